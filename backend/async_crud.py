@@ -0,0 +1,165 @@
+from datetime import datetime, timedelta
+from sqlalchemy import select
+from sqlalchemy.orm import joinedload, raiseload, selectinload
+from sqlalchemy.ext.asyncio import AsyncSession
+import models,schemas
+import crud, passwords, patient_index, patient_search, response_cache, scheduling
+from pagination import paginate_async, iterate_async
+
+# Async counterparts of the crud.py functions used by the async routers.
+
+async def get_user(db: AsyncSession, username: str):
+  return await db.scalar(select(models.User).where(models.User.username == username))
+
+async def authenticate_user(db: AsyncSession, username: str, password: str):
+  """Return the user when the password matches, upgrading its hash if the argon2 parameters changed."""
+  user = await get_user(db, username)
+  if user is None:
+    return None
+  valid, new_hash = await passwords.verify_and_update_async(password, user.password_hash)
+  if not valid:
+    return None
+  if new_hash is not None:
+    user.password_hash = new_hash
+    await db.commit()
+  return user
+
+async def create_patient(db: AsyncSession, patient: schemas.PatientCreate):
+  db_patient = models.Patient(**patient.dict())
+  db.add(db_patient)
+  await db.commit()
+  await db.refresh(db_patient)
+  patient_search.on_patient_saved(db, db_patient)
+  await patient_index.on_patient_saved_async(db, db_patient)
+  response_cache.invalidate("patients")
+  return db_patient
+
+async def get_patients(db: AsyncSession, limit: int | None = None, after: int | None = None):
+  return await paginate_async(db, select(models.Patient), models.Patient.id, limit, after)
+
+def iter_patients(db: AsyncSession, after: int | None = None, limit: int | None = None):
+  return iterate_async(db, select(models.Patient), models.Patient.id, after, limit)
+
+async def get_patient_by_id(db: AsyncSession, patient_id: int):
+  return await db.get(models.Patient, patient_id)
+
+async def update_patient(db: AsyncSession, db_patient: models.Patient, update_data: schemas.PatientCreate):
+  for key, value in update_data.dict().items():
+    setattr(db_patient, key, value)
+  await db.commit()
+  await db.refresh(db_patient)
+  patient_search.on_patient_saved(db, db_patient)
+  await patient_index.on_patient_saved_async(db, db_patient)
+  response_cache.invalidate("patients")
+  return db_patient
+
+async def delete_patient(db: AsyncSession, db_patient: models.Patient):
+  patient_id = db_patient.id
+  await db.delete(db_patient)
+  await db.commit()
+  patient_search.on_patient_deleted(db, patient_id)
+  await patient_index.on_patient_deleted_async(db, patient_id)
+  response_cache.invalidate("patients")
+
+async def search_patients(db: AsyncSession, q: str, limit: int = patient_search.MAX_RESULTS):
+  return await patient_search.search(db, q, limit)
+
+# Composite reads: fixed number of queries whatever the size of the graph;
+# raiseload makes any relationship left out fail loudly instead of lazy loading
+def _appointment_graph():
+  return (
+    joinedload(models.Appointment.doctor),
+    joinedload(models.Appointment.medical_record),
+    selectinload(models.Appointment.payment).selectinload(models.Payment.items),
+  )
+
+async def get_appointment_detail(db: AsyncSession, appointment_id: int):
+  return await db.scalar(
+    select(models.Appointment)
+    .where(models.Appointment.id == appointment_id)
+    .options(joinedload(models.Appointment.patient), *_appointment_graph(), raiseload("*"))
+  )
+
+async def get_patient_history(db: AsyncSession, patient_id: int):
+  return await db.scalar(
+    select(models.Patient)
+    .where(models.Patient.id == patient_id)
+    .options(selectinload(models.Patient.appointments).options(*_appointment_graph()), raiseload("*"))
+  )
+
+# Appointment
+async def create_appointment(db: AsyncSession, appointment: schemas.AppointmentCreate):
+  data = appointment.dict()
+  data['scheduled_at'] = scheduling.normalize(data['scheduled_at'])
+  await scheduling.ensure_free_async(db, data['doctor_id'], data['scheduled_at'], data['duration_minutes'])
+  db_appt = models.Appointment(**data)
+  db.add(db_appt)
+  await db.commit()
+  await db.refresh(db_appt)
+  response_cache.invalidate("appointments")
+  return db_appt
+
+async def get_appointments(db: AsyncSession, limit: int | None = None, after: int | None = None):
+  return await paginate_async(db, select(models.Appointment), models.Appointment.id, limit, after)
+
+def iter_appointments(db: AsyncSession, after: int | None = None, limit: int | None = None):
+  return iterate_async(db, select(models.Appointment), models.Appointment.id, after, limit)
+
+async def get_appointment_by_id(db: AsyncSession, appointment_id: int):
+  return await db.get(models.Appointment, appointment_id)
+
+async def update_appointment(db: AsyncSession, db_appointment: models.Appointment, updated_data: schemas.AppointmentCreate):
+  data = updated_data.dict()
+  data['scheduled_at'] = scheduling.normalize(data['scheduled_at'])
+  await scheduling.ensure_free_async(db, data['doctor_id'], data['scheduled_at'], data['duration_minutes'], exclude_id=db_appointment.id)
+  for key, value in data.items():
+    setattr(db_appointment, key, value)
+  await db.commit()
+  await db.refresh(db_appointment)
+  response_cache.invalidate("appointments")
+  return db_appointment
+
+async def get_doctor_availability(db: AsyncSession, doctor_id: int, start: datetime, end: datetime, min_minutes: int):
+  start, end = scheduling.normalize(start), scheduling.normalize(end)
+  schedule = await scheduling.load_schedule(db, doctor_id, start, end)
+  return schedule.free_windows(start, end, timedelta(minutes=min_minutes))
+
+async def delete_appointment(db: AsyncSession, db_appointment: models.Appointment):
+  await db.delete(db_appointment)
+  await db.commit()
+  response_cache.invalidate("appointments")
+
+# Payment
+async def create_payment(db: AsyncSession, payment: schemas.PaymentCreate):
+  db_payment = models.Payment(
+    appointment_id = payment.appointment_id,
+    amount=payment.amount,
+    payment_method=payment.payment_method,
+    status='pending'
+  )
+  db.add(db_payment)
+  await db.commit()
+  await db.refresh(db_payment)
+  return db_payment
+
+async def get_payment_by_id(db: AsyncSession, payment_id: int):
+  return await db.get(models.Payment, payment_id)
+
+async def set_payment_transaction(db: AsyncSession, payment_id: int, transaction_id: str, status: str | None = None):
+  db_payment = await db.get(models.Payment, payment_id)
+  db_payment.transaction_id = transaction_id
+  if status is not None:
+    db_payment.status = status
+  await db.commit()
+  await db.refresh(db_payment)
+  return db_payment
+
+async def update_payment_status(db: AsyncSession, transaction_id: str, new_status: str):
+  for stmt in crud.payment_status_statements({transaction_id: new_status}):
+    await db.execute(stmt)
+  await db.commit()
+  return await db.scalar(
+    select(models.Payment)
+    .where(models.Payment.transaction_id == transaction_id)
+    .execution_options(populate_existing=True)
+  )
@@ -1,50 +1,117 @@
-from datetime import datetime, timedelta, timezone
-from jose import JWTError, jwt
-from fastapi import Depends, HTTPException, status
+from datetime import timedelta
+from fastapi import Depends, HTTPException, Request, status
 from fastapi.security import OAuth2PasswordBearer
 import config, models
-from database import Sessions, get_db
-from sqlalchemy.orm import Session
+from database import AsyncSessions, Sessions, get_branch
+from principals import Principal, principal_cache
+from sqlalchemy import select
+from tokens import InvalidToken, create_token, decode_token
 
-SECRET_KEY = config.SECRET_KEY
-ALGORITHM = config.ALGORITHM
 ACCESS_TOKEN_EXPIRE_MINUTES = config.ACCESS_TOKEN_EXPIRE_MINUTES
 
 oauth2_scheme = OAuth2PasswordBearer(tokenUrl="/login/")
 
 def create_access_token(data: dict, expires_delta: timedelta | None = None):
-    to_encode = data.copy()
-    expire = datetime.now(timezone.utc) + timedelta(minutes=ACCESS_TOKEN_EXPIRE_MINUTES)
-    to_encode.update({"exp": expire})
-    encoded_jwt = jwt.encode(to_encode, SECRET_KEY, algorithm=ALGORITHM)
-    return encoded_jwt
+    if expires_delta is None:
+        expires_delta = timedelta(minutes=ACCESS_TOKEN_EXPIRE_MINUTES)
+    return create_token(data, expires_delta)
 
 def verify_token(token: str = Depends(oauth2_scheme)):
     try:
-        payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
-        return payload
-    except JWTError:
+        return decode_token(token)
+    except InvalidToken:
         raise HTTPException(
             status_code=status.HTTP_401_UNAUTHORIZED,
             detail="Invalid token",
             headers={"WWW-Authenticate": "Bearer"},
         )
 
-def get_current_user(token: str = Depends(oauth2_scheme),db: Session = Depends(get_db)):
+def _token_subject(token: str):
     payload = verify_token(token)
     username: str = payload.get('sub')
     if username is None:
         raise HTTPException(status_code=401, detail='Invalid token payload')
-    user = db.query(models.User).filter(models.User.username == username).first()
+    return username, payload
+
+def _cache_principal(user, username: str, branch: str, payload: dict):
     if user is None:
         raise HTTPException(status_code=404, detail='User not found')
-    return user
+    principal = Principal.from_user(user)
+    principal_cache.put(username, branch, principal, token_exp=payload.get('exp'))
+    return principal
 
-def require_role(roles: list[str]):
-    def role_checker(current_user = Depends(get_current_user)):
-        if current_user.role not in roles:
-            raise HTTPException(status_code=status.HTTP_403_FORBIDDEN, detail='You do not have permission to access this resource')
-        return current_user
-    return role_checker
+def _home_branch(payload: dict, branch: str) -> str:
+    """Database holding the caller's user row: the branch that issued the token."""
+    home = payload.get('branch')
+    return home if home in Sessions else branch
+
+def _claims_principal(payload: dict, branch: str):
+    """Principal straight from the token claims, if it was issued by this branch's database."""
+    uid, role = payload.get('uid'), payload.get('role')
+    if uid is None or role is None or payload.get('branch') != branch:
+        return None
+    return Principal(uid, payload['sub'], role, branch)
+
+def _cached_principal(token: str, branch: str, claims_only: bool):
+    username, payload = _token_subject(token)
+    home = _home_branch(payload, branch)
+    principal = (_claims_principal(payload, home) if claims_only else None) or principal_cache.get(username, home)
+    return username, payload, home, principal
+
+def _check_branch_access(request: Request, principal):
+    if getattr(request.state, 'branch_override', False) and principal.role != 'admin':
+        raise HTTPException(status_code=status.HTTP_403_FORBIDDEN, detail='Only admins can access another branch')
+    return principal
+
+def _resolve_user(request: Request, token: str, branch: str, claims_only: bool = False):
+    username, payload, home, principal = _cached_principal(token, branch, claims_only)
+    if principal is None:
+        with Sessions[home]() as db:
+            user = db.query(models.User).filter(models.User.username == username).first()
+        principal = _cache_principal(user, username, home, payload)
+    return _check_branch_access(request, principal)
+
+async def _resolve_user_async(request: Request, token: str, branch: str, claims_only: bool = False):
+    username, payload, home, principal = _cached_principal(token, branch, claims_only)
+    if principal is None:
+        async with AsyncSessions[home]() as db:
+            user = await db.scalar(select(models.User).where(models.User.username == username))
+        principal = _cache_principal(user, username, home, payload)
+    return _check_branch_access(request, principal)
+
+def get_current_user(request: Request, token: str = Depends(oauth2_scheme), branch: str = Depends(get_branch)):
+    return _resolve_user(request, token, branch)
 
+async def get_current_user_async(request: Request, token: str = Depends(oauth2_scheme), branch: str = Depends(get_branch)):
+    return await _resolve_user_async(request, token, branch)
 
+def get_claims_user(request: Request, token: str = Depends(oauth2_scheme), branch: str = Depends(get_branch)):
+    """get_current_user() without a database lookup when the token already says who the caller is."""
+    return _resolve_user(request, token, branch, claims_only=True)
+
+async def get_claims_user_async(request: Request, token: str = Depends(oauth2_scheme), branch: str = Depends(get_branch)):
+    return await _resolve_user_async(request, token, branch, claims_only=True)
+
+def _check_role(current_user, roles: list[str]):
+    if current_user.role not in roles:
+        raise HTTPException(status_code=status.HTTP_403_FORBIDDEN, detail='You do not have permission to access this resource')
+    return current_user
+
+def require_role(roles: list[str], claims_only: bool = False):
+    """Dependency that admits the given roles.
+
+    claims_only=True trusts the role in the token instead of re-reading the
+    user, so a role change or deletion only applies once the token expires;
+    use it on read-only routes where that is acceptable.
+    """
+    resolve = get_claims_user if claims_only else get_current_user
+    def role_checker(current_user = Depends(resolve)):
+        return _check_role(current_user, roles)
+    return role_checker
+
+def require_role_async(roles: list[str], claims_only: bool = False):
+    """require_role() for async routes; resolves the user on the async session."""
+    resolve = get_claims_user_async if claims_only else get_current_user_async
+    async def role_checker(current_user = Depends(resolve)):
+        return _check_role(current_user, roles)
+    return role_checker
@@ -0,0 +1,107 @@
+"""Fail when an endpoint runs more SQL statements than its @query_budget.
+
+Seeds a small and a large data set (more appointments, records, payments and
+items per patient), calls every budgeted endpoint on both and reads the
+X-Query-Count header. An endpoint fails when it exceeds its budget or when its
+count grows with the data set (an N+1 query). Exits 1 on any failure, so it
+can run in CI:
+
+    python benchmarks/check_query_budgets.py
+"""
+import os
+import sys
+import tempfile
+from datetime import datetime, timedelta
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault("MIDTRANS_SERVER_KEY", "SB-Mid-server-benchmark")
+os.environ.setdefault("MIDTRANS_CLIENT_KEY", "SB-Mid-client-benchmark")
+os.environ.setdefault("SECRET_KEY", "benchmark-secret")
+os.environ.setdefault("PASSWORD_HASH_WORKERS", "0")
+os.environ["SQL_INSTRUMENTATION"] = "true"
+os.environ["QUERY_COUNT_HEADER"] = "true"
+os.environ["WEBHOOK_CONSUMER_ENABLED"] = "false"
+if "DATABASE_URL_CENTRAL" not in os.environ:
+  _tmp = tempfile.mkdtemp()
+  for _branch in ("central", "branch_a", "branch_b"):
+    os.environ[f"DATABASE_URL_{_branch.upper()}"] = f"sqlite:///{_tmp}/{_branch}.db"
+
+from fastapi.routing import APIRoute
+from fastapi.testclient import TestClient
+from starlette.routing import Match
+
+import crud, main, models, schemas
+from database import Sessions
+from querycount import QUERY_COUNT_HEADER
+
+def seed(db, doctor_id: int, visits: int, items: int) -> dict:
+  """One patient with `visits` appointments, each with a record and a payment of `items` lines."""
+  patient = models.Patient(name=f"Pasien {visits}", national_id=f"NIK{visits}", phone="0811", address="Jl. Contoh")
+  db.add(patient)
+  db.flush()
+  start = datetime(2025, 1, 1, 8)
+  payment = None
+  for i in range(visits):
+    appointment = models.Appointment(patient_id=patient.id, doctor_id=doctor_id, scheduled_at=start + timedelta(days=i), status="done")
+    db.add(appointment)
+    db.flush()
+    db.add(models.MedicalRecord(appointment_id=appointment.id, patient_id=patient.id, doctor_id=doctor_id, diagnosis="-", treatment="-", notes="-"))
+    payment = models.Payment(appointment_id=appointment.id, amount=0, payment_method="cash", status="pending")
+    payment.items = [models.PaymentItem(description=f"item {n}", quantity=1, price=1000, total=1000) for n in range(items)]
+    db.add(payment)
+  db.commit()
+  return {"patient_id": patient.id, "appointment_id": appointment.id, "payment_id": payment.id}
+
+def requests_for(ids: dict, items: int) -> list[tuple[str, str, dict | None]]:
+  return [
+    ("GET", f"/appointments/{ids['appointment_id']}", None),
+    ("GET", f"/patients/{ids['patient_id']}/history", None),
+    ("GET", f"/payments/{ids['payment_id']}", None),
+    ("POST", f"/payments/{ids['payment_id']}/items/bulk",
+     {"items": [{"description": f"obat {n}", "quantity": 2, "price": "1500.00"} for n in range(items)]}),
+    ("GET", f"/medical_records/patient/{ids['patient_id']}", None),
+    ("GET", f"/medical_records/patient/{ids['patient_id']}/timeline?full=true&limit=10", None),
+  ]
+
+def main_check() -> int:
+  budgets = {route.path: route.endpoint.query_budget for route in main.app.routes
+             if isinstance(route, APIRoute) and hasattr(route.endpoint, "query_budget")}
+  db = Sessions["central"]()
+  for role in ("admin", "doctor"):
+    crud.create_user(db, schemas.UserCreate(username=f"budget-{role}", password="pw", role=role, branch="central"))
+  doctor_id = crud.get_user(db, "budget-doctor").id
+  small, large = seed(db, doctor_id, visits=1, items=1), seed(db, doctor_id, visits=20, items=15)
+  db.close()
+
+  client = TestClient(main.app)
+  headers = {}
+  for role in ("admin", "doctor"):
+    token = client.post("/login/", json={"username": f"budget-{role}", "password": "pw"}).json()["access_token"]
+    headers[role] = {"Authorization": f"Bearer {token}"}
+    # warm the principal cache so both measurements see the same auth cost
+    client.get(f"/medical_records/patient/{small['patient_id']}", headers=headers[role])
+
+  failures = 0
+  checked = set()
+  for (method, path, body), (_, large_path, large_body) in zip(requests_for(small, 1), requests_for(large, 15)):
+    role = "doctor" if path.startswith("/medical_records") else "admin"
+    counts = []
+    for url, payload in ((path, body), (large_path, large_body)):
+      response = client.request(method, url, json=payload, headers=headers[role])
+      if response.status_code >= 400:
+        print(f"FAIL {method} {url}: HTTP {response.status_code} {response.text}")
+        failures += 1
+      counts.append(int(response.headers[QUERY_COUNT_HEADER]))
+    route = next(r for r in main.app.routes if isinstance(r, APIRoute) and r.matches({"type": "http", "path": path.split("?")[0], "method": method})[0] == Match.FULL)
+    budget = budgets[route.path]
+    checked.add(route.path)
+    ok = max(counts) <= budget and counts[0] == counts[1]
+    failures += not ok
+    print(f"{'ok  ' if ok else 'FAIL'} {method} {route.path}: {counts[0]} / {counts[1]} statements (small / large), budget {budget}")
+  for path in sorted(budgets.keys() - checked):
+    print(f"FAIL {path}: has a query budget but no request in this script")
+    failures += 1
+  return 1 if failures else 0
+
+if __name__ == "__main__":
+  sys.exit(main_check())
@@ -0,0 +1,118 @@
+"""Local stand-in for the Midtrans Snap and Core APIs.
+
+Serves the three endpoints midtrans.MidtransClient uses, with configurable
+latency and failure rate, so the payment routes, retries and circuit breaker
+can be exercised without the sandbox:
+
+    python benchmarks/fake_midtrans.py --port 8900 --latency 0.3 --failure-rate 0.2
+    MIDTRANS_API_URL=http://localhost:8900 MIDTRANS_SNAP_URL=http://localhost:8900/snap uvicorn main:app
+
+It can also be mounted in-process: MidtransClient(transport=httpx.ASGITransport(app=create_app())).
+"""
+import argparse
+import asyncio
+import random
+import uuid
+from datetime import datetime
+
+from fastapi import FastAPI, Request
+from fastapi.responses import JSONResponse
+
+def create_app(latency: float = 0.0, failure_rate: float = 0.0) -> FastAPI:
+  app = FastAPI(title="Fake Midtrans")
+  app.state.latency = latency
+  app.state.failure_rate = failure_rate
+  app.state.calls = 0
+  orders: dict[str, dict] = {}
+
+  @app.middleware("http")
+  async def degrade(request: Request, call_next):
+    app.state.calls += 1
+    if app.state.latency:
+      await asyncio.sleep(app.state.latency)
+    if random.random() < app.state.failure_rate:
+      return JSONResponse(status_code=503, content={"status_message": "Service unavailable (fake)"})
+    if not request.url.path.startswith("/fake/") and not request.headers.get("authorization", "").startswith("Basic "):
+      return JSONResponse(status_code=401, content={"status_code": "401", "status_message": "Unauthorized"})
+    return await call_next(request)
+
+  def _order(body: dict) -> tuple[str, int]:
+    details = body.get("transaction_details") or {}
+    return str(details.get("order_id")), int(details.get("gross_amount") or 0)
+
+  @app.post("/snap/v1/transactions")
+  async def snap_transaction(request: Request):
+    order_id, gross_amount = _order(await request.json())
+    if order_id in orders:
+      return JSONResponse(status_code=400, content={"error_messages": ["transaction_details.order_id sudah digunakan"]})
+    token = uuid.uuid4().hex
+    orders[order_id] = {"transaction_id": token, "transaction_status": "pending", "gross_amount": f"{gross_amount}.00"}
+    return JSONResponse(status_code=201, content={"token": token, "redirect_url": f"https://fake.midtrans/snap/v2/vtweb/{token}"})
+
+  @app.post("/v2/charge")
+  async def charge(request: Request):
+    body = await request.json()
+    order_id, gross_amount = _order(body)
+    key = request.headers.get("idempotency-key")
+    if order_id in orders and not (key and orders[order_id].get("idempotency_key") == key):
+      return {"status_code": "406", "status_message": "The request could not be completed due to a conflict with the current state of the target resource, please try again"}
+    order = orders.setdefault(order_id, {
+      "transaction_id": str(uuid.uuid4()),
+      "transaction_status": "pending",
+      "gross_amount": f"{gross_amount}.00",
+      "idempotency_key": key,
+    })
+    bank = (body.get("bank_transfer") or {}).get("bank", "bca")
+    return {
+      "status_code": "201",
+      "status_message": "Success, Bank Transfer transaction is created",
+      "transaction_id": order["transaction_id"],
+      "order_id": order_id,
+      "gross_amount": order["gross_amount"],
+      "payment_type": body.get("payment_type"),
+      "transaction_time": datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
+      "transaction_status": order["transaction_status"],
+      "fraud_status": "accept",
+      "va_numbers": [{"bank": bank, "va_number": str(random.randint(10**10, 10**11 - 1))}],
+    }
+
+  @app.get("/v2/{order_id}/status")
+  async def status(order_id: str):
+    order = orders.get(order_id)
+    if order is None:
+      return {"status_code": "404", "status_message": "Transaction doesn't exist."}
+    expired = order["transaction_status"] == "expire"
+    return {
+      "status_code": "407" if expired else "200",
+      "status_message": "Success, transaction has expired" if expired else "Success, transaction is found",
+      "transaction_id": order["transaction_id"],
+      "order_id": order_id,
+      "gross_amount": order["gross_amount"],
+      "transaction_status": order["transaction_status"],
+      "fraud_status": "accept",
+    }
+
+  @app.post("/fake/{order_id}/settle")
+  async def settle(order_id: str):
+    """Test helper: mark an order as settled."""
+    orders[order_id]["transaction_status"] = "settlement"
+    return orders[order_id]
+
+  @app.post("/fake/{order_id}/expire")
+  async def expire(order_id: str):
+    """Test helper: let an order expire unpaid (status lookups then answer 407)."""
+    orders[order_id]["transaction_status"] = "expire"
+    return orders[order_id]
+
+  return app
+
+if __name__ == "__main__":
+  import uvicorn
+
+  parser = argparse.ArgumentParser(description="Fake Midtrans API server")
+  parser.add_argument("--host", default="127.0.0.1")
+  parser.add_argument("--port", type=int, default=8900)
+  parser.add_argument("--latency", type=float, default=0.0, help="seconds added to every response")
+  parser.add_argument("--failure-rate", type=float, default=0.0, help="fraction of requests answered with 503")
+  args = parser.parse_args()
+  uvicorn.run(create_app(args.latency, args.failure_rate), host=args.host, port=args.port)
@@ -0,0 +1,443 @@
+"""Load test of the clinic API: seed a synthetic dataset, drive the real app, report JSON.
+
+Every branch database gets its own synthetic clinic: doctors, an admin,
+patients, past appointments with medical records, and pending payments with
+items. The real main.app is then driven with concurrent clients, one
+scenario at a time. The scenarios cover login and token refresh, the list
+endpoints, master patient index lookups and merged cross-branch histories,
+creating patients and appointments, Midtrans webhooks and payment detail. Midtrans is replaced by benchmarks/fake_midtrans.py,
+mounted in-process.
+
+Two modes:
+- "inprocess" (the default) uses httpx.ASGITransport.
+- "http" serves the app with uvicorn on a local port, so requests go
+  through the real HTTP stack.
+
+Without DATABASE_URL_* every branch is a temporary SQLite file. Point them
+at a local Postgres for meaningful numbers; seeded rows are tagged with a
+run id, so repeated runs on the same databases do not collide. SQLite
+allows one writer at a time, so write scenarios run with concurrency 1
+there.
+
+The report is JSON, with p50/p95/p99 latency, throughput, status codes and
+peak RSS per scenario, plus the git commit and dataset sizes. Save it with
+--output and compare two runs with --compare:
+
+    python benchmarks/load_test.py --patients 5000 --requests 2000 --concurrency 50 --output before.json
+    python benchmarks/load_test.py --patients 5000 --requests 2000 --concurrency 50 --compare before.json
+    python benchmarks/load_test.py --mode http --scenarios list_patients,payment_detail
+"""
+import argparse
+import asyncio
+import json
+import os
+import platform
+import random
+import resource
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import uuid
+from datetime import datetime, timedelta
+
+BACKEND = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, BACKEND)
+os.environ.setdefault("MIDTRANS_SERVER_KEY", "SB-Mid-server-benchmark")
+os.environ.setdefault("MIDTRANS_CLIENT_KEY", "SB-Mid-client-benchmark")
+os.environ.setdefault("SECRET_KEY", "benchmark-secret")
+# the webhook queue is drained after the webhook scenario instead of racing it
+os.environ["WEBHOOK_CONSUMER_ENABLED"] = "false"
+if "DATABASE_URL_CENTRAL" not in os.environ:
+  _tmp = tempfile.mkdtemp()
+  for _branch in ("central", "branch_a", "branch_b"):
+    os.environ[f"DATABASE_URL_{_branch.upper()}"] = f"sqlite:///{_tmp}/{_branch}.db"
+
+import httpx
+from sqlalchemy import func, insert, select, text
+
+import main, midtrans, models, passwords, patient_index, payment_queue, refresh_tokens, user_directory
+from benchmarks import fake_midtrans
+from database import AsyncSessions, Sessions, async_engines, engines
+
+PASSWORD = "bench-password"
+SCENARIOS = (
+  "login", "list_patients", "list_doctors", "patient_history", "record_timeline",
+  "patient_records", "merged_history", "create_patient", "create_appointment", "webhook", "payment_detail", "snap_token", "token_refresh",
+)
+WRITE_SCENARIOS = {"create_patient", "create_appointment", "webhook", "snap_token", "token_refresh"}
+
+def _next_id(db, model) -> int:
+  return (db.scalar(select(func.max(model.id))) or 0) + 1
+
+def _bulk(db, model, rows: list[dict], chunk: int = 5000):
+  for i in range(0, len(rows), chunk):
+    db.execute(insert(model), rows[i:i + chunk])
+
+def _sync_sequences(db):
+  # ids were assigned explicitly, so move the Postgres sequences past them
+  if db.bind.dialect.name != "postgresql":
+    return
+  for model in (models.User, models.Patient, models.Appointment, models.MedicalRecord, models.Payment, models.PaymentItem):
+    table = model.__tablename__
+    db.execute(text(f"SELECT setval(pg_get_serial_sequence('{table}', 'id'), (SELECT max(id) FROM {table}))"))
+
+def seed_branch(branch: str, run_id: str, args, password_hash: str) -> dict:
+  """Insert one synthetic clinic into a branch database; returns the ids the scenarios use."""
+  rng = random.Random(f"{run_id}-{branch}")
+  db = Sessions[branch]()
+  try:
+    user_id = _next_id(db, models.User)
+    admin = f"bench-{run_id}-admin"
+    users = [{"id": user_id, "username": admin, "password_hash": password_hash, "role": "admin", "branch": branch}]
+    doctor_ids = list(range(user_id + 1, user_id + 1 + args.doctors))
+    users += [
+      {"id": doctor_id, "username": f"bench-{run_id}-dr{n}", "password_hash": password_hash, "role": "doctor", "branch": branch}
+      for n, doctor_id in enumerate(doctor_ids)
+    ]
+    _bulk(db, models.User, users)
+
+    patient_start = _next_id(db, models.Patient)
+    patient_ids = list(range(patient_start, patient_start + args.patients))
+    _bulk(db, models.Patient, [
+      {"id": pid, "name": f"Pasien {pid}", "national_id": f"B{run_id}{pid:09d}", "phone": f"08{pid:010d}", "address": f"Jl. Benchmark No. {pid}"}
+      for pid in patient_ids
+    ])
+
+    appointment_id = _next_id(db, models.Appointment)
+    record_id = _next_id(db, models.MedicalRecord)
+    payment_id = _next_id(db, models.Payment)
+    item_id = _next_id(db, models.PaymentItem)
+    appointments, records, payments, items = [], [], [], []
+    payment_ids, transaction_ids = [], []
+    start = datetime(2024, 1, 1, 8)
+    for pid in patient_ids:
+      for visit in range(args.visits):
+        doctor_id = rng.choice(doctor_ids)
+        scheduled_at = start + timedelta(days=rng.randrange(365), minutes=30 * rng.randrange(16))
+        appointments.append({"id": appointment_id, "patient_id": pid, "doctor_id": doctor_id, "scheduled_at": scheduled_at, "duration_minutes": 30, "status": "done"})
+        records.append({
+          "id": record_id, "appointment_id": appointment_id, "patient_id": pid, "doctor_id": doctor_id,
+          "diagnosis": "Diagnosis " * 20, "treatment": "Treatment " * 20, "notes": "Notes " * 40, "created_at": scheduled_at,
+        })
+        record_id += 1
+        if rng.random() < args.payment_ratio:
+          transaction_id = f"bench-{run_id}-{branch}-{payment_id}"
+          lines = [{"id": item_id + n, "payment_id": payment_id, "description": f"Item {n}", "quantity": 1, "price": 50000, "total": 50000} for n in range(args.items)]
+          items += lines
+          item_id += len(lines)
+          payments.append({
+            "id": payment_id, "appointment_id": appointment_id, "amount": 50000 * len(lines), "payment_method": "bank_transfer",
+            "status": "pending", "transaction_id": transaction_id, "created_date": scheduled_at,
+          })
+          payment_ids.append(payment_id)
+          transaction_ids.append(transaction_id)
+          payment_id += 1
+        appointment_id += 1
+    _bulk(db, models.Appointment, appointments)
+    _bulk(db, models.MedicalRecord, records)
+    _bulk(db, models.Payment, payments)
+    _bulk(db, models.PaymentItem, items)
+    _sync_sequences(db)
+    db.commit()
+  finally:
+    db.close()
+  return {
+    "admin": admin,
+    "admin_id": user_id,
+    "doctor": f"bench-{run_id}-dr0",
+    "doctor_ids": doctor_ids,
+    "patient_ids": patient_ids,
+    "appointment_ids": [a["id"] for a in appointments],
+    "payment_ids": payment_ids,
+    "transaction_ids": transaction_ids,
+  }
+
+class Scenario:
+  def __init__(self, name: str, requests: int, build, role: str = "admin", ok=(200,)):
+    self.name = name
+    self.requests = requests
+    # build(i) -> (method, url, json body or None)
+    self.build = build
+    self.role = role
+    self.ok = ok
+
+def scenarios(data: dict, args, run_id: str) -> dict[str, Scenario]:
+  central = data["central"]
+  patients, payments = central["patient_ids"], central["payment_ids"]
+  transactions = central["transaction_ids"]
+  rng = random.Random(run_id)
+  future = datetime(2030, 1, 1, 8)
+
+  def login(i):
+    return "POST", "/login/", {"username": central["admin"], "password": PASSWORD}
+
+  def list_patients(i):
+    return "GET", f"/patients/?limit=50&after={rng.choice(patients)}", None
+
+  def list_doctors(i):
+    return "GET", "/users/?role=doctor", None
+
+  def patient_history(i):
+    return "GET", f"/patients/{rng.choice(patients)}/history", None
+
+  def record_timeline(i):
+    return "GET", f"/medical_records/patient/{rng.choice(patients)}/timeline?limit=20", None
+
+  def patient_records(i):
+    return "GET", f"/patients/{rng.choice(patients)}/branches", None
+
+  def merged_history(i):
+    return "GET", f"/patients/{rng.choice(patients)}/history/merged", None
+
+  def create_patient(i):
+    return "POST", "/patients/", {"name": f"New {i}", "national_id": f"N{run_id}{i:09d}", "phone": "0800", "address": "Jl. Baru"}
+
+  def create_appointment(i):
+    # every request gets its own slot so none hits a scheduling conflict
+    doctor_id = central["doctor_ids"][i % len(central["doctor_ids"])]
+    slot = future + timedelta(minutes=30 * (i // len(central["doctor_ids"])))
+    return "POST", "/appointments/", {"patient_id": rng.choice(patients), "doctor_id": doctor_id, "scheduled_at": slot.isoformat()}
+
+  def webhook(i):
+    transaction_id = transactions[i % len(transactions)]
+    body = {
+      "order_id": transaction_id, "transaction_id": transaction_id, "transaction_status": "settlement" if i < len(transactions) else "pending",
+      "fraud_status": "accept", "status_code": "200", "gross_amount": "150000.00",
+    }
+    body["signature_key"] = midtrans.signature(body["order_id"], body["status_code"], body["gross_amount"])
+    return "POST", "/payments/notification", body
+
+  def payment_detail(i):
+    return "GET", f"/payments/{rng.choice(payments)}", None
+
+  def token_refresh(i):
+    # every refresh rotates its token, so each request gets one of its own
+    return "POST", "/token/refresh", {"refresh_token": data["refresh_tokens"][i]}
+
+  def snap_token(i):
+    return "POST", "/payments/create-snap-token", {"appointment_id": rng.choice(central["appointment_ids"]), "amount": 150000, "payment_method": "snap"}
+
+  n = args.requests
+  defined = [
+    Scenario("login", max(1, n // 10), login),
+    Scenario("list_patients", n, list_patients),
+    Scenario("list_doctors", n, list_doctors),
+    Scenario("patient_history", n, patient_history),
+    Scenario("record_timeline", n, record_timeline, role="doctor"),
+    Scenario("patient_records", n, patient_records),
+    Scenario("merged_history", n, merged_history, role="doctor"),
+    Scenario("create_patient", n, create_patient),
+    Scenario("create_appointment", n, create_appointment),
+    Scenario("webhook", n, webhook),
+    Scenario("payment_detail", n, payment_detail),
+    Scenario("snap_token", n, snap_token),
+    Scenario("token_refresh", n, token_refresh),
+  ]
+  return {scenario.name: scenario for scenario in defined}
+
+def percentile(sorted_values: list[float], p: float) -> float | None:
+  if not sorted_values:
+    return None
+  # nearest rank
+  index = max(0, min(len(sorted_values) - 1, int(round(p * len(sorted_values) + 0.5)) - 1))
+  return round(sorted_values[index] * 1000, 2)
+
+def peak_rss_mb() -> dict:
+  # ru_maxrss is in KiB on Linux; children covers the password hashing pool
+  return {
+    "self": round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1),
+    "children": round(resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss / 1024, 1),
+  }
+
+async def run_scenario(client, scenario: Scenario, headers: dict, concurrency: int) -> dict:
+  latencies: list[float] = []
+  statuses: dict[int, int] = {}
+  counter = iter(range(scenario.requests))
+
+  async def worker():
+    for i in counter:
+      method, url, body = scenario.build(i)
+      start = time.perf_counter()
+      try:
+        response = await client.request(method, url, json=body, headers=headers)
+        status = response.status_code
+      except httpx.HTTPError:
+        status = 0
+      latencies.append(time.perf_counter() - start)
+      statuses[status] = statuses.get(status, 0) + 1
+
+  start = time.perf_counter()
+  await asyncio.gather(*(worker() for _ in range(concurrency)))
+  elapsed = time.perf_counter() - start
+  latencies.sort()
+  errors = sum(count for status, count in statuses.items() if status not in scenario.ok)
+  return {
+    "requests": scenario.requests,
+    "concurrency": concurrency,
+    "seconds": round(elapsed, 3),
+    "rps": round(scenario.requests / elapsed, 1) if elapsed else None,
+    "p50_ms": percentile(latencies, 0.50),
+    "p95_ms": percentile(latencies, 0.95),
+    "p99_ms": percentile(latencies, 0.99),
+    "max_ms": percentile(latencies, 1.0),
+    "errors": errors,
+    "status_codes": {str(status): count for status, count in sorted(statuses.items())},
+    "peak_rss_mb": peak_rss_mb(),
+  }
+
+class HttpServer:
+  """main.app under uvicorn in a background thread (its own event loop)."""
+  def __init__(self, port: int):
+    import uvicorn
+    self.server = uvicorn.Server(uvicorn.Config(main.app, host="127.0.0.1", port=port, log_level="warning"))
+    self.thread = threading.Thread(target=self.server.run, name="bench-uvicorn", daemon=True)
+
+  def __enter__(self):
+    self.thread.start()
+    while not self.server.started:
+      time.sleep(0.05)
+    return self
+
+  def __exit__(self, *exc):
+    self.server.should_exit = True
+    self.thread.join(timeout=10)
+
+def git_revision() -> dict:
+  def git(*command):
+    try:
+      return subprocess.run(["git", *command], cwd=BACKEND, capture_output=True, text=True, timeout=10).stdout.strip()
+    except (OSError, subprocess.SubprocessError):
+      return None
+  return {"commit": git("rev-parse", "HEAD"), "dirty": bool(git("status", "--porcelain", "--untracked-files=no"))}
+
+async def refresh_token_pool(user_id: int, count: int) -> list[str]:
+  async with AsyncSessions["central"]() as db:
+    pool = [await refresh_tokens.issue(db, "central", user_id) for _ in range(count)]
+    await db.commit()
+  return pool
+
+async def drive(args, selected: list[str], data: dict, run_id: str) -> dict:
+  if "token_refresh" in selected:
+    data["refresh_tokens"] = await refresh_token_pool(data["central"]["admin_id"], args.requests)
+  defined = scenarios(data, args, run_id)
+  results = {}
+  if args.mode == "http":
+    limits = httpx.Limits(max_connections=args.concurrency, max_keepalive_connections=args.concurrency)
+    client = httpx.AsyncClient(base_url=f"http://127.0.0.1:{args.port}", limits=limits, timeout=60)
+  else:
+    client = httpx.AsyncClient(transport=httpx.ASGITransport(app=main.app), base_url="http://bench", timeout=60)
+  sqlite = async_engines["central"].dialect.name == "sqlite"
+  async with client:
+    headers = {}
+    for role in ("admin", "doctor"):
+      login = await client.post("/login/", json={"username": data["central"][role], "password": PASSWORD})
+      headers[role] = {"Authorization": f"Bearer {login.json()['access_token']}"}
+    for name in selected:
+      scenario = defined[name]
+      concurrency = 1 if sqlite and name in WRITE_SCENARIOS else args.concurrency
+      results[name] = await run_scenario(client, scenario, headers[scenario.role], concurrency)
+      if name == "webhook":
+        drain_start = time.perf_counter()
+        applied = payment_queue.drain("central")
+        results[name]["queue_drain"] = {"notifications": applied, "seconds": round(time.perf_counter() - drain_start, 3)}
+      print(f"{name}: {results[name]['rps']} req/s, p95 {results[name]['p95_ms']} ms, {results[name]['errors']} errors", file=sys.stderr)
+  return results
+
+def compare(current: dict, baseline: dict, threshold: float) -> list[str]:
+  """Scenarios whose p95 grew or throughput fell by more than threshold (a fraction)."""
+  regressions = []
+  for name, result in current["scenarios"].items():
+    before = baseline.get("scenarios", {}).get(name)
+    if not before or not before.get("p95_ms") or not before.get("rps"):
+      continue
+    p95 = result["p95_ms"] / before["p95_ms"] - 1
+    rps = result["rps"] / before["rps"] - 1
+    flag = p95 > threshold or rps < -threshold
+    print(f"{'REGRESSION' if flag else 'ok':10} {name:20} p95 {before['p95_ms']:>9} -> {result['p95_ms']:>9} ms ({p95:+.0%})  "
+          f"rps {before['rps']:>8} -> {result['rps']:>8} ({rps:+.0%})", file=sys.stderr)
+    if flag:
+      regressions.append(name)
+  return regressions
+
+def run(args) -> int:
+  run_id = uuid.uuid4().hex[:6]
+  selected = args.scenarios.split(",") if args.scenarios else list(SCENARIOS)
+  unknown = set(selected) - set(SCENARIOS)
+  if unknown:
+    print(f"unknown scenarios: {', '.join(sorted(unknown))}; available: {', '.join(SCENARIOS)}", file=sys.stderr)
+    return 2
+
+  midtrans.gateway = midtrans.MidtransClient(transport=httpx.ASGITransport(app=fake_midtrans.create_app(latency=args.midtrans_latency)))
+  seed_start = time.perf_counter()
+  password_hash = passwords.hash_password(PASSWORD)
+  data = {branch: seed_branch(branch, run_id, args, password_hash) for branch in Sessions}
+  # the seed bypasses crud, so register its users for /login/ and link its patients
+  # (on fresh databases a patient id has the same national_id in every branch)
+  user_directory.rebuild()
+  patient_index.rebuild()
+  seed_seconds = time.perf_counter() - seed_start
+  print(f"seeded {len(data)} branches in {seed_seconds:.1f}s", file=sys.stderr)
+
+  async def go():
+    try:
+      return await drive(args, selected, data, run_id)
+    finally:
+      for engine in async_engines.values():
+        await engine.dispose()
+
+  try:
+    if args.mode == "http":
+      with HttpServer(args.port):
+        results = asyncio.run(go())
+    else:
+      results = asyncio.run(go())
+  finally:
+    passwords.shutdown()
+
+  # before git_revision(): a forked child starts with this process's RSS
+  peak = peak_rss_mb()
+  report = {
+    "run_id": run_id,
+    "started_at": datetime.utcnow().isoformat(),
+    "git": git_revision(),
+    "python": platform.python_version(),
+    "mode": args.mode,
+    "database": {branch: engine.dialect.name for branch, engine in engines.items()},
+    "dataset": {
+      "branches": len(data), "doctors": args.doctors, "patients": args.patients, "visits_per_patient": args.visits,
+      "payment_ratio": args.payment_ratio, "items_per_payment": args.items, "seed_seconds": round(seed_seconds, 2),
+    },
+    "concurrency": args.concurrency,
+    "scenarios": results,
+    "peak_rss_mb": peak,
+  }
+  output = json.dumps(report, indent=2)
+  print(output)
+  if args.output:
+    with open(args.output, "w") as f:
+      f.write(output + "\n")
+  if args.compare:
+    with open(args.compare) as f:
+      if compare(report, json.load(f), args.threshold):
+        return 1
+  return 0
+
+if __name__ == "__main__":
+  parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+  parser.add_argument("--mode", choices=("inprocess", "http"), default="inprocess")
+  parser.add_argument("--port", type=int, default=8765, help="port for --mode http")
+  parser.add_argument("--scenarios", help="comma-separated subset (default: all)")
+  parser.add_argument("--requests", type=int, default=500, help="requests per scenario (login runs a tenth)")
+  parser.add_argument("--concurrency", type=int, default=20)
+  parser.add_argument("--doctors", type=int, default=20, help="per branch")
+  parser.add_argument("--patients", type=int, default=2000, help="per branch")
+  parser.add_argument("--visits", type=int, default=3, help="appointments (each with a medical record) per patient")
+  parser.add_argument("--payment-ratio", type=float, default=0.8, help="fraction of appointments with a payment")
+  parser.add_argument("--items", type=int, default=3, help="items per payment")
+  parser.add_argument("--midtrans-latency", type=float, default=0.0, help="seconds the fake Midtrans waits per call")
+  parser.add_argument("--output", help="also write the JSON report to this file")
+  parser.add_argument("--compare", help="baseline report; exit 1 if p95 or throughput regressed beyond --threshold")
+  parser.add_argument("--threshold", type=float, default=0.2)
+  sys.exit(run(parser.parse_args()))
@@ -0,0 +1,98 @@
+"""Reconcile pending payments against the fake Midtrans and check the outcome.
+
+Seeds pending payments in central whose webhooks were "lost". Each payment
+gets an order in benchmarks/fake_midtrans.py, mounted in-process. A share of
+the orders is then settled and a share expires unpaid; expired orders answer
+status lookups with status_code 407. One reconciliation.reconcile_branch
+pass runs, then the statuses are checked: settled orders must end up paid,
+expired orders failed, the rest still pending. Exits 1 on any mismatch.
+
+    python benchmarks/reconcile.py --payments 2000 --settled 0.4 --expired 0.3 --concurrency 20
+"""
+import argparse
+import asyncio
+import json
+import os
+import random
+import sys
+import tempfile
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault("MIDTRANS_SERVER_KEY", "SB-Mid-server-benchmark")
+os.environ.setdefault("MIDTRANS_CLIENT_KEY", "SB-Mid-client-benchmark")
+os.environ.setdefault("SECRET_KEY", "benchmark-secret")
+if "DATABASE_URL_CENTRAL" not in os.environ:
+  _tmp = tempfile.mkdtemp()
+  for _branch in ("central", "branch_a", "branch_b"):
+    os.environ[f"DATABASE_URL_{_branch.upper()}"] = f"sqlite:///{_tmp}/{_branch}.db"
+
+import httpx
+
+import midtrans, migrations, models, reconciliation
+from benchmarks import fake_midtrans
+from database import Sessions, async_engines, engines
+
+def seed_payments(count: int) -> list[int]:
+  db = Sessions["central"]()
+  payments = [
+    models.Payment(appointment_id=None, amount=150000, payment_method="bank_transfer", status="pending", transaction_id=f"reconcile-{i}")
+    for i in range(count)
+  ]
+  db.add_all(payments)
+  db.commit()
+  ids = [payment.id for payment in payments]
+  db.close()
+  return ids
+
+async def run(args) -> int:
+  migrations.upgrade(engines["central"])
+  payment_ids = seed_payments(args.payments)
+  rng = random.Random(args.seed)
+  expected = {}
+  for payment_id in payment_ids:
+    draw = rng.random()
+    expected[payment_id] = "paid" if draw < args.settled else "failed" if draw < args.settled + args.expired else "pending"
+
+  fake = fake_midtrans.create_app(latency=args.latency)
+  midtrans.gateway = midtrans.MidtransClient(transport=httpx.ASGITransport(app=fake))
+  async with httpx.AsyncClient(transport=httpx.ASGITransport(app=fake), base_url="http://fake") as helper:
+    for payment_id, status in expected.items():
+      order_id = f"PAY-{payment_id}"
+      await midtrans.gateway.create_snap_transaction({"transaction_details": {"order_id": order_id, "gross_amount": 150000}})
+      if status == "paid":
+        await helper.post(f"/fake/{order_id}/settle")
+      elif status == "failed":
+        await helper.post(f"/fake/{order_id}/expire")
+
+  try:
+    result = await reconciliation.reconcile_branch("central", concurrency=args.concurrency, rate=args.rate)
+  finally:
+    await midtrans.gateway.aclose()
+    for engine in async_engines.values():
+      await engine.dispose()
+
+  db = Sessions["central"]()
+  actual = dict(db.query(models.Payment.id, models.Payment.status).filter(models.Payment.id.in_(payment_ids)).all())
+  db.close()
+  mismatches = sorted(payment_id for payment_id, status in expected.items() if actual.get(payment_id) != status)
+  counts = {status: sum(1 for value in expected.values() if value == status) for status in ("paid", "failed", "pending")}
+  print(json.dumps({
+    "payments": len(payment_ids),
+    "expected": counts,
+    "result": result,
+    "stats": reconciliation.stats.snapshot(),
+    "mismatches": len(mismatches),
+    "mismatch_sample": mismatches[:10],
+  }, indent=2))
+  return 1 if mismatches else 0
+
+if __name__ == "__main__":
+  parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+  parser.add_argument("--payments", type=int, default=1000)
+  parser.add_argument("--settled", type=float, default=0.4, help="fraction of orders settled without a webhook")
+  parser.add_argument("--expired", type=float, default=0.3, help="fraction of orders that expire unpaid (status_code 407)")
+  parser.add_argument("--concurrency", type=int, default=20)
+  parser.add_argument("--rate", type=float, default=10000, help="gateway calls per second")
+  parser.add_argument("--latency", type=float, default=0.0, help="seconds the fake Midtrans waits per call")
+  parser.add_argument("--seed", type=int, default=7)
+  sys.exit(asyncio.run(run(parser.parse_args())))
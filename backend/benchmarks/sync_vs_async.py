@@ -0,0 +1,97 @@
+"""Compare throughput of the sync and async database paths.
+
+Runs list and create requests against two in-process FastAPI apps that differ
+only in using crud/get_db (threadpool) or async_crud/get_async_db (event
+loop). Point DATABASE_URL_CENTRAL at a local Postgres for meaningful numbers;
+without it a temporary SQLite file is used.
+
+    python benchmarks/sync_vs_async.py --requests 2000 --concurrency 100
+"""
+import argparse
+import asyncio
+import json
+import os
+import statistics
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault("MIDTRANS_SERVER_KEY", "SB-Mid-server-benchmark")
+os.environ.setdefault("MIDTRANS_CLIENT_KEY", "SB-Mid-client-benchmark")
+os.environ.setdefault("SECRET_KEY", "benchmark-secret")
+if "DATABASE_URL_CENTRAL" not in os.environ:
+  os.environ["DATABASE_URL_CENTRAL"] = f"sqlite:///{tempfile.mkdtemp()}/central.db"
+
+import httpx
+from fastapi import Depends, FastAPI
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.orm import Session
+
+import async_crud, crud, schemas
+from database import Base, async_engines, engines, get_async_db, get_db
+
+def build_app() -> FastAPI:
+  app = FastAPI()
+
+  @app.get("/sync/patients")
+  def sync_list(db: Session = Depends(get_db)):
+    return crud.get_patients(db, limit=50)[0]
+
+  @app.post("/sync/patients", response_model=schemas.PatientOut)
+  def sync_create(patient: schemas.PatientCreate, db: Session = Depends(get_db)):
+    return crud.create_patient(db, patient)
+
+  @app.get("/async/patients")
+  async def async_list(db: AsyncSession = Depends(get_async_db)):
+    return (await async_crud.get_patients(db, limit=50))[0]
+
+  @app.post("/async/patients", response_model=schemas.PatientOut)
+  async def async_create(patient: schemas.PatientCreate, db: AsyncSession = Depends(get_async_db)):
+    return await async_crud.create_patient(db, patient)
+
+  return app
+
+async def run(client, method: str, url: str, total: int, concurrency: int) -> dict:
+  latencies = []
+  queue = asyncio.Queue()
+  for i in range(total):
+    queue.put_nowait(i)
+  body = {"name": "Bench Patient", "national_id": "3171000000000000", "phone": "0800", "address": "Jl. Benchmark"}
+
+  async def worker():
+    while not queue.empty():
+      queue.get_nowait()
+      start = time.perf_counter()
+      response = await client.request(method, url, json=body if method == "POST" else None)
+      response.raise_for_status()
+      latencies.append(time.perf_counter() - start)
+
+  start = time.perf_counter()
+  await asyncio.gather(*(worker() for _ in range(concurrency)))
+  elapsed = time.perf_counter() - start
+  latencies.sort()
+  return {
+    "requests": total,
+    "seconds": round(elapsed, 3),
+    "rps": round(total / elapsed, 1),
+    "p50_ms": round(statistics.median(latencies) * 1000, 2),
+    "p95_ms": round(latencies[int(len(latencies) * 0.95) - 1] * 1000, 2),
+  }
+
+async def main(args):
+  Base.metadata.create_all(bind=engines["central"])
+  transport = httpx.ASGITransport(app=build_app())
+  results = {}
+  async with httpx.AsyncClient(transport=transport, base_url="http://bench") as client:
+    for path in ("sync", "async"):
+      results[f"{path}_create"] = await run(client, "POST", f"/{path}/patients", args.requests, args.concurrency)
+      results[f"{path}_list"] = await run(client, "GET", f"/{path}/patients", args.requests, args.concurrency)
+  await async_engines["central"].dispose()
+  print(json.dumps(results, indent=2))
+
+if __name__ == "__main__":
+  parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+  parser.add_argument("--requests", type=int, default=1000)
+  parser.add_argument("--concurrency", type=int, default=50)
+  asyncio.run(main(parser.parse_args()))
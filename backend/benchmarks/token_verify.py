@@ -0,0 +1,74 @@
+"""Per-request cost of access token verification.
+
+Times tokens.TokenService.decode for each algorithm, with the verified-token
+cache cold (every call checks the signature, as for a client's first request)
+and warm (repeat requests with the same token), next to the python-jose
+decode the API used before. No database is involved.
+
+    python benchmarks/token_verify.py --iterations 20000
+"""
+import argparse
+import json
+import os
+import sys
+import tempfile
+import time
+from datetime import timedelta
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault("MIDTRANS_SERVER_KEY", "SB-Mid-server-benchmark")
+os.environ.setdefault("MIDTRANS_CLIENT_KEY", "SB-Mid-client-benchmark")
+os.environ.setdefault("SECRET_KEY", "benchmark-secret")
+
+import config
+from tokens import Key, Keyset, TokenService, write_keyset
+
+CLAIMS = {"sub": "dr.benchmark", "uid": 42, "role": "doctor", "branch": "central"}
+
+def per_call_us(fn, iterations: int) -> float:
+  start = time.perf_counter()
+  for _ in range(iterations):
+    fn()
+  return round((time.perf_counter() - start) / iterations * 1e6, 2)
+
+def keys_file(alg: str, directory: str) -> str | None:
+  """None for the SECRET_KEY (HMAC) setup, else a one-key keyset file."""
+  if alg.startswith("HS"):
+    return None
+  path = os.path.join(directory, f"{alg}.json")
+  write_keyset(path, Keyset({"bench": Key.generate("bench", alg)}, "bench"))
+  return path
+
+def token_for(tokens: TokenService) -> str:
+  exp = int(time.time() + timedelta(minutes=30).total_seconds())
+  return tokens.encode({**CLAIMS, "exp": exp})
+
+def main(args):
+  results = {}
+  directory = tempfile.mkdtemp()
+  for alg in (config.ALGORITHM, "EdDSA", "RS256"):
+    path = keys_file(alg, directory)
+    cold = TokenService(path, 3600, 0)
+    warm = TokenService(path, 3600, 10000)
+    token = token_for(cold)
+    warm.decode(token)
+    results[alg] = {
+      "uncached_us": per_call_us(lambda: cold.decode(token), args.iterations),
+      "cached_us": per_call_us(lambda: warm.decode(token), args.iterations),
+      "token_bytes": len(token),
+    }
+  try:
+    from jose import jwt
+  except ImportError:
+    pass
+  else:
+    token = jwt.encode({**CLAIMS, "exp": int(time.time()) + 1800}, config.SECRET_KEY, algorithm=config.ALGORITHM)
+    results[f"python-jose {config.ALGORITHM}"] = {
+      "uncached_us": per_call_us(lambda: jwt.decode(token, config.SECRET_KEY, algorithms=[config.ALGORITHM]), args.iterations),
+    }
+  print(json.dumps({"iterations": args.iterations, "results": results}, indent=2))
+
+if __name__ == "__main__":
+  parser = argparse.ArgumentParser(description="Benchmark access token verification")
+  parser.add_argument("--iterations", type=int, default=20000)
+  main(parser.parse_args())
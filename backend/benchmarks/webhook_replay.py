@@ -0,0 +1,134 @@
+"""Replay Midtrans notifications through the webhook queue and measure throughput.
+
+Acts as a local Midtrans stand-in: seeds payments, then sends signed
+notifications (including retries and out-of-order 'pending' after
+'settlement') to POST /payments/notification of the real app and drains the
+queue with payment_queue.drain. Ingest and apply are timed as separate phases
+(SQLite allows one writer at a time, so there it also sends serially).
+Recorded notifications can be replayed with --input (one JSON object per
+line); they are re-signed with the local server key.
+
+    python benchmarks/webhook_replay.py --payments 2000 --retries 2 --concurrency 50
+"""
+import argparse
+import asyncio
+import json
+import os
+import random
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault("MIDTRANS_SERVER_KEY", "SB-Mid-server-benchmark")
+os.environ.setdefault("MIDTRANS_CLIENT_KEY", "SB-Mid-client-benchmark")
+os.environ.setdefault("SECRET_KEY", "benchmark-secret")
+os.environ.setdefault("PASSWORD_HASH_WORKERS", "0")
+os.environ["WEBHOOK_CONSUMER_ENABLED"] = "false"
+if "DATABASE_URL_CENTRAL" not in os.environ:
+  _tmp = tempfile.mkdtemp()
+  for _branch in ("central", "branch_a", "branch_b"):
+    os.environ[f"DATABASE_URL_{_branch.upper()}"] = f"sqlite:///{_tmp}/{_branch}.db"
+
+import httpx
+
+import main, midtrans, models, payment_queue
+from database import Sessions, async_engines
+
+def seed_payments(count: int) -> list[str]:
+  db = Sessions["central"]()
+  transaction_ids = [f"bench-{i}" for i in range(count)]
+  db.add_all(
+    models.Payment(appointment_id=None, amount=150000, payment_method="bank_transfer", status="pending", transaction_id=tid)
+    for tid in transaction_ids
+  )
+  db.commit()
+  db.close()
+  return transaction_ids
+
+def notification(transaction_id: str, transaction_status: str) -> dict:
+  body = {
+    "order_id": transaction_id,
+    "transaction_id": transaction_id,
+    "transaction_status": transaction_status,
+    "fraud_status": "accept",
+    "status_code": "200",
+    "gross_amount": "150000.00",
+  }
+  return sign(body)
+
+def sign(body: dict) -> dict:
+  body["signature_key"] = midtrans.signature(body.get("order_id"), body.get("status_code"), body.get("gross_amount"))
+  return body
+
+def synthetic(transaction_ids: list[str], retries: int) -> list[dict]:
+  notifications = []
+  for tid in transaction_ids:
+    for status in ("pending", "settlement", "pending"):
+      notifications.extend(notification(tid, status) for _ in range(1 + retries))
+  random.shuffle(notifications)
+  return notifications
+
+async def send_all(client, notifications: list[dict], concurrency: int) -> float:
+  queue = asyncio.Queue()
+  for body in notifications:
+    queue.put_nowait(body)
+
+  async def worker():
+    while not queue.empty():
+      response = await client.post("/payments/notification", json=queue.get_nowait())
+      response.raise_for_status()
+
+  start = time.perf_counter()
+  await asyncio.gather(*(worker() for _ in range(concurrency)))
+  return time.perf_counter() - start
+
+async def run(args):
+  if args.input:
+    with open(args.input) as f:
+      notifications = [sign(json.loads(line)) for line in f if line.strip()]
+    transaction_ids = sorted({n["transaction_id"] for n in notifications})
+    seed_payments(0)
+  else:
+    transaction_ids = seed_payments(args.payments)
+    notifications = synthetic(transaction_ids, args.retries)
+
+  concurrency = args.concurrency
+  if async_engines["central"].dialect.name == "sqlite":
+    # concurrent aiosqlite writers fail with "database is locked"
+    concurrency = 1
+  transport = httpx.ASGITransport(app=main.app)
+  try:
+    async with httpx.AsyncClient(transport=transport, base_url="http://bench") as client:
+      ingest_seconds = await send_all(client, notifications, concurrency)
+  finally:
+    for engine in async_engines.values():
+      await engine.dispose()
+
+  drain_start = time.perf_counter()
+  applied_rows = payment_queue.drain("central")
+  drain_seconds = time.perf_counter() - drain_start
+
+  db = Sessions["central"]()
+  paid = db.query(models.Payment).filter(models.Payment.transaction_id.in_(transaction_ids), models.Payment.status == "paid").count()
+  db.close()
+  print(json.dumps({
+    "notifications": len(notifications),
+    "concurrency": concurrency,
+    "ingest_seconds": round(ingest_seconds, 3),
+    "ingest_per_second": round(len(notifications) / ingest_seconds, 1),
+    "queued": applied_rows,
+    "drain_seconds": round(drain_seconds, 3),
+    "drain_per_second": round(applied_rows / drain_seconds, 1) if drain_seconds else None,
+    "payments": len(transaction_ids),
+    "payments_paid": paid,
+    "queue": payment_queue.stats.snapshot(),
+  }, indent=2))
+
+if __name__ == "__main__":
+  parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+  parser.add_argument("--payments", type=int, default=1000)
+  parser.add_argument("--retries", type=int, default=1, help="extra deliveries of each notification")
+  parser.add_argument("--concurrency", type=int, default=50)
+  parser.add_argument("--input", help="NDJSON file of recorded notifications to replay")
+  asyncio.run(run(parser.parse_args()))
@@ -1,14 +1,17 @@
-from sqlalchemy.orm import Session
+from sqlalchemy.orm import Session, selectinload
 import models,schemas
-from passlib.context import CryptContext
-
-pwd_context = CryptContext(schemes=["argon2"], deprecated="auto")
+from pagination import DEFAULT_PAGE_SIZE, paginate, iterate, timeline_cursor
+from principals import principal_cache
+import passwords, patient_index, patient_search, scheduling, midtrans, response_cache, refresh_tokens, user_directory
+from datetime import datetime
+from decimal import Decimal
+from sqlalchemy import func, insert, select, tuple_, update
 
 def hash_password(password: str) -> str:
-  return pwd_context.hash(password)
+  return passwords.hash_password(password)
 
 def verify_password(plain_password: str, hashed_password: str) -> bool:
-  return pwd_context.verify(plain_password, hashed_password)
+  return passwords.verify_and_update(plain_password, hashed_password)[0]
 
 def create_user(db:Session, user:schemas.UserCreate):
   hashed_pw = hash_password(user.password)
@@ -16,24 +19,34 @@ def create_user(db:Session, user:schemas.UserCreate):
   db.add(db_user)
   db.commit()
   db.refresh(db_user)
+  user_directory.on_user_saved(db, db_user)
+  response_cache.invalidate("users")
   return db_user
 
 def get_user(db: Session, username: str):
   return db.query(models.User).filter(models.User.username == username).first()
 
-def get_all_users(db: Session, role: str | None = None):
+def _users_query(db: Session, role: str | None = None):
     query = db.query(models.User)
     if role:
         query = query.filter(models.User.role == role)
-    return query.all()
+    return query
+
+def get_all_users(db: Session, role: str | None = None, limit: int | None = None, after: int | None = None):
+    return paginate(_users_query(db, role), models.User.id, limit, after)
+
+def iter_users(db: Session, role: str | None = None, after: int | None = None, limit: int | None = None):
+    return iterate(_users_query(db, role), models.User.id, after, limit)
 
 def update_user(db: Session, user_id: int, user_data: schemas.UserUpdate):
     user = db.query(models.User).filter(models.User.id == user_id).first()
     if not user:
         return None
+    old_username = user.username
 
     if user_data.password is not None and user_data.password.strip() != "":
         user.password_hash = hash_password(user_data.password)
+        refresh_tokens.revoke_user(db, user.id)
 
     if user_data.username is not None:
         user.username = user_data.username
@@ -46,6 +59,9 @@ def update_user(db: Session, user_id: int, user_data: schemas.UserUpdate):
 
     db.commit()
     db.refresh(user)
+    principal_cache.invalidate(old_username, user.username)
+    user_directory.on_user_saved(db, user, old_username)
+    response_cache.invalidate("users")
     return user
 
 def delete_user(db: Session, user_id: int):
@@ -54,8 +70,13 @@ def delete_user(db: Session, user_id: int):
     if not user:
         return None
 
+    username = user.username
+    db.query(models.RefreshToken).filter(models.RefreshToken.user_id == user.id).delete(synchronize_session=False)
     db.delete(user)
     db.commit()
+    principal_cache.invalidate(username)
+    user_directory.on_user_deleted(db, username)
+    response_cache.invalidate("users")
 
     return user
 
@@ -64,10 +85,16 @@ def create_patient(db: Session, patient: schemas.PatientCreate):
   db.add(db_patient)
   db.commit()
   db.refresh(db_patient)
+  patient_search.on_patient_saved(db, db_patient)
+  patient_index.on_patient_saved(db, db_patient)
+  response_cache.invalidate("patients")
   return db_patient
 
-def get_patients(db: Session):
-  return db.query(models.Patient).all()
+def get_patients(db: Session, limit: int | None = None, after: int | None = None):
+  return paginate(db.query(models.Patient), models.Patient.id, limit, after)
+
+def iter_patients(db: Session, after: int | None = None, limit: int | None = None):
+  return iterate(db.query(models.Patient), models.Patient.id, after, limit)
 
 def get_patient_by_id(db: Session, patient_id: int):
   return db.query(models.Patient).filter(models.Patient.id == patient_id).first()
@@ -77,36 +104,55 @@ def update_patient(db: Session, db_patient: models.Patient, update_data: schemas
     setattr(db_patient, key, value)
   db.commit()
   db.refresh(db_patient)
+  patient_search.on_patient_saved(db, db_patient)
+  patient_index.on_patient_saved(db, db_patient)
+  response_cache.invalidate("patients")
   return db_patient
 
 def delete_patient(db: Session, db_patient: models.Patient):
+  patient_id = db_patient.id
   db.delete(db_patient)
   db.commit()
+  patient_search.on_patient_deleted(db, patient_id)
+  patient_index.on_patient_deleted(db, patient_id)
+  response_cache.invalidate("patients")
 
 # Appointment
 def create_appointment(db: Session, appointment: schemas.AppointmentCreate):
-  db_appt = models.Appointment(**appointment.dict())
+  data = appointment.dict()
+  data['scheduled_at'] = scheduling.normalize(data['scheduled_at'])
+  scheduling.ensure_free(db, data['doctor_id'], data['scheduled_at'], data['duration_minutes'])
+  db_appt = models.Appointment(**data)
   db.add(db_appt)
   db.commit()
   db.refresh(db_appt)
+  response_cache.invalidate("appointments")
   return db_appt
 
-def get_appointments(db: Session):
-  return db.query(models.Appointment).all()
+def get_appointments(db: Session, limit: int | None = None, after: int | None = None):
+  return paginate(db.query(models.Appointment), models.Appointment.id, limit, after)
+
+def iter_appointments(db: Session, after: int | None = None, limit: int | None = None):
+  return iterate(db.query(models.Appointment), models.Appointment.id, after, limit)
 
 def get_appointment_by_id(db: Session, appointment_id : int):
   return db.query(models.Appointment).filter(models.Appointment.id == appointment_id).first()
 
 def update_appointment(db: Session, db_appointment: models.Appointment, updated_data: schemas.AppointmentCreate):
-  for key, value in updated_data.dict().items():
+  data = updated_data.dict()
+  data['scheduled_at'] = scheduling.normalize(data['scheduled_at'])
+  scheduling.ensure_free(db, data['doctor_id'], data['scheduled_at'], data['duration_minutes'], exclude_id=db_appointment.id)
+  for key, value in data.items():
     setattr(db_appointment,key,value)
   db.commit()
   db.refresh(db_appointment)
+  response_cache.invalidate("appointments")
   return db_appointment
 
 def delete_appointment(db: Session, db_appointment: models.Appointment):
   db.delete(db_appointment)
   db.commit()
+  response_cache.invalidate("appointments")
 
 def create_medical_record(db: Session, record: schemas.MedicalRecordCreate):
   db_record = models.MedicalRecord(**record.dict())
@@ -118,6 +164,46 @@ def create_medical_record(db: Session, record: schemas.MedicalRecordCreate):
 def get_medical_records_by_patient(db: Session, patient_id: int):
   return db.query(models.MedicalRecord).filter(models.MedicalRecord.patient_id == patient_id).all()
 
+# timeline rows without the free-text columns
+MEDICAL_RECORD_SUMMARY = (
+  models.MedicalRecord.id,
+  models.MedicalRecord.appointment_id,
+  models.MedicalRecord.patient_id,
+  models.MedicalRecord.doctor_id,
+  models.MedicalRecord.created_at,
+)
+
+def get_medical_record_timeline(
+  db: Session,
+  patient_id: int,
+  limit: int | None = None,
+  before: tuple[datetime, int] | None = None,
+  start: datetime | None = None,
+  end: datetime | None = None,
+  full: bool = False,
+):
+  """One page of a patient's records, newest first; returns (rows, next_cursor).
+
+  Rows are summary tuples unless full is set, in which case they are
+  MedicalRecord objects with diagnosis, treatment and notes.
+  """
+  limit = limit or DEFAULT_PAGE_SIZE
+  record = models.MedicalRecord
+  query = db.query(record) if full else db.query(*MEDICAL_RECORD_SUMMARY)
+  query = query.filter(record.patient_id == patient_id)
+  if start is not None:
+    query = query.filter(record.created_at >= start)
+  if end is not None:
+    query = query.filter(record.created_at < end)
+  if before is not None:
+    query = query.filter(tuple_(record.created_at, record.id) < tuple_(*before))
+  rows = query.order_by(record.created_at.desc(), record.id.desc()).limit(limit + 1).all()
+  next_cursor = None
+  if len(rows) > limit:
+    rows = rows[:limit]
+    next_cursor = timeline_cursor(rows[-1].created_at, rows[-1].id)
+  return rows, next_cursor
+
 def create_payment(db: Session, payment: schemas.PaymentCreate):
   db_payment = models.Payment(
     appointment_id = payment.appointment_id,
@@ -131,30 +217,77 @@ def create_payment(db: Session, payment: schemas.PaymentCreate):
   return db_payment
 
 def update_payment_status(db:Session, transaction_id:str, new_status: str):
-  db_payment = db.query(models.Payment).filter(models.Payment.transaction_id == transaction_id).first()
-  if db_payment:
-    db_payment.status = new_status
-    if new_status == 'paid':
-      from datetime import datetime
-      db_payment.payment_date = datetime.now()
-    db.commit()
-    db.refresh(db_payment)
-  return db_payment
+  apply_payment_statuses(db, {transaction_id: new_status})
+  db.commit()
+  return db.query(models.Payment).filter(models.Payment.transaction_id == transaction_id).first()
+
+def payment_status_statements(updates: dict[str, str]):
+  """UPDATE ... RETURNING transaction_id statements for {transaction_id: status}, one per target status.
+
+  A row only changes when the new status ranks above its current one (see
+  midtrans.STATUS_RANK), so 'paid' is never undone.
+  """
+  by_status: dict[str, list[str]] = {}
+  for transaction_id, status in updates.items():
+    by_status.setdefault(status, []).append(transaction_id)
+  for status, transaction_ids in by_status.items():
+    lower = [s for s, rank in midtrans.STATUS_RANK.items() if rank < midtrans.status_rank(status)]
+    values = {'status': status}
+    if status == 'paid':
+      values['payment_date'] = datetime.now()
+    yield (
+      update(models.Payment)
+      .where(models.Payment.transaction_id.in_(transaction_ids))
+      .where(models.Payment.status.in_(lower) | models.Payment.status.is_(None) | models.Payment.status.notin_(list(midtrans.STATUS_RANK)))
+      .values(**values)
+      .returning(models.Payment.transaction_id)
+      .execution_options(synchronize_session=False)
+    )
+
+def apply_payment_statuses(db: Session, updates: dict[str, str]) -> set[str]:
+  """Bulk-apply {transaction_id: status}; returns the transaction ids that changed. The caller commits."""
+  changed = set()
+  for stmt in payment_status_statements(updates):
+    changed.update(db.scalars(stmt))
+  return changed
 
 def create_payment_item(db: Session, payment_id: int, item: schemas.PaymentItemCreate):
-  total = item.quantity * item.price
-  db_item = models.PaymentItem(
-    payment_id = payment_id,
-    description=item.description,
-    quantity=item.quantity,
-    price=item.price,
-    total=total
+  item_ids = add_payment_items(db, payment_id, [item])
+  return db.get(models.PaymentItem, item_ids[0]) if item_ids else None
+
+def add_payment_items(db: Session, payment_id: int, items: list[schemas.PaymentItemCreate]):
+  """Insert all items with one multi-row INSERT and recompute the payment amount, in one transaction.
+
+  Returns the new item ids, or None when the payment does not exist.
+  """
+  # row lock so concurrent additions to the same invoice recompute in turn
+  if db.scalar(select(models.Payment.id).where(models.Payment.id == payment_id).with_for_update()) is None:
+    db.rollback()
+    return None
+  rows = [
+    {
+      'payment_id': payment_id,
+      'description': item.description,
+      'quantity': item.quantity,
+      'price': item.price,
+      'total': (item.price * item.quantity).quantize(Decimal('0.01')),
+    }
+    for item in items
+  ]
+  item_ids = db.scalars(insert(models.PaymentItem).values(rows).returning(models.PaymentItem.id)).all()
+  item_total = (
+    select(func.coalesce(func.sum(models.PaymentItem.total), 0))
+    .where(models.PaymentItem.payment_id == payment_id)
+    .scalar_subquery()
   )
-  db.add(db_item)
+  db.execute(update(models.Payment).where(models.Payment.id == payment_id).values(amount=item_total))
   db.commit()
-  db.refresh(db_item)
-  return db_item
+  return item_ids
 
 def get_payment_with_items(db: Session, payment_id: int):
-  payment = db.query(models.Payment).filter(models.Payment.id == payment_id).first()
-  return payment
\ No newline at end of file
+  return db.scalar(
+    select(models.Payment)
+    .where(models.Payment.id == payment_id)
+    .options(selectinload(models.Payment.items))
+    .execution_options(populate_existing=True)
+  )
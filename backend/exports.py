@@ -0,0 +1,151 @@
+"""Streaming exports of branch tables as CSV, NDJSON or Parquet.
+
+Rows are read through a server-side cursor in STREAM_BATCH_SIZE partitions
+and encoded one partition at a time, so a worker holds about one batch in
+memory whatever the export size. Several branches are exported one after
+another into the same stream, with a leading `branch` column. Parquet needs
+the optional pyarrow package; each batch becomes a row group.
+"""
+import csv
+import io
+import json
+import logging
+from datetime import date, datetime
+from decimal import Decimal
+
+from sqlalchemy import Integer, Numeric, TIMESTAMP, select
+
+import models
+from database import AsyncSessions
+from pagination import STREAM_BATCH_SIZE
+
+logger = logging.getLogger(__name__)
+
+class Dataset:
+  def __init__(self, model, date_column=None, join=None):
+    self.model = model
+    self.columns = list(model.__table__.columns)
+    # date_column filters the export; join is needed when it lives on another table
+    self.date_column = date_column
+    self.join = join
+
+DATASETS = {
+  "patients": Dataset(models.Patient),
+  "appointments": Dataset(models.Appointment, models.Appointment.scheduled_at),
+  "medical_records": Dataset(models.MedicalRecord, models.MedicalRecord.created_at),
+  "payments": Dataset(models.Payment, models.Payment.created_date),
+  "payment_items": Dataset(models.PaymentItem, models.Payment.created_date, join=models.Payment),
+}
+
+FORMATS = {
+  "csv": ("text/csv; charset=utf-8", "csv"),
+  "ndjson": ("application/x-ndjson", "ndjson"),
+  "parquet": ("application/vnd.apache.parquet", "parquet"),
+}
+
+class ExportUnavailable(Exception):
+  """The requested format needs an optional dependency that is not installed."""
+
+def _statement(dataset: Dataset, start: datetime | None, end: datetime | None):
+  stmt = select(*dataset.columns)
+  if dataset.join is not None:
+    stmt = stmt.join(dataset.join)
+  if start is not None:
+    stmt = stmt.where(dataset.date_column >= start)
+  if end is not None:
+    stmt = stmt.where(dataset.date_column < end)
+  return stmt.order_by(dataset.model.id)
+
+async def _batches(branches: list[str], dataset: Dataset, start, end):
+  """(branch, rows) per partition, branch after branch; one session open at a time."""
+  stmt = _statement(dataset, start, end).execution_options(yield_per=STREAM_BATCH_SIZE)
+  for branch in branches:
+    async with AsyncSessions[branch]() as db:
+      result = await db.stream(stmt)
+      async for rows in result.partitions():
+        yield branch, rows
+
+def _text(value) -> str:
+  if value is None:
+    return ""
+  if isinstance(value, (datetime, date)):
+    return value.isoformat()
+  return str(value)
+
+def _json_default(value):
+  if isinstance(value, (datetime, date)):
+    return value.isoformat()
+  if isinstance(value, Decimal):
+    return str(value)
+  raise TypeError(f"{type(value).__name__} is not JSON serializable")
+
+async def _csv(batches, names: list[str]):
+  buffer = io.StringIO()
+  writer = csv.writer(buffer)
+  writer.writerow(["branch", *names])
+  async for branch, rows in batches:
+    for row in rows:
+      writer.writerow([branch, *(_text(value) for value in row)])
+    yield buffer.getvalue().encode()
+    buffer.seek(0)
+    buffer.truncate()
+  if buffer.tell():
+    yield buffer.getvalue().encode()
+
+async def _ndjson(batches, names: list[str]):
+  async for branch, rows in batches:
+    yield "".join(
+      json.dumps({"branch": branch, **dict(zip(names, row))}, default=_json_default) + "\n" for row in rows
+    ).encode()
+
+def _arrow_schema(pa, columns):
+  fields = [pa.field("branch", pa.string())]
+  for column in columns:
+    if isinstance(column.type, TIMESTAMP):
+      arrow_type = pa.timestamp("us")
+    elif isinstance(column.type, Numeric):
+      arrow_type = pa.decimal128(column.type.precision or 38, column.type.scale or 0)
+    elif isinstance(column.type, Integer):
+      arrow_type = pa.int64()
+    else:
+      arrow_type = pa.string()
+    fields.append(pa.field(column.name, arrow_type))
+  return pa.schema(fields)
+
+async def _parquet(batches, columns):
+  import pyarrow as pa
+  import pyarrow.parquet as pq
+  schema = _arrow_schema(pa, columns)
+  sink = io.BytesIO()
+  writer = pq.ParquetWriter(sink, schema)
+  try:
+    async for branch, rows in batches:
+      data = [[branch] * len(rows), *(list(values) for values in zip(*rows))]
+      writer.write_table(pa.Table.from_arrays([pa.array(values, type=field.type) for values, field in zip(data, schema)], schema=schema))
+      yield sink.getvalue()
+      sink.seek(0)
+      sink.truncate()
+  finally:
+    writer.close()
+  # the footer is written on close
+  yield sink.getvalue()
+
+def check_format(format: str):
+  if format == "parquet":
+    try:
+      import pyarrow.parquet  # noqa: F401
+    except ImportError:
+      raise ExportUnavailable("Parquet export needs the pyarrow package")
+
+def export(dataset_name: str, format: str, branches: list[str], start: datetime | None = None, end: datetime | None = None):
+  """Async iterator of encoded chunks for a StreamingResponse."""
+  dataset = DATASETS[dataset_name]
+  check_format(format)
+  logger.info("export of %s as %s from %s (%s to %s)", dataset_name, format, ",".join(branches), start, end)
+  batches = _batches(branches, dataset, start, end)
+  names = [column.name for column in dataset.columns]
+  if format == "parquet":
+    return _parquet(batches, dataset.columns)
+  if format == "ndjson":
+    return _ndjson(batches, names)
+  return _csv(batches, names)
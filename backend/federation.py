@@ -0,0 +1,129 @@
+import heapq
+import threading
+from concurrent.futures import ThreadPoolExecutor, wait
+
+from fastapi.responses import JSONResponse
+from sqlalchemy import text
+
+import config
+from database import Sessions
+from pagination import DEFAULT_PAGE_SIZE, NEXT_CURSOR_HEADER
+
+FEDERATION_ERRORS_HEADER = "X-Federation-Errors"
+
+executor = ThreadPoolExecutor(
+  max_workers=config.FEDERATION_MAX_WORKERS,
+  thread_name_prefix="federation",
+)
+
+class FederatedResult:
+  """Rows collected from each branch plus the branches that failed or timed out."""
+  def __init__(self):
+    self.rows: dict[str, list[dict]] = {}
+    self.errors: dict[str, str] = {}
+
+  @property
+  def error_header(self) -> str:
+    return ",".join(f"{branch}:{reason}" for branch, reason in sorted(self.errors.items()))
+
+# timed-out fan-out work still running, per branch; the branch is skipped until it finishes
+_abandoned: dict[str, int] = {}
+_abandoned_lock = threading.Lock()
+
+def _release(branch: str):
+  with _abandoned_lock:
+    _abandoned[branch] -= 1
+    if not _abandoned[branch]:
+      del _abandoned[branch]
+
+def _run_on_branch(branch: str, fetch, timeout: float):
+  db = Sessions[branch]()
+  try:
+    if timeout > 0 and db.get_bind().dialect.name == "postgresql":
+      # bound the work itself: a query outliving the fan-out would keep its worker and connection
+      db.execute(text("SELECT set_config('statement_timeout', :ms, true)"), {"ms": str(int(timeout * 1000))})
+    # serialize inside the worker so the session can be closed right away
+    return [dict(row, branch=branch) for row in fetch(db)]
+  finally:
+    db.close()
+
+def fan_out(branches: list[str], fetch, timeout: float | None = None) -> FederatedResult:
+  """Run fetch(db) -> iterable of dicts on every branch in parallel.
+
+  Branches that do not answer within timeout seconds are left out of the
+  result and reported in FederatedResult.errors instead of stalling the caller.
+  On Postgres the same timeout is each statement's statement_timeout. A branch
+  whose timed-out work is still running is reported as "busy" and not queried
+  again until that work ends, so a hung branch cannot fill the executor and pool.
+  """
+  timeout = config.FEDERATION_TIMEOUT_SECONDS if timeout is None else timeout
+  result = FederatedResult()
+  with _abandoned_lock:
+    busy = {branch for branch in branches if branch in _abandoned}
+  for branch in busy:
+    result.errors[branch] = "busy"
+  futures = {executor.submit(_run_on_branch, branch, fetch, timeout): branch for branch in branches if branch not in busy}
+  done, pending = wait(futures, timeout=timeout)
+  for future in pending:
+    branch = futures[future]
+    result.errors[branch] = "timeout"
+    # cancel() only stops work that has not started yet
+    if not future.cancel():
+      with _abandoned_lock:
+        _abandoned[branch] = _abandoned.get(branch, 0) + 1
+      future.add_done_callback(lambda _, branch=branch: _release(branch))
+  for future in done:
+    branch = futures[future]
+    try:
+      result.rows[branch] = future.result()
+    except Exception:
+      result.errors[branch] = "error"
+  return result
+
+def merge(result: FederatedResult, key, limit: int | None = None):
+  """k-way merge of per-branch sorted rows; returns (rows, next_cursor).
+
+  Each branch must already be sorted by key. Rows sharing the last key of a
+  page are kept together so a cursor on key never skips a branch's row.
+  """
+  branch_order = {branch: i for i, branch in enumerate(Sessions)}
+  merged = heapq.merge(
+    *result.rows.values(),
+    key=lambda row: (key(row), branch_order[row["branch"]]),
+  )
+  if limit is None:
+    return list(merged), None
+  rows = []
+  next_cursor = None
+  for row in merged:
+    if len(rows) >= limit and key(row) != key(rows[-1]):
+      next_cursor = key(rows[-1])
+      break
+    rows.append(row)
+  return rows, next_cursor
+
+def json_response(rows: list[dict], result: FederatedResult, next_cursor=None) -> JSONResponse:
+  response = JSONResponse(content=rows)
+  if next_cursor is not None:
+    response.headers[NEXT_CURSOR_HEADER] = str(next_cursor)
+  if result.errors:
+    response.headers[FEDERATION_ERRORS_HEADER] = result.error_header
+  return response
+
+def list_keyset(branches: list[str], model, schema, limit: int | None = None, after: int | None = None):
+  """Keyset page of model rows ordered by id across branches."""
+  page_size = limit or DEFAULT_PAGE_SIZE
+
+  def fetch(db):
+    query = db.query(model)
+    if after is not None:
+      query = query.filter(model.id > after)
+    # each branch contributes at most one row per id, so limit + 1 is enough
+    rows = query.order_by(model.id).limit(page_size + 1).all()
+    return [schema.model_validate(row).model_dump(mode="json") for row in rows]
+
+  result = fan_out(branches, fetch)
+  rows, next_cursor = merge(result, key=lambda row: row["id"], limit=page_size)
+  if next_cursor is None and rows and any(len(branch_rows) > page_size for branch_rows in result.rows.values()):
+    next_cursor = rows[-1]["id"]
+  return json_response(rows, result, next_cursor)
@@ -1,13 +1,15 @@
-from fastapi import FastAPI, Depends , Query , HTTPException, status
+from fastapi import FastAPI, Depends , Query , HTTPException, Request, status
 from datetime import timedelta
-from sqlalchemy.orm import Session
-import models, schemas, crud, database, config
-from database import Base, engines, Sessions, get_db
+import models, schemas, async_crud, database, config, passwords, migrations, midtrans, payment_queue, reconciliation, querycount, metrics, refresh_tokens, user_directory
+from database import engines, Sessions
 from auth import create_access_token, get_current_user, require_role, verify_token
-from passlib.hash import argon2
+from principals import principal_cache
+from tokens import tokens
+from response_cache import response_cache
 from fastapi.openapi.utils import get_openapi
-from routers import patient, user, appointment, medical_record, payment
+from routers import patient, user, appointment, medical_record, payment, export
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import JSONResponse, PlainTextResponse
 
 app = FastAPI(title="Clinic API")
 
@@ -17,7 +19,11 @@ app.add_middleware(
     allow_credentials=True,
     allow_methods=["*"],
     allow_headers=["*"],
+    expose_headers=["X-Next-Cursor", "X-Federation-Errors", "Server-Timing", "ETag", "Content-Disposition", querycount.QUERY_COUNT_HEADER],
 )
+app.add_middleware(querycount.QueryCountMiddleware)
+# outermost, so the latency includes the other middleware
+app.add_middleware(metrics.MetricsMiddleware)
 
 # for routing
 app.include_router(patient.router)
@@ -25,9 +31,9 @@ app.include_router(user.router)
 app.include_router(appointment.router)
 app.include_router(medical_record.router)
 app.include_router(payment.router)
+app.include_router(export.router)
 
-for engine in engines.values():
-  Base.metadata.create_all(bind=engine)
+migrations.upgrade_all()
 
 def custom_openapi():
   if app.openapi_schema:
@@ -53,36 +59,182 @@ def custom_openapi():
 
 app.openapi = custom_openapi
 
-@app.post("/login/")
-def login(
-   user: schemas.UserLogin, db: Session = Depends(get_db)
-   ):
-  db_user = crud.get_user(db, user.username)
-  if not db_user or not crud.verify_password(user.password, db_user.password_hash):
-      raise HTTPException(status_code=401, detail="Invalid username or password")
+@app.exception_handler(passwords.HashingBusy)
+def hashing_busy_handler(request: Request, exc: passwords.HashingBusy):
+  return JSONResponse(
+     status_code=status.HTTP_429_TOO_MANY_REQUESTS,
+     content={"detail": "Too many login attempts in progress, please retry shortly"},
+     headers={"Retry-After": "1"},
+  )
+
+@app.exception_handler(midtrans.GatewayUnavailable)
+def gateway_unavailable_handler(request: Request, exc: midtrans.GatewayUnavailable):
+  return JSONResponse(
+     status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+     content={"detail": "Payment gateway is unavailable, please retry shortly"},
+     headers={"Retry-After": str(max(1, round(exc.retry_after)))},
+  )
+
+@app.on_event("startup")
+async def start_payment_workers():
+  payment_queue.start_consumer()
+  reconciliation.start_worker()
+
+@app.on_event("shutdown")
+async def shutdown_workers():
+  payment_queue.stop_consumer()
+  await reconciliation.stop_worker()
+  passwords.shutdown()
+  await midtrans.gateway.aclose()
+
+LOGINS = metrics.Counter("login_attempts_total", "Logins by outcome (success, invalid).", ("outcome",))
+REFRESHES = metrics.Counter("token_refresh_total", "Refresh token exchanges by outcome (ok, invalid, expired, revoked).", ("outcome",))
+BREAKER_STATES = {"closed": 0, "half-open": 1, "open": 2}
+
+@metrics.collector
+def runtime_metrics():
+  pools = {name: database.pool_status(name) for name in engines}
+  yield "db_pool_size", "gauge", "Configured pool size per branch.", [({"branch": b}, p["size"]) for b, p in pools.items()]
+  yield "db_pool_checked_out", "gauge", "Connections in use per branch.", [({"branch": b}, p["checked_out"]) for b, p in pools.items()]
+  yield "db_pool_overflow", "gauge", "Overflow connections open per branch.", [({"branch": b}, p["overflow"]) for b, p in pools.items()]
+  yield "db_pool_saturation", "gauge", "Checked out / (size + max_overflow).", [({"branch": b}, p["saturation"]) for b, p in pools.items()]
+  yield "db_pool_checkouts_total", "counter", "Pool checkouts per branch.", [({"branch": b}, p["checkouts"]) for b, p in pools.items()]
+  yield "db_pool_timeouts_total", "counter", "Pool checkouts that timed out.", [({"branch": b}, p["timeouts"]) for b, p in pools.items()]
+  yield "db_pool_wait_seconds_total", "counter", "Time spent waiting for a pooled connection.", [({"branch": b}, p["wait_seconds_total"]) for b, p in pools.items()]
+  try:
+    depths = payment_queue.depth()
+  except Exception:
+    depths = {}
+  yield "webhook_queue_depth", "gauge", "Unprocessed payment notifications per branch.", [({"branch": b}, d) for b, d in depths.items()]
+  queue = payment_queue.stats.snapshot()
+  yield "webhook_notifications_total", "counter", "Payment notifications by stage.", [
+    ({"stage": stage}, queue[stage]) for stage in ("received", "duplicates", "processed", "applied", "errors")
+  ]
+  yield "midtrans_breaker_state", "gauge", "Midtrans circuit breaker (0 closed, 1 half-open, 2 open).", [({}, BREAKER_STATES[midtrans.gateway.breaker.state])]
+
+@app.get("/metrics", include_in_schema=False)
+def metrics_endpoint():
+  return PlainTextResponse(metrics.render(), media_type="text/plain; version=0.0.4")
+
+def _token_response(db_user, branch: str, refresh_token: str) -> dict:
   access_token_expires = timedelta(minutes=config.ACCESS_TOKEN_EXPIRE_MINUTES)
-  access_token = create_access_token(data={'sub': db_user.username,'role': db_user.role,'branch': db_user.branch},expires_delta=access_token_expires)
+  # 'branch' is the database that holds the account; later requests are routed there
+  access_token = create_access_token(data={'sub': db_user.username,'uid': db_user.id,'role': db_user.role,'branch': branch},expires_delta=access_token_expires)
   return {
      "access_token": access_token, 
+     "refresh_token": refresh_token,
      "token_type": "bearer",
+     "expires_in": int(access_token_expires.total_seconds()),
      "message": f"Welcome {db_user.username}", 
      "role": db_user.role, 
      "branch": db_user.branch
      }
 
+@app.post("/login/")
+async def login(
+   user: schemas.UserLogin, branch: str | None = Query(None, description="Branch tempat akun terdaftar; default dicari di direktori user")
+   ):
+  # never routed by a bearer token: one left over from another account must not pick the database
+  if branch is not None:
+    home = database.resolve_branch(branch)
+  else:
+    entry = await user_directory.lookup(user.username)
+    home = entry.branch if entry is not None and entry.branch in database.Sessions else config.USER_DIRECTORY_BRANCH
+  database.BRANCH_REQUESTS.labels(home, "query" if branch is not None else "directory").inc()
+  async with database.AsyncSessions[home]() as db:
+    db_user = await async_crud.authenticate_user(db, user.username, user.password)
+    if db_user:
+      refresh_token = await refresh_tokens.issue(db, home, db_user.id)
+      await db.commit()
+  if not db_user:
+      LOGINS.labels("invalid").inc()
+      raise HTTPException(status_code=401, detail="Invalid username or password")
+  LOGINS.labels("success").inc()
+  if branch is not None and await user_directory.lookup(user.username, home) is None:
+    # created before the directory existed, or its replicas were down at the time
+    await user_directory.register(db_user, home)
+  return _token_response(db_user, home, refresh_token)
+
+@app.post("/token/refresh")
+async def refresh_access_token(body: schemas.TokenRefresh):
+  """New access token (and rotated refresh token) without a password login."""
+  try:
+    db_user, branch, refresh_token = await refresh_tokens.rotate(body.refresh_token)
+  except refresh_tokens.InvalidRefreshToken as e:
+    REFRESHES.labels(e.reason).inc()
+    raise HTTPException(
+      status_code=status.HTTP_401_UNAUTHORIZED,
+      detail="Invalid refresh token",
+      headers={"WWW-Authenticate": "Bearer"},
+    )
+  REFRESHES.labels("ok").inc()
+  database.BRANCH_REQUESTS.labels(branch, "token").inc()
+  return _token_response(db_user, branch, refresh_token)
+
+@app.post("/logout", status_code=status.HTTP_204_NO_CONTENT)
+async def logout(body: schemas.TokenRefresh):
+  """Revoke the refresh token (and every token rotated from the same login)."""
+  try:
+    await refresh_tokens.revoke(body.refresh_token)
+  except refresh_tokens.InvalidRefreshToken:
+    pass
+
+@app.get('/.well-known/jwks.json', include_in_schema=False)
+def jwks():
+   """Public keys that verify our access tokens (EdDSA/RS256 keysets only)."""
+   return tokens.jwks()
+
 @app.get('/admin/dashboard')
-def admin_dashboard(current_user = Depends(require_role(['admin']))):
+def admin_dashboard(current_user = Depends(require_role(['admin'], claims_only=True))):
    return {'message': f'Hello Admin {current_user.username}'}
 
+@app.get('/admin/principal-cache')
+def principal_cache_stats(current_user = Depends(require_role(['admin']))):
+   return principal_cache.stats()
+
+@app.get('/admin/tokens')
+def token_stats(current_user = Depends(require_role(['admin']))):
+   return tokens.stats()
+
+@app.get('/admin/response-cache')
+def response_cache_stats(current_user = Depends(require_role(['admin']))):
+   return response_cache.stats()
+
+@app.delete('/admin/response-cache', status_code=status.HTTP_204_NO_CONTENT)
+def clear_response_cache(current_user = Depends(require_role(['admin']))):
+   response_cache.backend.clear()
+
+@app.get('/admin/sql-instrumentation')
+def sql_instrumentation_settings(current_user = Depends(require_role(['admin']))):
+   return {**querycount.settings.snapshot(), "slow_queries": list(querycount.slow_queries)}
+
+@app.put('/admin/sql-instrumentation')
+def update_sql_instrumentation(
+   enabled: bool | None = None,
+   slow_query_ms: float | None = Query(None, ge=0),
+   log_requests: bool | None = None,
+   current_user = Depends(require_role(['admin']))
+):
+   return querycount.configure(enabled=enabled, slow_query_ms=slow_query_ms, log_requests=log_requests)
+
+@app.get('/health/db')
+def db_health():
+   branches = {name: {**database.ping(name), "pool": database.pool_status(name)} for name in engines}
+   healthy = all(branch["ok"] for branch in branches.values())
+   return JSONResponse(
+      status_code=status.HTTP_200_OK if healthy else status.HTTP_503_SERVICE_UNAVAILABLE,
+      content={"status": "ok" if healthy else "degraded", "branches": branches},
+   )
+
 @app.get('/doctor/dashboard')
-def doctor_dashboard(current_user = Depends(require_role(['doctor']))):
+def doctor_dashboard(current_user = Depends(require_role(['doctor'], claims_only=True))):
    return {'message': f'Hello Doctor {current_user.username}'}
 
 @app.get('/staff/dashboard')
-def staff_dashboard(current_user = Depends(require_role(['staff']))):
+def staff_dashboard(current_user = Depends(require_role(['staff'], claims_only=True))):
    return {'message': f'Hello Staff {current_user.username}'}
 
 @app.get('/patient/dashboard')
-def patient_dashboard(current_user = Depends(require_role(['patient']))):
+def patient_dashboard(current_user = Depends(require_role(['patient'], claims_only=True))):
    return {'message': f'Hello Patient {current_user.username}'}
 
@@ -0,0 +1,194 @@
+import bisect
+import threading
+import time
+
+# Prometheus text-format metrics without a client library. Metrics register
+# themselves in REGISTRY; GET /metrics renders REGISTRY plus the collectors
+# (callbacks that read live values such as pool usage at scrape time).
+# MetricsMiddleware times every request against its route template. The
+# per-route children are cached in nested dicts keyed by template, method and
+# status, so a request to a known route only does dict lookups.
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+UNMATCHED_ROUTE = "<unmatched>"
+
+REGISTRY = []
+_collectors = []
+
+def _escape(value) -> str:
+  return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+def _labels(names, values, extra: str = "") -> str:
+  pairs = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+  if extra:
+    pairs.append(extra)
+  return "{" + ",".join(pairs) + "}" if pairs else ""
+
+def _number(value) -> str:
+  if value == float("inf"):
+    return "+Inf"
+  return repr(float(value)) if isinstance(value, float) else str(value)
+
+class _Metric:
+  kind = None
+
+  def __init__(self, name: str, documentation: str, labelnames: tuple = ()):
+    self.name = name
+    self.documentation = documentation
+    self.labelnames = tuple(labelnames)
+    self._children = {}
+    self._lock = threading.Lock()
+    REGISTRY.append(self)
+
+  def labels(self, *values):
+    child = self._children.get(values)
+    if child is None:
+      with self._lock:
+        child = self._children.setdefault(values, self._new_child())
+    return child
+
+  def render(self) -> list[str]:
+    lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.kind}"]
+    for values, child in list(self._children.items()):
+      lines.extend(child.render(self.name, self.labelnames, values))
+    return lines
+
+class _ValueChild:
+  def __init__(self):
+    self.value = 0
+    self._lock = threading.Lock()
+
+  def inc(self, amount=1):
+    with self._lock:
+      self.value += amount
+
+  def dec(self, amount=1):
+    with self._lock:
+      self.value -= amount
+
+  def set(self, value):
+    self.value = value
+
+  def render(self, name, labelnames, values):
+    return [f"{name}{_labels(labelnames, values)} {_number(self.value)}"]
+
+class Counter(_Metric):
+  kind = "counter"
+  _new_child = _ValueChild
+
+class Gauge(_Metric):
+  kind = "gauge"
+  _new_child = _ValueChild
+
+class _HistogramChild:
+  def __init__(self, buckets):
+    self.buckets = buckets
+    self.counts = [0] * (len(buckets) + 1)
+    self.sum = 0.0
+    self._lock = threading.Lock()
+
+  def observe(self, value: float):
+    i = bisect.bisect_left(self.buckets, value)
+    with self._lock:
+      self.counts[i] += 1
+      self.sum += value
+
+  def time(self):
+    return _Timer(self)
+
+  def render(self, name, labelnames, values):
+    lines = []
+    cumulative = 0
+    for bound, count in zip((*self.buckets, float("inf")), self.counts):
+      cumulative += count
+      le = 'le="' + _number(bound) + '"'
+      lines.append(f"{name}_bucket{_labels(labelnames, values, le)} {cumulative}")
+    lines.append(f"{name}_sum{_labels(labelnames, values)} {_number(self.sum)}")
+    lines.append(f"{name}_count{_labels(labelnames, values)} {cumulative}")
+    return lines
+
+class _Timer:
+  def __init__(self, child):
+    self.child = child
+
+  def __enter__(self):
+    self.start = time.perf_counter()
+    return self
+
+  def __exit__(self, *exc):
+    self.child.observe(time.perf_counter() - self.start)
+
+class Histogram(_Metric):
+  kind = "histogram"
+
+  def __init__(self, name: str, documentation: str, labelnames: tuple = (), buckets: tuple = LATENCY_BUCKETS):
+    self.bucket_bounds = tuple(sorted(buckets))
+    super().__init__(name, documentation, labelnames)
+
+  def _new_child(self):
+    return _HistogramChild(self.bucket_bounds)
+
+def collector(fn):
+  """Register fn() -> iterable of (name, kind, help, [(labels dict, value), ...]) evaluated at scrape time."""
+  _collectors.append(fn)
+  return fn
+
+def render() -> str:
+  lines = []
+  for metric in REGISTRY:
+    lines.extend(metric.render())
+  for fn in _collectors:
+    for name, kind, documentation, samples in fn():
+      lines.append(f"# HELP {name} {documentation}")
+      lines.append(f"# TYPE {name} {kind}")
+      for labels, value in samples:
+        if value is not None:
+          lines.append(f"{name}{_labels(labels.keys(), labels.values())} {_number(value)}")
+  return "\n".join(lines) + "\n"
+
+HTTP_REQUEST_SECONDS = Histogram("http_request_duration_seconds", "Request latency by route template and method.", ("route", "method"))
+HTTP_REQUESTS = Counter("http_requests_total", "Requests by route template, method and status code.", ("route", "method", "status"))
+HTTP_IN_FLIGHT = Gauge("http_requests_in_flight", "Requests currently being served.")
+_in_flight = HTTP_IN_FLIGHT.labels()
+
+class MetricsMiddleware:
+  def __init__(self, app):
+    self.app = app
+    # route template -> method -> (histogram child, {status: counter child})
+    self._routes: dict[str, dict[str, tuple]] = {}
+
+  def _children(self, route: str, method: str):
+    methods = self._routes.get(route)
+    if methods is None:
+      methods = self._routes.setdefault(route, {})
+    children = methods.get(method)
+    if children is None:
+      children = methods.setdefault(method, (HTTP_REQUEST_SECONDS.labels(route, method), {}))
+    return children
+
+  async def __call__(self, scope, receive, send):
+    if scope["type"] != "http":
+      return await self.app(scope, receive, send)
+    start = time.perf_counter()
+    status_code = 500
+
+    async def send_with_status(message):
+      nonlocal status_code
+      if message["type"] == "http.response.start":
+        status_code = message["status"]
+      await send(message)
+
+    _in_flight.inc()
+    try:
+      await self.app(scope, receive, send_with_status)
+    finally:
+      _in_flight.dec()
+      route = scope.get("route")
+      # unmatched paths share one label so scanners cannot blow up cardinality
+      template = route.path if route is not None else UNMATCHED_ROUTE
+      histogram, statuses = self._children(template, scope["method"])
+      histogram.observe(time.perf_counter() - start)
+      counter = statuses.get(status_code)
+      if counter is None:
+        counter = statuses.setdefault(status_code, HTTP_REQUESTS.labels(template, scope["method"], str(status_code)))
+      counter.inc()
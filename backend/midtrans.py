@@ -0,0 +1,210 @@
+import asyncio
+import hashlib
+import hmac
+import random
+import time
+
+import httpx
+
+import config, metrics
+
+# Internal payment statuses ordered by how final they are. A payment only
+# moves forward in this order, so a late or replayed 'pending' notification
+# can never undo 'paid'.
+STATUS_RANK = {'pending': 0, 'failed': 1, 'paid': 2}
+
+def status_rank(status: str | None) -> int:
+  return STATUS_RANK.get(status, -1)
+
+def internal_status(transaction_status: str | None, fraud_status: str | None = None) -> str:
+  """Map a Midtrans transaction_status/fraud_status pair to our payment status."""
+  if transaction_status == 'capture':
+    return 'paid' if fraud_status == 'accept' else 'pending'
+  if transaction_status == 'settlement':
+    return 'paid'
+  if transaction_status in ('cancel', 'deny', 'expire'):
+    return 'failed'
+  return 'pending'
+
+def signature(order_id, status_code, gross_amount, server_key: str | None = None) -> str:
+  server_key = config.MIDTRANS_SERVER_KEY if server_key is None else server_key
+  return hashlib.sha512(f"{order_id}{status_code}{gross_amount}{server_key}".encode('utf-8')).hexdigest()
+
+def verify_signature(notification: dict) -> bool:
+  expected = signature(
+    notification.get('order_id'),
+    notification.get('status_code'),
+    notification.get('gross_amount'),
+  )
+  return hmac.compare_digest(expected, str(notification.get('signature_key') or ''))
+
+class MidtransError(Exception):
+  """Midtrans answered but rejected the request (4xx or an error status_code in the body)."""
+  def __init__(self, message: str, status_code: int | None = None):
+    super().__init__(message)
+    self.status_code = status_code
+
+class GatewayUnavailable(Exception):
+  """Midtrans could not be reached, kept failing, or the circuit breaker is open."""
+  def __init__(self, message: str, retry_after: float):
+    super().__init__(message)
+    self.retry_after = retry_after
+
+class CircuitBreaker:
+  """Opens after `failures` consecutive failed calls; after `reset_seconds` one probe call is let through."""
+  def __init__(self, failures: int, reset_seconds: float):
+    self.failures = failures
+    self.reset_seconds = reset_seconds
+    self.consecutive_failures = 0
+    self.opened_at = None
+    self._probing = False
+    self._probe_started = 0.0
+
+  @property
+  def state(self) -> str:
+    if self.opened_at is None:
+      return "closed"
+    return "half-open" if self._probing or self.retry_after() == 0 else "open"
+
+  def retry_after(self) -> float:
+    if self.opened_at is None:
+      return 0.0
+    return max(0.0, self.opened_at + self.reset_seconds - time.monotonic())
+
+  def allow(self) -> bool:
+    if self.opened_at is None:
+      return True
+    if self.retry_after() > 0:
+      return False
+    now = time.monotonic()
+    # a probe that never reported back (e.g. cancelled) is replaced after reset_seconds
+    if self._probing and now - self._probe_started < self.reset_seconds:
+      return False
+    self._probing = True
+    self._probe_started = now
+    return True
+
+  def record_success(self):
+    self.consecutive_failures = 0
+    self.opened_at = None
+    self._probing = False
+
+  def record_failure(self):
+    self.consecutive_failures += 1
+    if self._probing or self.consecutive_failures >= self.failures:
+      self.opened_at = time.monotonic()
+    self._probing = False
+
+GATEWAY_SECONDS = metrics.Histogram("midtrans_request_duration_seconds", "Midtrans call latency including retries.", ("operation",))
+GATEWAY_CALLS = metrics.Counter(
+  "midtrans_requests_total", "Midtrans calls by outcome (ok, rejected, unavailable, breaker_open).", ("operation", "outcome"),
+)
+
+class MidtransClient:
+  """Async Midtrans Snap / Core API client sharing one keep-alive connection pool.
+
+  Only idempotent calls are retried: status lookups, and charges sent with an
+  Idempotency-Key. Transport errors, timeouts and 5xx responses count as
+  failures for the circuit breaker; rejections (4xx) do not.
+  """
+  def __init__(self, server_key: str | None = None, api_url: str | None = None, snap_url: str | None = None, transport=None):
+    self.server_key = config.MIDTRANS_SERVER_KEY if server_key is None else server_key
+    self.api_url = (api_url or config.MIDTRANS_API_URL).rstrip("/")
+    self.snap_url = (snap_url or config.MIDTRANS_SNAP_URL).rstrip("/")
+    self.breaker = CircuitBreaker(config.MIDTRANS_BREAKER_FAILURES, config.MIDTRANS_BREAKER_RESET_SECONDS)
+    self._transport = transport
+    self._http = None
+    self._loop = None
+
+  def _client(self) -> httpx.AsyncClient:
+    # an httpx pool belongs to the event loop that opened its connections
+    loop = asyncio.get_running_loop()
+    if self._http is None or self._loop is not loop:
+      self._http = httpx.AsyncClient(
+        auth=(self.server_key, ""),
+        headers={"Accept": "application/json"},
+        timeout=httpx.Timeout(config.MIDTRANS_TIMEOUT_SECONDS, connect=config.MIDTRANS_CONNECT_TIMEOUT_SECONDS),
+        limits=httpx.Limits(max_connections=config.MIDTRANS_MAX_CONNECTIONS, max_keepalive_connections=config.MIDTRANS_MAX_CONNECTIONS),
+        transport=self._transport,
+      )
+      self._loop = loop
+    return self._http
+
+  async def aclose(self):
+    if self._http is not None:
+      await self._http.aclose()
+      self._http = None
+      self._loop = None
+
+  def _parse(self, response: httpx.Response) -> dict:
+    try:
+      body = response.json()
+    except ValueError:
+      body = {}
+    status_code = response.status_code
+    if status_code < 400 and str(body.get("status_code", "200")).isdigit():
+      status_code = int(body.get("status_code", "200"))
+    # 407 is how Midtrans reports an expired transaction: a normal status body, not an error
+    if status_code >= 400 and status_code != 407:
+      message = body.get("status_message") or "; ".join(body.get("error_messages", [])) or response.text
+      raise MidtransError(message, status_code)
+    return body
+
+  async def _request(self, operation: str, method: str, url: str, retries: int = 0, **kwargs) -> dict:
+    if not self.breaker.allow():
+      GATEWAY_CALLS.labels(operation, "breaker_open").inc()
+      raise GatewayUnavailable("Midtrans circuit breaker is open", self.breaker.retry_after())
+    start = time.perf_counter()
+    outcome = "unavailable"
+    try:
+      body = await self._send(method, url, retries, **kwargs)
+      outcome = "ok"
+      return body
+    except MidtransError:
+      outcome = "rejected"
+      raise
+    finally:
+      GATEWAY_SECONDS.labels(operation).observe(time.perf_counter() - start)
+      GATEWAY_CALLS.labels(operation, outcome).inc()
+
+  async def _send(self, method: str, url: str, retries: int, **kwargs) -> dict:
+    error = None
+    for attempt in range(retries + 1):
+      if attempt:
+        # exponential backoff with full jitter so retries from many requests spread out
+        await asyncio.sleep(random.uniform(0, config.MIDTRANS_RETRY_BACKOFF_SECONDS * 2 ** attempt))
+      try:
+        response = await self._client().request(method, url, **kwargs)
+      except httpx.TransportError as e:
+        error = e
+        continue
+      if response.status_code < 500:
+        self.breaker.record_success()
+        return self._parse(response)
+      error = MidtransError(f"Midtrans returned HTTP {response.status_code}", response.status_code)
+    self.breaker.record_failure()
+    raise GatewayUnavailable(f"Midtrans unavailable: {error!r}", self.breaker.retry_after() or 1.0) from error
+
+  async def create_snap_transaction(self, params: dict) -> dict:
+    # not retried: a repeated order_id is rejected by Snap
+    return await self._request("snap", "POST", f"{self.snap_url}/v1/transactions", json=params)
+
+  async def charge(self, params: dict, idempotency_key: str | None = None) -> dict:
+    if idempotency_key is None:
+      return await self._request("charge", "POST", f"{self.api_url}/v2/charge", json=params)
+    return await self._request(
+      "charge", "POST", f"{self.api_url}/v2/charge", retries=config.MIDTRANS_RETRIES,
+      json=params, headers={"Idempotency-Key": idempotency_key},
+    )
+
+  async def transaction_status(self, order_id: str) -> dict:
+    return await self._request("status", "GET", f"{self.api_url}/v2/{order_id}/status", retries=config.MIDTRANS_RETRIES)
+
+  def stats(self) -> dict:
+    return {
+      "breaker": self.breaker.state,
+      "consecutive_failures": self.breaker.consecutive_failures,
+      "retry_after": round(self.breaker.retry_after(), 3),
+    }
+
+gateway = MidtransClient()
@@ -0,0 +1,250 @@
+"""Versioned schema migrations, applied to every branch database.
+
+Each migration is a function of a Connection registered with @migration(version).
+Applied versions are recorded in schema_migrations, so running upgrade() again
+is a no-op. Steps are written to be idempotent (IF NOT EXISTS / inspector
+checks) because databases created by the old create_all() loop already have
+some of the objects.
+
+    python migrations.py              # upgrade all branches
+    python migrations.py --status     # show applied versions
+    python migrations.py --check-plans  # fail if hot lookups use a seq scan
+"""
+import argparse
+import sys
+from datetime import datetime
+
+from sqlalchemy import inspect, text
+
+import models, patient_index, user_directory
+from database import Base, engines
+
+MIGRATIONS = []
+# arbitrary constant for pg_advisory_lock so concurrent workers migrate one at a time
+_LOCK_ID = 74013
+
+def migration(version: int):
+  def register(fn):
+    MIGRATIONS.append((version, fn.__name__, fn))
+    MIGRATIONS.sort(key=lambda m: m[0])
+    return fn
+  return register
+
+def create_index(conn, name: str, table: str, columns: list[str], unique: bool = False):
+  existing = {index["name"] for index in inspect(conn).get_indexes(table)}
+  if name in existing:
+    return
+  unique_sql = "UNIQUE " if unique else ""
+  conn.execute(text(f"CREATE {unique_sql}INDEX IF NOT EXISTS {name} ON {table} ({', '.join(columns)})"))
+
+def add_column(conn, table: str, column: str, ddl: str):
+  existing = {col["name"] for col in inspect(conn).get_columns(table)}
+  if column not in existing:
+    conn.execute(text(f"ALTER TABLE {table} ADD COLUMN {column} {ddl}"))
+
+@migration(1)
+def initial_schema(conn):
+  Base.metadata.create_all(bind=conn)
+
+@migration(2)
+def hot_lookup_indexes(conn):
+  create_index(conn, "ix_appointments_patient_id", "appointments", ["patient_id"])
+  create_index(conn, "ix_appointments_scheduled_at", "appointments", ["scheduled_at"])
+  create_index(conn, "ix_appointments_doctor_id_scheduled_at", "appointments", ["doctor_id", "scheduled_at"])
+  create_index(conn, "ix_medical_records_patient_id", "medical_records", ["patient_id"])
+  create_index(conn, "ix_payments_transaction_id", "payments", ["transaction_id"], unique=True)
+  create_index(conn, "ix_payments_appointment_id", "payments", ["appointment_id"])
+  create_index(conn, "ix_payment_items_payment_id", "payment_items", ["payment_id"])
+
+@migration(3)
+def patient_search_indexes(conn):
+  # other dialects fall back to patient_search.TrigramIndex
+  if conn.dialect.name != "postgresql":
+    return
+  conn.execute(text("CREATE EXTENSION IF NOT EXISTS pg_trgm"))
+  conn.execute(text("CREATE INDEX IF NOT EXISTS ix_patients_name_trgm ON patients USING gin (lower(name) gin_trgm_ops)"))
+  conn.execute(text("CREATE INDEX IF NOT EXISTS ix_patients_name_prefix ON patients (lower(name) text_pattern_ops)"))
+  conn.execute(text("CREATE INDEX IF NOT EXISTS ix_patients_national_id_prefix ON patients (national_id text_pattern_ops)"))
+  conn.execute(text("CREATE INDEX IF NOT EXISTS ix_patients_phone_prefix ON patients (phone text_pattern_ops)"))
+
+@migration(4)
+def appointment_duration(conn):
+  add_column(conn, "appointments", "duration_minutes", "INTEGER NOT NULL DEFAULT 30")
+
+@migration(5)
+def payment_notification_queue(conn):
+  models.PaymentNotification.__table__.create(bind=conn, checkfirst=True)
+
+@migration(6)
+def payment_reconciliation(conn):
+  models.JobCheckpoint.__table__.create(bind=conn, checkfirst=True)
+  for index in models.Payment.__table__.indexes:
+    if index.name == "ix_payments_pending":
+      index.create(bind=conn, checkfirst=True)
+
+@migration(7)
+def exact_money_columns(conn):
+  # SQLite has no column types to change; NUMERIC is only enforced on Postgres
+  if conn.dialect.name != "postgresql":
+    return
+  for table, column in [("payments", "amount"), ("payment_items", "price"), ("payment_items", "total")]:
+    conn.execute(text(f"ALTER TABLE {table} ALTER COLUMN {column} TYPE NUMERIC(12, 2) USING round({column}::numeric, 2)"))
+
+@migration(8)
+def patient_national_id_index(conn):
+  # bulk import deduplicates on national_id; Postgres already has ix_patients_national_id_prefix
+  if conn.dialect.name == "postgresql":
+    return
+  create_index(conn, "ix_patients_national_id", "patients", ["national_id"])
+
+@migration(9)
+def medical_record_timeline_index(conn):
+  create_index(conn, "ix_medical_records_patient_id_created_at", "medical_records", ["patient_id", "created_at", "id"])
+  # covered by the new index's leading column
+  conn.execute(text("DROP INDEX IF EXISTS ix_medical_records_patient_id"))
+
+@migration(10)
+def user_directory_and_refresh_tokens(conn):
+  models.UserDirectoryEntry.__table__.create(bind=conn, checkfirst=True)
+  models.RefreshToken.__table__.create(bind=conn, checkfirst=True)
+  # this branch's own accounts; upgrade_all() then replicates every branch's (POST_UPGRADE)
+  branch = next(name for name, engine in engines.items() if engine is conn.engine)
+  conn.execute(
+    text(
+      "INSERT INTO user_directory (username, branch, user_id, role, updated_at) "
+      "SELECT username, :branch, id, role, :now FROM users WHERE username IS NOT NULL "
+      "AND username NOT IN (SELECT username FROM user_directory)"
+    ),
+    {"branch": branch, "now": datetime.utcnow()},
+  )
+
+@migration(11)
+def master_patient_index(conn):
+  # only PATIENT_INDEX_BRANCH uses them; upgrade_all() then links existing patients (POST_UPGRADE)
+  models.MasterPatient.__table__.create(bind=conn, checkfirst=True)
+  models.PatientLink.__table__.create(bind=conn, checkfirst=True)
+
+@migration(12)
+def payment_created_date_backfill(conn):
+  # created_date was never set; the best remaining evidence of when a payment
+  # was created is when it was paid, else its appointment's time, else now
+  conn.execute(
+    text(
+      "UPDATE payments SET created_date = COALESCE("
+      "payment_date, (SELECT scheduled_at FROM appointments WHERE appointments.id = payments.appointment_id), :now"
+      ") WHERE created_date IS NULL"
+    ),
+    {"now": datetime.utcnow()},
+  )
+
+def _ensure_version_table(conn):
+  conn.execute(text(
+    "CREATE TABLE IF NOT EXISTS schema_migrations ("
+    "version INTEGER PRIMARY KEY, name VARCHAR NOT NULL, applied_at TIMESTAMP NOT NULL)"
+  ))
+
+def applied_versions(conn) -> set[int]:
+  _ensure_version_table(conn)
+  return {row[0] for row in conn.execute(text("SELECT version FROM schema_migrations"))}
+
+def upgrade(engine) -> list[int]:
+  """Apply pending migrations to one engine; returns the versions applied."""
+  applied = []
+  is_postgres = engine.dialect.name == "postgresql"
+  with engine.connect() as lock_conn:
+    if is_postgres:
+      lock_conn.execute(text("SELECT pg_advisory_lock(:id)"), {"id": _LOCK_ID})
+    try:
+      with engine.begin() as conn:
+        done = applied_versions(conn)
+      for version, name, fn in MIGRATIONS:
+        if version in done:
+          continue
+        with engine.begin() as conn:
+          fn(conn)
+          conn.execute(
+            text("INSERT INTO schema_migrations (version, name, applied_at) VALUES (:version, :name, :applied_at)"),
+            {"version": version, "name": name, "applied_at": datetime.utcnow()},
+          )
+        applied.append(version)
+    finally:
+      if is_postgres:
+        lock_conn.execute(text("SELECT pg_advisory_unlock(:id)"), {"id": _LOCK_ID})
+  return applied
+
+# Steps that read every branch, so they run once all branches are upgraded,
+# whenever their migration was applied to any of them; version -> step.
+POST_UPGRADE = {
+  10: user_directory.rebuild,
+  11: patient_index.rebuild,
+}
+
+def upgrade_all() -> dict[str, list[int]]:
+  applied = {branch: upgrade(engine) for branch, engine in engines.items()}
+  versions = {version for branch_versions in applied.values() for version in branch_versions}
+  for version, step in POST_UPGRADE.items():
+    if version in versions:
+      step()
+  return applied
+
+# Lookups that must be served by an index; (description, table, sql).
+HOT_LOOKUPS = [
+  ("medical records by patient", "medical_records", "SELECT * FROM medical_records WHERE patient_id = 1"),
+  ("medical record timeline", "medical_records",
+   "SELECT * FROM medical_records WHERE patient_id = 1 AND created_at < '2025-01-01' ORDER BY created_at DESC, id DESC LIMIT 100"),
+  ("appointments by patient", "appointments", "SELECT * FROM appointments WHERE patient_id = 1"),
+  ("doctor schedule", "appointments",
+   "SELECT * FROM appointments WHERE doctor_id = 1 AND scheduled_at >= '2025-01-01' AND scheduled_at < '2025-01-02'"),
+  ("payment by transaction (webhook)", "payments", "SELECT * FROM payments WHERE transaction_id = 'x'"),
+  ("pending payments (reconciliation)", "payments",
+   "SELECT * FROM payments WHERE status = 'pending' AND id > 0 ORDER BY id LIMIT 200"),
+  ("patients by national_id (import dedup)", "patients", "SELECT * FROM patients WHERE national_id IN ('1', '2')"),
+  ("payment by appointment", "payments", "SELECT * FROM payments WHERE appointment_id = 1"),
+  ("payment items by payment", "payment_items", "SELECT * FROM payment_items WHERE payment_id = 1"),
+  ("user directory (login)", "user_directory", "SELECT * FROM user_directory WHERE username = 'x'"),
+  ("refresh token by hash", "refresh_tokens", "SELECT * FROM refresh_tokens WHERE token_hash = 'x'"),
+  ("refresh token family (reuse)", "refresh_tokens", "SELECT * FROM refresh_tokens WHERE family = 'x'"),
+  ("patient link by branch record", "patient_links", "SELECT * FROM patient_links WHERE branch = 'x' AND patient_id = 1"),
+  ("patient links by master", "patient_links", "SELECT * FROM patient_links WHERE master_id = 1"),
+  ("master patient by national_id", "master_patients", "SELECT * FROM master_patients WHERE national_id = 'x'"),
+  ("master patients by phone (fuzzy linkage)", "master_patients", "SELECT * FROM master_patients WHERE phone = 'x'"),
+]
+
+def seq_scans(engine) -> list[str]:
+  """Return the hot lookups whose query plan scans the whole table."""
+  failures = []
+  with engine.connect() as conn:
+    is_postgres = engine.dialect.name == "postgresql"
+    if is_postgres:
+      # small tables make a seq scan look cheaper; we only want to know an index is usable
+      conn.execute(text("SET LOCAL enable_seqscan = off"))
+    for description, table, sql in HOT_LOOKUPS:
+      if is_postgres:
+        plan = "\n".join(row[0] for row in conn.execute(text(f"EXPLAIN {sql}")))
+        scanned = f"Seq Scan on {table}" in plan
+      else:
+        plan = "\n".join(row[-1] for row in conn.execute(text(f"EXPLAIN QUERY PLAN {sql}")))
+        scanned = f"SCAN {table}" in plan and "USING" not in plan
+      if scanned:
+        failures.append(description)
+  return failures
+
+if __name__ == "__main__":
+  parser = argparse.ArgumentParser(description="Apply schema migrations to every branch database")
+  parser.add_argument("--status", action="store_true", help="show applied versions only")
+  parser.add_argument("--check-plans", action="store_true", help="exit 1 if a hot lookup uses a seq scan")
+  args = parser.parse_args()
+  if args.status:
+    for branch, engine in engines.items():
+      with engine.begin() as conn:
+        print(branch, sorted(applied_versions(conn)))
+  elif args.check_plans:
+    failed = False
+    for branch, engine in engines.items():
+      for description in seq_scans(engine):
+        failed = True
+        print(f"{branch}: seq scan for {description}")
+    sys.exit(1 if failed else 0)
+  else:
+    for branch, applied in upgrade_all().items():
+      print(branch, "applied", applied or "nothing")
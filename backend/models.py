@@ -1,4 +1,4 @@
-from sqlalchemy import Column,String,Integer,TIMESTAMP,ForeignKey,Text, Float
+from sqlalchemy import Column,String,Integer,TIMESTAMP,ForeignKey,Text, Float, Index, Numeric, UniqueConstraint, text
 from sqlalchemy.orm import relationship
 from database import Base
 from datetime import datetime
@@ -26,10 +26,13 @@ class Patient(Base):
 
 class Appointment(Base):
   __tablename__ = "appointments"
+  # (doctor_id, scheduled_at) also serves lookups on doctor_id alone
+  __table_args__ = (Index("ix_appointments_doctor_id_scheduled_at", "doctor_id", "scheduled_at"),)
   id = Column(Integer, primary_key=True, index=True)
-  patient_id = Column(Integer, ForeignKey("patients.id"))
+  patient_id = Column(Integer, ForeignKey("patients.id"), index=True)
   doctor_id = Column(Integer, ForeignKey("users.id"))
-  scheduled_at = Column(TIMESTAMP)
+  scheduled_at = Column(TIMESTAMP, index=True)
+  duration_minutes = Column(Integer, nullable=False, default=30, server_default="30")
   status = Column(String, default="scheduled")
 
   patient = relationship("Patient",back_populates="appointments")
@@ -39,6 +42,8 @@ class Appointment(Base):
 
 class MedicalRecord(Base):
   __tablename__="medical_records"
+  # the patient timeline reads newest first; also serves lookups on patient_id alone
+  __table_args__ = (Index("ix_medical_records_patient_id_created_at", "patient_id", "created_at", "id"),)
   id= Column(Integer, primary_key=True, index=True)
   appointment_id = Column(Integer, ForeignKey("appointments.id", ondelete="CASCADE"))
   patient_id = Column(Integer, ForeignKey("patients.id", ondelete="CASCADE"))
@@ -54,15 +59,21 @@ class MedicalRecord(Base):
 
 class Payment(Base):
   __tablename__ = 'payments'
+  __table_args__ = (
+    # reconciliation scans pending payments in id order
+    Index('ix_payments_pending', 'id',
+          postgresql_where=text("status = 'pending'"), sqlite_where=text("status = 'pending'")),
+  )
   id = Column(Integer, primary_key=True, index=True)
-  appointment_id = Column(Integer, ForeignKey('appointments.id'))
-  amount = Column(Float,nullable=False)
+  appointment_id = Column(Integer, ForeignKey('appointments.id'), index=True)
+  amount = Column(Numeric(12, 2),nullable=False)
   payment_method = Column(String, nullable=False)
   status= Column(String, default='pending')
-  transaction_id = Column(String, nullable=True)
+  transaction_id = Column(String, nullable=True, unique=True, index=True)
   payment_date = Column(TIMESTAMP, nullable=True)
   invoice_entries = Column(String)
-  created_date = Column(TIMESTAMP)
+  # exports filter payments and their items on it
+  created_date = Column(TIMESTAMP, default=datetime.utcnow)
   
   appointment = relationship("Appointment",back_populates="payment")
   items = relationship("PaymentItem", back_populates="payment", cascade="all, delete-orphan")
@@ -70,11 +81,83 @@ class Payment(Base):
 class PaymentItem(Base):
   __tablename__ = 'payment_items'
   id= Column(Integer, primary_key=True, index=True)
-  payment_id = Column(Integer, ForeignKey('payments.id'))
+  payment_id = Column(Integer, ForeignKey('payments.id'), index=True)
   description = Column(String, nullable=False)
   quantity = Column(Integer, default=1)
-  price = Column(Float, nullable=False)
-  total = Column(Float, nullable=True)
+  price = Column(Numeric(12, 2), nullable=False)
+  total = Column(Numeric(12, 2), nullable=True)
 
   payment = relationship("Payment",back_populates="items")
 
+class PaymentNotification(Base):
+  """Midtrans webhook queue: verified notifications waiting to be applied to payments."""
+  __tablename__ = 'payment_notifications'
+  __table_args__ = (
+    # Midtrans retries deliver the same (transaction, status) pair many times
+    UniqueConstraint('transaction_id', 'transaction_status', name='uq_payment_notifications_transaction_status'),
+    Index('ix_payment_notifications_unprocessed', 'id',
+          postgresql_where=text('processed_at IS NULL'), sqlite_where=text('processed_at IS NULL')),
+  )
+  id = Column(Integer, primary_key=True, index=True)
+  transaction_id = Column(String, nullable=False)
+  transaction_status = Column(String, nullable=False)
+  fraud_status = Column(String, nullable=True)
+  order_id = Column(String, nullable=True)
+  payload = Column(Text, nullable=False)
+  received_at = Column(TIMESTAMP, default=datetime.utcnow, nullable=False)
+  processed_at = Column(TIMESTAMP, nullable=True)
+  outcome = Column(String, nullable=True)
+
+class JobCheckpoint(Base):
+  """Resume position of a background job (e.g. the last payment id reconciliation scanned)."""
+  __tablename__ = 'job_checkpoints'
+  name = Column(String, primary_key=True)
+  position = Column(Integer, nullable=False, default=0)
+  updated_at = Column(TIMESTAMP, default=datetime.utcnow, onupdate=datetime.utcnow)
+
+class UserDirectoryEntry(Base):
+  """Replica of the global username -> branch index; every branch database holds one (user_directory.py)."""
+  __tablename__ = 'user_directory'
+  username = Column(String, primary_key=True)
+  # the branch database that holds the account
+  branch = Column(String, nullable=False)
+  user_id = Column(Integer, nullable=False)
+  role = Column(String)
+  updated_at = Column(TIMESTAMP, default=datetime.utcnow, nullable=False)
+
+class RefreshToken(Base):
+  """Hashed refresh token (refresh_tokens.py); a family is one login, rotated on every use."""
+  __tablename__ = 'refresh_tokens'
+  id = Column(Integer, primary_key=True)
+  token_hash = Column(String, nullable=False, unique=True, index=True)
+  family = Column(String, nullable=False, index=True)
+  user_id = Column(Integer, nullable=False, index=True)
+  created_at = Column(TIMESTAMP, default=datetime.utcnow, nullable=False)
+  expires_at = Column(TIMESTAMP, nullable=False)
+  revoked_at = Column(TIMESTAMP, nullable=True)
+
+class MasterPatient(Base):
+  """One person across branches in the master patient index (patient_index.py); lives in central."""
+  __tablename__ = 'master_patients'
+  id = Column(Integer, primary_key=True)
+  # normalized (patient_index.normalize_national_id); NULL when no linked record has a usable one
+  national_id = Column(String, unique=True, index=True, nullable=True)
+  name = Column(String)
+  # normalized; blocking key for fuzzy matching of records without a national_id
+  phone = Column(String, index=True)
+  created_at = Column(TIMESTAMP, default=datetime.utcnow, nullable=False)
+  updated_at = Column(TIMESTAMP, default=datetime.utcnow, onupdate=datetime.utcnow, nullable=False)
+
+class PatientLink(Base):
+  """A branch-local patients row linked to its MasterPatient."""
+  __tablename__ = 'patient_links'
+  __table_args__ = (UniqueConstraint("branch", "patient_id", name="uq_patient_links_branch_patient_id"),)
+  id = Column(Integer, primary_key=True)
+  master_id = Column(Integer, ForeignKey("master_patients.id", ondelete="CASCADE"), nullable=False, index=True)
+  branch = Column(String, nullable=False)
+  patient_id = Column(Integer, nullable=False)
+  # how the record was linked: national_id, fuzzy (name + phone) or new (started its own master)
+  match = Column(String, nullable=False)
+  # name similarity of a fuzzy link
+  score = Column(Float, nullable=True)
+  linked_at = Column(TIMESTAMP, default=datetime.utcnow, nullable=False)
@@ -0,0 +1,91 @@
+from datetime import datetime
+from fastapi import HTTPException, Query, Response
+from fastapi.responses import StreamingResponse
+
+DEFAULT_PAGE_SIZE = 100
+MAX_PAGE_SIZE = 1000
+STREAM_BATCH_SIZE = 500
+NEXT_CURSOR_HEADER = "X-Next-Cursor"
+
+class PageParams:
+  """Keyset pagination query parameters shared by the list endpoints."""
+  def __init__(
+    self,
+    limit: int | None = Query(None, ge=1, le=MAX_PAGE_SIZE, description="Jumlah maksimum baris per halaman"),
+    after: int | None = Query(None, description="Cursor: ambil baris dengan id lebih besar dari nilai ini"),
+    stream: bool = Query(False, description="Kirim semua baris sebagai NDJSON stream"),
+  ):
+    self.limit = limit
+    self.after = after
+    self.stream = stream
+
+def paginate(query, key_column, limit: int | None = None, after: int | None = None):
+  """Return (rows, next_cursor) for one page ordered by key_column."""
+  limit = limit or DEFAULT_PAGE_SIZE
+  if after is not None:
+    query = query.filter(key_column > after)
+  # fetch one extra row to know whether another page exists
+  rows = query.order_by(key_column).limit(limit + 1).all()
+  next_cursor = None
+  if len(rows) > limit:
+    rows = rows[:limit]
+    next_cursor = getattr(rows[-1], key_column.key)
+  return rows, next_cursor
+
+def iterate(query, key_column, after: int | None = None, limit: int | None = None):
+  """Yield rows in key order through a server-side cursor."""
+  if after is not None:
+    query = query.filter(key_column > after)
+  query = query.order_by(key_column)
+  if limit is not None:
+    query = query.limit(limit)
+  return query.yield_per(STREAM_BATCH_SIZE)
+
+async def paginate_async(db, stmt, key_column, limit: int | None = None, after: int | None = None):
+  """paginate() for a select() statement on an AsyncSession."""
+  limit = limit or DEFAULT_PAGE_SIZE
+  if after is not None:
+    stmt = stmt.where(key_column > after)
+  rows = (await db.scalars(stmt.order_by(key_column).limit(limit + 1))).all()
+  next_cursor = None
+  if len(rows) > limit:
+    rows = rows[:limit]
+    next_cursor = getattr(rows[-1], key_column.key)
+  return rows, next_cursor
+
+async def iterate_async(db, stmt, key_column, after: int | None = None, limit: int | None = None):
+  """iterate() for an AsyncSession; rows arrive through a server-side cursor."""
+  if after is not None:
+    stmt = stmt.where(key_column > after)
+  stmt = stmt.order_by(key_column)
+  if limit is not None:
+    stmt = stmt.limit(limit)
+  result = await db.stream_scalars(stmt.execution_options(yield_per=STREAM_BATCH_SIZE))
+  async for row in result:
+    yield row
+
+def timeline_cursor(moment: datetime, id: int) -> str:
+  """Cursor for lists ordered by (timestamp DESC, id DESC)."""
+  return f"{moment.isoformat()}_{id}"
+
+def parse_timeline_cursor(cursor: str) -> tuple[datetime, int]:
+  try:
+    moment, id = cursor.rsplit("_", 1)
+    return datetime.fromisoformat(moment), int(id)
+  except ValueError:
+    raise HTTPException(status_code=400, detail="Invalid cursor")
+
+def set_next_cursor(response: Response, next_cursor):
+  if next_cursor is not None:
+    response.headers[NEXT_CURSOR_HEADER] = str(next_cursor)
+
+def ndjson_response(rows, schema) -> StreamingResponse:
+  if hasattr(rows, "__aiter__"):
+    async def generate():
+      async for row in rows:
+        yield schema.model_validate(row).model_dump_json() + "\n"
+  else:
+    def generate():
+      for row in rows:
+        yield schema.model_validate(row).model_dump_json() + "\n"
+  return StreamingResponse(generate(), media_type="application/x-ndjson")
@@ -0,0 +1,94 @@
+import asyncio
+import multiprocessing
+import threading
+import time
+from concurrent.futures import Future, ProcessPoolExecutor
+
+from passlib.context import CryptContext
+
+import config, metrics
+
+# Argon2 is deliberately CPU and memory heavy, so hashing runs in a separate
+# process pool instead of the request threads. The pool is bounded: when
+# PASSWORD_HASH_MAX_PENDING jobs are already queued, new ones are rejected
+# with HashingBusy (turned into 429 by main.py) instead of piling up.
+
+pwd_context = CryptContext(
+  schemes=["argon2"],
+  deprecated="auto",
+  argon2__time_cost=config.ARGON2_TIME_COST,
+  argon2__memory_cost=config.ARGON2_MEMORY_COST,
+  argon2__parallelism=config.ARGON2_PARALLELISM,
+)
+
+class HashingBusy(Exception):
+  """Too many password hash jobs in flight."""
+
+HASH_SECONDS = metrics.Histogram(
+  "password_hash_duration_seconds", "Password hash/verify latency including the wait for a pool worker.", ("operation",),
+)
+HASH_REJECTED = metrics.Counter("password_hash_rejected_total", "Hash jobs rejected with HashingBusy.")
+
+_executor = None
+_executor_lock = threading.Lock()
+_slots = threading.BoundedSemaphore(config.PASSWORD_HASH_MAX_PENDING)
+
+def _hash(password: str) -> str:
+  return pwd_context.hash(password)
+
+def _verify_and_update(password: str, hashed_password: str):
+  return pwd_context.verify_and_update(password, hashed_password)
+
+def _get_executor():
+  global _executor
+  if _executor is None:
+    with _executor_lock:
+      if _executor is None:
+        _executor = ProcessPoolExecutor(
+          max_workers=config.PASSWORD_HASH_WORKERS,
+          mp_context=multiprocessing.get_context("spawn"),
+        )
+  return _executor
+
+def _submit(fn, *args):
+  if not _slots.acquire(blocking=False):
+    HASH_REJECTED.labels().inc()
+    raise HashingBusy()
+  start = time.perf_counter()
+  histogram = HASH_SECONDS.labels("hash" if fn is _hash else "verify")
+  try:
+    if config.PASSWORD_HASH_WORKERS == 0:
+      # inline mode (tests, single-core hosts)
+      future = Future()
+      try:
+        future.set_result(fn(*args))
+      except Exception as e:
+        future.set_exception(e)
+    else:
+      future = _get_executor().submit(fn, *args)
+  except BaseException:
+    _slots.release()
+    raise
+  future.add_done_callback(lambda _: _done(histogram, start))
+  return future
+
+def _done(histogram, start: float):
+  histogram.observe(time.perf_counter() - start)
+  _slots.release()
+
+def hash_password(password: str) -> str:
+  return _submit(_hash, password).result()
+
+def verify_and_update(password: str, hashed_password: str):
+  """Return (valid, new_hash); new_hash is set when the stored hash uses outdated parameters."""
+  return _submit(_verify_and_update, password, hashed_password).result()
+
+async def hash_password_async(password: str) -> str:
+  return await asyncio.wrap_future(_submit(_hash, password))
+
+async def verify_and_update_async(password: str, hashed_password: str):
+  return await asyncio.wrap_future(_submit(_verify_and_update, password, hashed_password))
+
+def shutdown():
+  if _executor is not None:
+    _executor.shutdown(wait=False, cancel_futures=True)
@@ -0,0 +1,192 @@
+"""Bulk patient import from a CSV or NDJSON request body.
+
+The body is read as a stream and parsed record by record, and valid rows are
+buffered one chunk (IMPORT_CHUNK_SIZE rows) at a time, so parsing and loading
+do not hold the file in memory. Two things still grow with the file: the set
+of national_ids seen so far, used to catch duplicates within it, and the error
+report, which lists at most IMPORT_MAX_ERRORS rows. Each record is
+validated against schemas.PatientCreate. A record whose national_id is
+already in the branch database, or earlier in the same file, is reported as
+a duplicate. Valid rows are loaded one chunk per transaction: COPY on
+Postgres (asyncpg copy_records_to_table), a multi-row executemany INSERT
+elsewhere. Because committed chunks are deduplicated on the next attempt, an
+interrupted import can simply be sent again. Each loaded chunk is then linked
+in the master patient index (patient_index.py).
+"""
+import csv
+import io
+import json
+import time
+
+from pydantic import ValidationError
+from sqlalchemy import insert, select
+
+import config, models, patient_index, patient_search, response_cache, schemas
+
+COLUMNS = ("name", "national_id", "phone", "address")
+
+class ImportFormatError(Exception):
+  """The upload cannot be parsed at all (e.g. a CSV header without the required columns)."""
+
+class ImportReport:
+  def __init__(self):
+    self.started = time.perf_counter()
+    self.received = 0
+    self.imported = 0
+    self.duplicates = 0
+    self.invalid = 0
+    self.errors: list[dict] = []
+    self.errors_truncated = False
+
+  def error(self, row: int, national_id, messages: list[str], duplicate: bool = False):
+    if duplicate:
+      self.duplicates += 1
+    else:
+      self.invalid += 1
+    if len(self.errors) < config.IMPORT_MAX_ERRORS:
+      self.errors.append({"row": row, "national_id": national_id, "errors": messages})
+    else:
+      self.errors_truncated = True
+
+  def result(self) -> dict:
+    seconds = time.perf_counter() - self.started
+    return {
+      "received": self.received,
+      "imported": self.imported,
+      "duplicates": self.duplicates,
+      "invalid": self.invalid,
+      "errors": sorted(self.errors, key=lambda error: error["row"]),
+      "errors_truncated": self.errors_truncated,
+      "seconds": round(seconds, 3),
+      "rows_per_second": round(self.received / seconds, 1) if seconds else 0.0,
+    }
+
+async def _lines(chunks):
+  """Text lines (with their newline) from an async iterator of byte chunks."""
+  pending = b""
+  first = True
+  async for chunk in chunks:
+    *complete, pending = (pending + chunk).split(b"\n")
+    for line in complete:
+      yield _decode(line + b"\n", first)
+      first = False
+  if pending:
+    yield _decode(pending, first)
+
+def _decode(line: bytes, first: bool) -> str:
+  try:
+    text = line.decode()
+  except UnicodeDecodeError:
+    raise ImportFormatError("upload must be UTF-8 encoded")
+  # Excel writes a byte order mark in front of UTF-8 CSV files
+  return text.removeprefix("\ufeff") if first else text
+
+async def _csv_records(chunks):
+  """Dict per CSV record; quoted fields may contain newlines."""
+  header = None
+  record = ""
+  async for line in _lines(chunks):
+    record += line
+    # a record is complete once its quotes are balanced
+    if record.count('"') % 2:
+      continue
+    values = next(csv.reader(io.StringIO(record)), [])
+    record = ""
+    if header is None:
+      header = [value.strip().lower() for value in values]
+      missing = [column for column in COLUMNS if column not in header]
+      if missing:
+        raise ImportFormatError(f"CSV header is missing: {', '.join(missing)}")
+      continue
+    if not any(value.strip() for value in values):
+      continue
+    yield dict(zip(header, values))
+  if record.strip():
+    yield ValueError("unterminated quoted field at end of file")
+  if header is None:
+    raise ImportFormatError("CSV upload is empty")
+
+async def _ndjson_records(chunks):
+  async for line in _lines(chunks):
+    if not line.strip():
+      continue
+    try:
+      yield json.loads(line)
+    except ValueError as e:
+      yield ValueError(f"invalid JSON: {e}")
+
+def records(chunks, format: str):
+  return _ndjson_records(chunks) if format == "ndjson" else _csv_records(chunks)
+
+def _validate(data) -> schemas.PatientCreate | list[str]:
+  if isinstance(data, Exception):
+    return [str(data)]
+  if not isinstance(data, dict):
+    return ["expected an object"]
+  try:
+    return schemas.PatientCreate.model_validate(data)
+  except ValidationError as e:
+    return [f"{'.'.join(str(part) for part in error['loc'])}: {error['msg']}" for error in e.errors()]
+
+async def _existing_national_ids(db, national_ids: list[str]) -> set[str]:
+  rows = await db.scalars(select(models.Patient.national_id).where(models.Patient.national_id.in_(national_ids)))
+  return set(rows)
+
+async def _load(db, rows: list[tuple]):
+  if db.bind.dialect.name == "postgresql":
+    connection = await (await db.connection()).get_raw_connection()
+    await connection.driver_connection.copy_records_to_table(
+      models.Patient.__tablename__, records=rows, columns=list(COLUMNS),
+    )
+  else:
+    await db.execute(insert(models.Patient), [dict(zip(COLUMNS, row)) for row in rows])
+
+async def _flush(db, chunk: list[tuple[int, schemas.PatientCreate]], report: ImportReport):
+  existing = await _existing_national_ids(db, [patient.national_id for _, patient in chunk])
+  rows = []
+  for row_number, patient in chunk:
+    if patient.national_id in existing:
+      report.error(row_number, patient.national_id, ["national_id already registered"], duplicate=True)
+    else:
+      rows.append((patient.name, patient.national_id, patient.phone, patient.address))
+  if rows:
+    await _load(db, rows)
+  await db.commit()
+  report.imported += len(rows)
+  if rows:
+    # COPY returns no ids; none of these national_ids was in the branch before, so this finds just the new rows
+    loaded = await db.execute(
+      select(models.Patient.id, models.Patient.name, models.Patient.national_id, models.Patient.phone)
+      .where(models.Patient.national_id.in_([row[1] for row in rows]))
+    )
+    await patient_index.on_patients_imported(db, loaded.all())
+
+async def import_patients(db, chunks, format: str = "csv") -> dict:
+  """Stream, validate and load patients from an async iterator of byte chunks; returns the report."""
+  report = ImportReport()
+  seen: set[str] = set()
+  chunk: list[tuple[int, schemas.PatientCreate]] = []
+  try:
+    async for data in records(chunks, format):
+      report.received += 1
+      row_number = report.received
+      patient = _validate(data)
+      if isinstance(patient, list):
+        national_id = data.get("national_id") if isinstance(data, dict) else None
+        report.error(row_number, national_id, patient)
+        continue
+      if patient.national_id in seen:
+        report.error(row_number, patient.national_id, ["national_id repeated in this file"], duplicate=True)
+        continue
+      seen.add(patient.national_id)
+      chunk.append((row_number, patient))
+      if len(chunk) >= config.IMPORT_CHUNK_SIZE:
+        await _flush(db, chunk, report)
+        chunk = []
+    if chunk:
+      await _flush(db, chunk, report)
+  finally:
+    if report.imported:
+      patient_search.on_patients_imported(db)
+      response_cache.invalidate("patients")
+  return report.result()
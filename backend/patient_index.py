@@ -0,0 +1,320 @@
+"""Master patient index: one id per person across the branch databases.
+
+Each branch database numbers its patients independently, so a person who
+visits two branches has two unrelated rows. master_patients, kept in
+PATIENT_INDEX_BRANCH, holds one row per person. patient_links maps every
+(branch, patient id) to its master row.
+
+A record joins the master with the same normalized national_id. A record
+without a usable national_id joins the master with the same normalized phone
+whose name is at least PATIENT_INDEX_NAME_SIMILARITY alike. A record with a
+national_id may also join such a master, but only if that master has no
+national_id yet; it never joins a master that has a different one. A record
+that matches nothing starts a new master.
+
+The patient write paths in crud.py, async_crud.py and patient_import.py link
+records after they commit. If the index database is down the write is
+logged and skipped. The record is linked again the next time it is saved or
+its locations are read. To relink everything:
+
+    python patient_index.py --rebuild
+"""
+import argparse
+import json
+import logging
+import re
+from collections import namedtuple
+from datetime import datetime
+
+from fastapi.responses import JSONResponse
+from sqlalchemy import delete, exists, func, insert, select, update
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import joinedload, selectinload
+
+import config, federation, metrics, models, schemas
+from database import async_engines, engines, session_branch
+from patient_search import normalize, trigrams
+
+logger = logging.getLogger(__name__)
+
+LINKS = metrics.Counter("patient_index_links_total", "Patient records (re)linked in the master index by match (national_id, fuzzy, new).", ("match",))
+
+# masters sharing one phone (a family's number) that a fuzzy match compares against
+FUZZY_CANDIDATES = 50
+REBUILD_BATCH_SIZE = 1000
+
+_masters = models.MasterPatient.__table__
+_links = models.PatientLink.__table__
+_NOT_ALNUM = re.compile(r"[^0-9A-Z]")
+
+Record = namedtuple("Record", "id name national_id phone")
+
+def normalize_national_id(value: str | None) -> str | None:
+  national_id = _NOT_ALNUM.sub("", (value or "").upper())
+  # placeholders such as "-" or "0000000000000000" identify nobody
+  return national_id if national_id.strip("0") else None
+
+def normalize_phone(value: str | None) -> str | None:
+  digits = "".join(c for c in value or "" if c.isdigit())
+  # +62 812... and 0812... are the same number
+  if digits.startswith("62"):
+    digits = "0" + digits[2:]
+  return digits or None
+
+def name_similarity(a: str | None, b: str | None) -> float:
+  a, b = trigrams(normalize(a or "")), trigrams(normalize(b or ""))
+  union = len(a | b)
+  return len(a & b) / union if union else 0.0
+
+def _record(patient) -> Record:
+  return Record(patient.id, patient.name, patient.national_id, patient.phone)
+
+def _fuzzy_match(conn, name: str | None, phone: str | None, national_id: str | None):
+  """(master id, master national_id, score) of the most similar master with this phone, or None."""
+  if phone is None:
+    return None
+  query = select(_masters.c.id, _masters.c.name, _masters.c.national_id).where(_masters.c.phone == phone)
+  if national_id is not None:
+    query = query.where(_masters.c.national_id.is_(None))
+  best = None
+  for row in conn.execute(query.order_by(_masters.c.id).limit(FUZZY_CANDIDATES)):
+    score = name_similarity(name, row.name)
+    if score >= config.PATIENT_INDEX_NAME_SIMILARITY and (best is None or score > best[2]):
+      best = (row.id, row.national_id, score)
+  return best
+
+def _drop_orphans(conn, master_ids):
+  if master_ids:
+    conn.execute(delete(_masters).where(
+      _masters.c.id.in_(master_ids),
+      ~exists().where(_links.c.master_id == _masters.c.id),
+    ))
+
+def _link(conn, branch: str, records: list[Record]):
+  """Link records of one branch inside conn's transaction on the index database."""
+  ids = [record.id for record in records]
+  linked = dict(conn.execute(
+    select(_links.c.patient_id, _links.c.master_id).where(_links.c.branch == branch, _links.c.patient_id.in_(ids))
+  ).all())
+  national_ids = {normalize_national_id(record.national_id) for record in records} - {None}
+  by_national_id = dict(conn.execute(
+    select(_masters.c.national_id, _masters.c.id).where(_masters.c.national_id.in_(national_ids))
+  ).all()) if national_ids else {}
+  master_national_ids = dict(conn.execute(
+    select(_masters.c.id, _masters.c.national_id).where(_masters.c.id.in_(set(linked.values())))
+  ).all()) if linked else {}
+  master_national_ids.update((master_id, national_id) for national_id, master_id in by_national_id.items())
+  now = datetime.utcnow()
+  moved_from = set()
+  for record in records:
+    national_id = normalize_national_id(record.national_id)
+    phone = normalize_phone(record.phone)
+    current = linked.get(record.id)
+    score = None
+    if national_id is not None and national_id in by_national_id:
+      master_id, match = by_national_id[national_id], "national_id"
+    elif current is not None and (national_id is None or master_national_ids.get(current) is None):
+      # nothing contradicts the existing link
+      master_id, match = current, None
+    else:
+      candidate = _fuzzy_match(conn, record.name, phone, national_id)
+      if candidate is not None:
+        master_id, master_national_id, score = candidate
+        master_national_ids[master_id] = master_national_id
+        match = "fuzzy"
+      else:
+        master_id = conn.execute(
+          insert(_masters).values(national_id=national_id, name=record.name, phone=phone, created_at=now, updated_at=now)
+        ).inserted_primary_key[0]
+        master_national_ids[master_id] = national_id
+        match = "new"
+    values = {"name": record.name, "updated_at": now}
+    if phone is not None:
+      values["phone"] = phone
+    if national_id is not None and master_national_ids.get(master_id) is None:
+      values["national_id"] = master_national_ids[master_id] = national_id
+    if national_id is not None:
+      by_national_id[national_id] = master_id
+    conn.execute(update(_masters).where(_masters.c.id == master_id).values(**values))
+    if current == master_id:
+      continue
+    link = {"master_id": master_id, "match": match, "score": score, "linked_at": now}
+    if current is None:
+      conn.execute(insert(_links).values(branch=branch, patient_id=record.id, **link))
+    else:
+      conn.execute(update(_links).where(_links.c.branch == branch, _links.c.patient_id == record.id).values(**link))
+      moved_from.add(current)
+    linked[record.id] = master_id
+    LINKS.labels(match).inc()
+  _drop_orphans(conn, moved_from)
+
+def _unlink(conn, branch: str, patient_ids: list[int]):
+  condition = (_links.c.branch == branch) & _links.c.patient_id.in_(patient_ids)
+  master_ids = set(conn.scalars(select(_links.c.master_id).where(condition)))
+  conn.execute(delete(_links).where(condition))
+  _drop_orphans(conn, master_ids)
+
+def _write(apply):
+  # a concurrent writer may claim the same national_id first; the retry then joins its master
+  for attempt in range(2):
+    try:
+      with engines[config.PATIENT_INDEX_BRANCH].begin() as conn:
+        return apply(conn)
+    except IntegrityError:
+      if attempt:
+        raise
+
+async def _write_async(apply):
+  for attempt in range(2):
+    try:
+      async with async_engines[config.PATIENT_INDEX_BRANCH].begin() as conn:
+        return await conn.run_sync(apply)
+    except IntegrityError:
+      if attempt:
+        raise
+
+def link(branch: str, patients):
+  """Link (or relink) patients rows of branch; raises if the index database fails."""
+  records = [_record(patient) for patient in patients]
+  if records:
+    _write(lambda conn: _link(conn, branch, records))
+
+async def link_async(branch: str, patients):
+  records = [_record(patient) for patient in patients]
+  if records:
+    await _write_async(lambda conn: _link(conn, branch, records))
+
+def on_patient_saved(db, patient):
+  """Link a created/updated patient of db's (sync) branch after commit."""
+  branch = session_branch(db)
+  try:
+    link(branch, [patient])
+  except Exception:
+    logger.exception("patient %s/%s was not linked in the master patient index", branch, patient.id)
+
+async def on_patient_saved_async(db, patient):
+  branch = session_branch(db)
+  try:
+    await link_async(branch, [patient])
+  except Exception:
+    logger.exception("patient %s/%s was not linked in the master patient index", branch, patient.id)
+
+async def on_patients_imported(db, patients):
+  branch = session_branch(db)
+  try:
+    await link_async(branch, patients)
+  except Exception:
+    logger.exception("imported patients of %s were not linked in the master patient index", branch)
+
+def on_patient_deleted(db, patient_id: int):
+  branch = session_branch(db)
+  try:
+    _write(lambda conn: _unlink(conn, branch, [patient_id]))
+  except Exception:
+    logger.exception("patient %s/%s was not unlinked from the master patient index", branch, patient_id)
+
+async def on_patient_deleted_async(db, patient_id: int):
+  branch = session_branch(db)
+  try:
+    await _write_async(lambda conn: _unlink(conn, branch, [patient_id]))
+  except Exception:
+    logger.exception("patient %s/%s was not unlinked from the master patient index", branch, patient_id)
+
+async def _master(condition) -> dict | None:
+  stmt = (
+    select(_masters.c.id, _masters.c.national_id, _masters.c.name, _masters.c.phone,
+           _links.c.branch, _links.c.patient_id, _links.c.match, _links.c.score)
+    .join(_links, _links.c.master_id == _masters.c.id)
+    .where(condition)
+    .order_by(_links.c.branch, _links.c.patient_id)
+  )
+  async with async_engines[config.PATIENT_INDEX_BRANCH].connect() as conn:
+    rows = (await conn.execute(stmt)).all()
+  if not rows:
+    return None
+  first = rows[0]
+  return {
+    "id": first.id,
+    "national_id": first.national_id,
+    "name": first.name,
+    "phone": first.phone,
+    "records": [
+      {"branch": row.branch, "patient_id": row.patient_id, "match": row.match, "score": row.score}
+      for row in rows
+    ],
+  }
+
+async def locate(branch: str, patient_id: int) -> dict | None:
+  """The master of one branch record and every record linked to it; one indexed query."""
+  master_id = select(_links.c.master_id).where(_links.c.branch == branch, _links.c.patient_id == patient_id)
+  return await _master(_masters.c.id == master_id.scalar_subquery())
+
+async def find(national_id: str) -> dict | None:
+  national_id = normalize_national_id(national_id)
+  if national_id is None:
+    return None
+  return await _master(_masters.c.national_id == national_id)
+
+def merged_history(master: dict) -> JSONResponse:
+  """Appointments of every record linked to master, from all their branches, newest first."""
+  patient_ids: dict[str, list[int]] = {}
+  for record in master["records"]:
+    patient_ids.setdefault(record["branch"], []).append(record["patient_id"])
+
+  def fetch(db):
+    appointments = (
+      db.query(models.Appointment)
+      .filter(models.Appointment.patient_id.in_(patient_ids[session_branch(db)]))
+      .options(
+        joinedload(models.Appointment.doctor),
+        joinedload(models.Appointment.medical_record),
+        selectinload(models.Appointment.payment).selectinload(models.Payment.items),
+      )
+    )
+    return [schemas.AppointmentHistoryEntry.model_validate(a).model_dump(mode="json") for a in appointments]
+
+  result = federation.fan_out([branch for branch in patient_ids if branch in engines], fetch)
+  for branch in patient_ids:
+    if branch not in engines:
+      result.errors[branch] = "unknown"
+  rows = [row for rows in result.rows.values() for row in rows]
+  rows.sort(key=lambda row: (row["scheduled_at"], row["branch"], row["id"]), reverse=True)
+  response = JSONResponse(content={"master": master, "appointments": rows})
+  if result.errors:
+    response.headers[federation.FEDERATION_ERRORS_HEADER] = result.error_header
+  return response
+
+def rebuild() -> dict:
+  """Empty the index and link every patient of every branch again."""
+  with engines[config.PATIENT_INDEX_BRANCH].begin() as conn:
+    conn.execute(delete(_links))
+    conn.execute(delete(_masters))
+  linked = {}
+  for branch, engine in engines.items():
+    linked[branch] = 0
+    after = 0
+    while True:
+      with engine.connect() as conn:
+        batch = conn.execute(
+          select(models.Patient.id, models.Patient.name, models.Patient.national_id, models.Patient.phone)
+          .where(models.Patient.id > after)
+          .order_by(models.Patient.id)
+          .limit(REBUILD_BATCH_SIZE)
+        ).all()
+      if not batch:
+        break
+      link(branch, batch)
+      linked[branch] += len(batch)
+      after = batch[-1].id
+  with engines[config.PATIENT_INDEX_BRANCH].connect() as conn:
+    masters = conn.scalar(select(func.count()).select_from(_masters))
+  return {"linked": linked, "masters": masters}
+
+if __name__ == "__main__":
+  parser = argparse.ArgumentParser(description="Maintain the master patient index")
+  parser.add_argument("--rebuild", action="store_true", help="relink every patient of every branch")
+  args = parser.parse_args()
+  if not args.rebuild:
+    parser.error("nothing to do; pass --rebuild")
+  logging.basicConfig(level=logging.INFO)
+  print(json.dumps(rebuild()))
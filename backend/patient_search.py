@@ -0,0 +1,169 @@
+import bisect
+import re
+import threading
+
+from sqlalchemy import case, func, or_, select
+
+import models
+
+# Patient lookup by name (prefix + fuzzy), national_id and phone (prefix).
+# Postgres answers with pg_trgm and the indexes from migration 3; other
+# dialects (SQLite test runs) use an in-process TrigramIndex per database,
+# built on first search and kept current by the crud write paths.
+
+MAX_RESULTS = 50
+# same default as pg_trgm.similarity_threshold
+SIMILARITY_THRESHOLD = 0.3
+
+_WORD = re.compile(r"[0-9a-z]+")
+
+def normalize(q: str) -> str:
+  return " ".join(q.lower().split())
+
+def trigrams(text: str) -> set[str]:
+  """pg_trgm-style trigrams: each word padded with two leading and one trailing space."""
+  grams = set()
+  for word in _WORD.findall(text.lower()):
+    padded = f"  {word} "
+    grams.update(padded[i:i + 3] for i in range(len(padded) - 2))
+  return grams
+
+def _escape_like(value: str) -> str:
+  return value.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_")
+
+class TrigramIndex:
+  """In-memory prefix and trigram index over patient name, national_id and phone."""
+  FIELDS = ("name", "national_id", "phone")
+
+  def __init__(self):
+    self._lock = threading.Lock()
+    self._docs: dict[int, tuple[tuple[str, ...], set[str]]] = {}
+    self._postings: dict[str, set[int]] = {}
+    self._sorted: dict[str, list[tuple[str, int]]] = {field: [] for field in self.FIELDS}
+
+  def _values(self, patient) -> tuple[str, ...]:
+    return tuple(normalize(getattr(patient, field) or "") for field in self.FIELDS)
+
+  def add(self, patient):
+    with self._lock:
+      self._remove(patient.id)
+      values = self._values(patient)
+      grams = trigrams(values[0])
+      self._docs[patient.id] = (values, grams)
+      for gram in grams:
+        self._postings.setdefault(gram, set()).add(patient.id)
+      for field, value in zip(self.FIELDS, values):
+        bisect.insort(self._sorted[field], (value, patient.id))
+
+  def remove(self, patient_id: int):
+    with self._lock:
+      self._remove(patient_id)
+
+  def _remove(self, patient_id: int):
+    doc = self._docs.pop(patient_id, None)
+    if doc is None:
+      return
+    values, grams = doc
+    for gram in grams:
+      postings = self._postings.get(gram)
+      if postings is not None:
+        postings.discard(patient_id)
+        if not postings:
+          del self._postings[gram]
+    for field, value in zip(self.FIELDS, values):
+      entries = self._sorted[field]
+      i = bisect.bisect_left(entries, (value, patient_id))
+      if i < len(entries) and entries[i] == (value, patient_id):
+        entries.pop(i)
+
+  def search(self, q: str, limit: int) -> list[int]:
+    """Patient ids ranked like the Postgres query: prefix hits first, then name similarity."""
+    q = normalize(q)
+    q_grams = trigrams(q)
+    with self._lock:
+      prefix_hits = set()
+      for field in self.FIELDS:
+        entries = self._sorted[field]
+        i = bisect.bisect_left(entries, (q, -1))
+        while i < len(entries) and entries[i][0].startswith(q):
+          prefix_hits.add(entries[i][1])
+          i += 1
+      shared: dict[int, int] = {}
+      for gram in q_grams:
+        for patient_id in self._postings.get(gram, ()):
+          shared[patient_id] = shared.get(patient_id, 0) + 1
+      scores = {}
+      for patient_id in prefix_hits | shared.keys():
+        common = shared.get(patient_id, 0)
+        name_grams = self._docs[patient_id][1]
+        union = len(q_grams) + len(name_grams) - common
+        similarity = common / union if union else 0.0
+        if patient_id in prefix_hits:
+          scores[patient_id] = 1.0 + similarity
+        elif similarity >= SIMILARITY_THRESHOLD:
+          scores[patient_id] = similarity
+    ranked = sorted(scores, key=lambda patient_id: (-scores[patient_id], patient_id))
+    return ranked[:limit]
+
+_indexes: dict[str, TrigramIndex] = {}
+_indexes_lock = threading.Lock()
+
+def _index_key(bind) -> str:
+  # sync and async engines of one branch share an index despite different drivers
+  url = bind.url
+  return url.set(drivername=url.get_backend_name()).render_as_string()
+
+def on_patient_saved(db, patient):
+  index = _indexes.get(_index_key(db.bind))
+  if index is not None:
+    index.add(patient)
+
+def on_patient_deleted(db, patient_id: int):
+  index = _indexes.get(_index_key(db.bind))
+  if index is not None:
+    index.remove(patient_id)
+
+def on_patients_imported(db):
+  # bulk loads don't return the new rows; rebuild the index on the next search
+  with _indexes_lock:
+    _indexes.pop(_index_key(db.bind), None)
+
+async def _fallback_index(db) -> TrigramIndex:
+  key = _index_key(db.bind)
+  index = _indexes.get(key)
+  if index is None:
+    index = TrigramIndex()
+    rows = await db.execute(select(models.Patient.id, models.Patient.name, models.Patient.national_id, models.Patient.phone))
+    for row in rows:
+      index.add(row)
+    with _indexes_lock:
+      index = _indexes.setdefault(key, index)
+  return index
+
+async def search(db, q: str, limit: int = MAX_RESULTS):
+  """Ranked patients matching q on an AsyncSession."""
+  limit = min(limit, MAX_RESULTS)
+  if db.bind.dialect.name == "postgresql":
+    # national_id/phone are indexed as stored (not lower()), so they get the query's own case
+    raw = q.strip()
+    q = normalize(q)
+    name = func.lower(models.Patient.name)
+    raw_prefix = _escape_like(raw) + "%"
+    is_prefix = or_(
+      name.like(_escape_like(q) + "%", escape="\\"),
+      models.Patient.national_id.like(raw_prefix, escape="\\"),
+      models.Patient.phone.like(raw_prefix, escape="\\"),
+    )
+    score = case((is_prefix, 1.0), else_=0.0) + func.similarity(name, q)
+    stmt = (
+      select(models.Patient)
+      .where(or_(is_prefix, name.op("%")(q)))
+      .order_by(score.desc(), models.Patient.id)
+      .limit(limit)
+    )
+    return (await db.scalars(stmt)).all()
+  ids = (await _fallback_index(db)).search(q, limit)
+  if not ids:
+    return []
+  patients = {p.id: p for p in (await db.scalars(select(models.Patient).where(models.Patient.id.in_(ids))))}
+  return [patients[patient_id] for patient_id in ids if patient_id in patients]
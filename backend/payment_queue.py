@@ -0,0 +1,160 @@
+import json
+import logging
+import threading
+import time
+from datetime import datetime
+
+from sqlalchemy import func, select
+from sqlalchemy.exc import IntegrityError
+
+import config, crud, midtrans, models
+from database import Sessions
+
+# Midtrans webhooks are verified and stored in payment_notifications by the
+# request handler, which answers 200 right away. A background thread per
+# worker drains the table in batches and applies the resulting payment status
+# changes with crud.apply_payment_statuses. Duplicates are dropped on insert by
+# the (transaction_id, transaction_status) unique constraint; on Postgres
+# FOR UPDATE SKIP LOCKED lets several workers drain the same branch.
+
+logger = logging.getLogger(__name__)
+
+class QueueStats:
+  def __init__(self):
+    self._lock = threading.Lock()
+    self.started = time.monotonic()
+    self.received = 0
+    self.duplicates = 0
+    self.processed = 0
+    self.applied = 0
+    self.batches = 0
+    self.errors = 0
+    self.last_batch_seconds = 0.0
+
+  def incr(self, **counts):
+    with self._lock:
+      for name, value in counts.items():
+        setattr(self, name, getattr(self, name) + value)
+
+  def snapshot(self) -> dict:
+    with self._lock:
+      uptime = time.monotonic() - self.started
+      return {
+        "received": self.received,
+        "duplicates": self.duplicates,
+        "processed": self.processed,
+        "applied": self.applied,
+        "batches": self.batches,
+        "errors": self.errors,
+        "last_batch_seconds": round(self.last_batch_seconds, 6),
+        "processed_per_second": round(self.processed / uptime, 2) if uptime else 0.0,
+      }
+
+stats = QueueStats()
+_wakeup = threading.Event()
+_stop = threading.Event()
+_thread = None
+
+async def enqueue(db, notification: dict) -> bool:
+  """Store a verified notification; returns False if it was already queued."""
+  row = models.PaymentNotification(
+    transaction_id=str(notification['transaction_id']),
+    transaction_status=str(notification['transaction_status']),
+    fraud_status=notification.get('fraud_status'),
+    order_id=notification.get('order_id'),
+    payload=json.dumps(notification),
+  )
+  db.add(row)
+  try:
+    await db.commit()
+  except IntegrityError:
+    await db.rollback()
+    stats.incr(received=1, duplicates=1)
+    return False
+  stats.incr(received=1)
+  _wakeup.set()
+  return True
+
+def drain_once(db, batch_size: int | None = None) -> int:
+  """Apply one batch of queued notifications; returns how many were consumed."""
+  batch_size = batch_size or config.WEBHOOK_BATCH_SIZE
+  start = time.perf_counter()
+  rows = db.scalars(
+    select(models.PaymentNotification)
+    .where(models.PaymentNotification.processed_at.is_(None))
+    .order_by(models.PaymentNotification.id)
+    .limit(batch_size)
+    .with_for_update(skip_locked=True)
+  ).all()
+  if not rows:
+    db.rollback()
+    return 0
+  # keep the most final status seen per transaction in this batch
+  updates: dict[str, str] = {}
+  for row in rows:
+    status = midtrans.internal_status(row.transaction_status, row.fraud_status)
+    if midtrans.status_rank(status) > midtrans.status_rank(updates.get(row.transaction_id)):
+      updates[row.transaction_id] = status
+  changed = crud.apply_payment_statuses(db, updates)
+  now = datetime.utcnow()
+  for row in rows:
+    row.processed_at = now
+    row.outcome = 'applied' if row.transaction_id in changed else 'skipped'
+  db.commit()
+  stats.incr(processed=len(rows), applied=len(changed), batches=1)
+  stats.last_batch_seconds = time.perf_counter() - start
+  return len(rows)
+
+def drain(branch: str) -> int:
+  """Drain a branch queue until it is empty."""
+  total = 0
+  while True:
+    db = Sessions[branch]()
+    try:
+      consumed = drain_once(db)
+    finally:
+      db.close()
+    total += consumed
+    if consumed < config.WEBHOOK_BATCH_SIZE:
+      return total
+
+def depth() -> dict[str, int]:
+  depths = {}
+  for branch, Session in Sessions.items():
+    db = Session()
+    try:
+      depths[branch] = db.scalar(
+        select(func.count()).select_from(models.PaymentNotification)
+        .where(models.PaymentNotification.processed_at.is_(None))
+      )
+    finally:
+      db.close()
+  return depths
+
+def _run():
+  while not _stop.is_set():
+    busy = False
+    for branch in Sessions:
+      try:
+        busy = drain(branch) > 0 or busy
+      except Exception:
+        stats.incr(errors=1)
+        logger.exception("payment notification batch failed on %s", branch)
+    if not busy:
+      _wakeup.wait(config.WEBHOOK_POLL_SECONDS)
+      _wakeup.clear()
+
+def start_consumer():
+  global _thread
+  if _thread is None and config.WEBHOOK_CONSUMER_ENABLED:
+    _stop.clear()
+    _thread = threading.Thread(target=_run, name="payment-notification-consumer", daemon=True)
+    _thread.start()
+
+def stop_consumer():
+  global _thread
+  _stop.set()
+  _wakeup.set()
+  if _thread is not None:
+    _thread.join(timeout=5)
+    _thread = None
@@ -0,0 +1,71 @@
+import threading
+import time
+
+import config
+
+class Principal:
+  """Read-only snapshot of an authenticated user, safe to share across requests."""
+  __slots__ = ("id", "username", "role", "branch")
+
+  def __init__(self, id: int, username: str, role: str, branch: str):
+    self.id = id
+    self.username = username
+    self.role = role
+    self.branch = branch
+
+  @classmethod
+  def from_user(cls, user):
+    return cls(user.id, user.username, user.role, user.branch)
+
+class PrincipalCache:
+  """TTL cache of resolved principals keyed by (username, branch database)."""
+  def __init__(self, ttl_seconds: int):
+    self.ttl_seconds = ttl_seconds
+    self._entries: dict[str, dict[str, tuple[Principal, float]]] = {}
+    self._lock = threading.Lock()
+    self.hits = 0
+    self.misses = 0
+    self.invalidations = 0
+
+  def get(self, username: str, branch: str) -> Principal | None:
+    now = time.monotonic()
+    with self._lock:
+      entry = self._entries.get(username, {}).get(branch)
+      if entry is None or entry[1] <= now:
+        self.misses += 1
+        return None
+      self.hits += 1
+      return entry[0]
+
+  def put(self, username: str, branch: str, principal: Principal, token_exp: float | None = None):
+    ttl = self.ttl_seconds
+    if token_exp is not None:
+      # never keep a principal around longer than the token that produced it
+      ttl = min(ttl, token_exp - time.time())
+    if ttl <= 0:
+      return
+    with self._lock:
+      self._entries.setdefault(username, {})[branch] = (principal, time.monotonic() + ttl)
+
+  def invalidate(self, *usernames: str | None):
+    with self._lock:
+      for username in usernames:
+        if username is not None and self._entries.pop(username, None) is not None:
+          self.invalidations += 1
+
+  def clear(self):
+    with self._lock:
+      self._entries.clear()
+
+  def stats(self) -> dict:
+    with self._lock:
+      size = sum(len(branches) for branches in self._entries.values())
+    return {
+      "size": size,
+      "hits": self.hits,
+      "misses": self.misses,
+      "invalidations": self.invalidations,
+      "ttl_seconds": self.ttl_seconds,
+    }
+
+principal_cache = PrincipalCache(config.PRINCIPAL_CACHE_TTL_SECONDS)
@@ -0,0 +1,222 @@
+import collections
+import json
+import logging
+import re
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+
+from sqlalchemy import event
+
+import config
+
+# Per-request SQL instrumentation. Every engine in database.py is registered
+# with instrument(); while instrumentation is enabled, cursor events attribute
+# statement count, DB time and rows to the counter QueryCountMiddleware opens
+# for the request, split by branch. The middleware reports them in
+# Server-Timing (and X-Query-Count when QUERY_COUNT_HEADER is set), can log
+# one JSON line per request, and endpoints marked with @query_budget(n) log an
+# error when they run more than n statements. Statements slower than
+# slow_query_ms go to the "sql.slow" logger with literals and parameters
+# removed. Disabling removes the event listeners, so the only remaining cost
+# is one attribute check per request.
+
+logger = logging.getLogger(__name__)
+slow_logger = logging.getLogger("sql.slow")
+
+QUERY_COUNT_HEADER = "X-Query-Count"
+
+class Settings:
+  def __init__(self):
+    self.enabled = config.SQL_INSTRUMENTATION
+    self.slow_query_ms = config.SQL_SLOW_QUERY_MS
+    self.log_requests = config.SQL_REQUEST_LOG
+
+  def snapshot(self) -> dict:
+    return {"enabled": self.enabled, "slow_query_ms": self.slow_query_ms, "log_requests": self.log_requests}
+
+settings = Settings()
+# recent slow statements, already normalized and redacted
+slow_queries = collections.deque(maxlen=100)
+
+class BranchTotals:
+  __slots__ = ("count", "seconds", "rows")
+
+  def __init__(self):
+    self.count = 0
+    self.seconds = 0.0
+    self.rows = 0
+
+class QueryCounter:
+  def __init__(self):
+    self.count = 0
+    self.seconds = 0.0
+    self.rows = 0
+    self.statements: list[str] = []
+    self.branches: dict[str, BranchTotals] = {}
+
+  def record(self, branch: str, statement: str, seconds: float, rows: int):
+    self.count += 1
+    self.seconds += seconds
+    self.rows += rows
+    self.statements.append(statement)
+    totals = self.branches.get(branch)
+    if totals is None:
+      totals = self.branches[branch] = BranchTotals()
+    totals.count += 1
+    totals.seconds += seconds
+    totals.rows += rows
+
+  def server_timing(self) -> str:
+    parts = [f'db;dur={self.seconds * 1000:.2f};desc="{self.count} queries, {self.rows} rows"']
+    parts.extend(f"db-{branch};dur={totals.seconds * 1000:.2f}" for branch, totals in self.branches.items())
+    return ", ".join(parts)
+
+_current: ContextVar[QueryCounter | None] = ContextVar("query_counter", default=None)
+_current_scope: ContextVar[dict | None] = ContextVar("query_counter_scope", default=None)
+# engine -> branch name, for every engine passed to instrument()
+_engines: dict = {}
+
+_STRING = re.compile(r"'(?:[^']|'')*'")
+_NUMBER = re.compile(r"(?<![\w$])-?\d+(?:\.\d+)?\b")
+_PLACEHOLDER = re.compile(r"%\(\w+\)s|%s|\$\d+|(?<!:):\w+|\?")
+_PLACEHOLDER_LIST = re.compile(r"\(\s*\?(?:\s*,\s*\?)+\s*\)")
+_WHITESPACE = re.compile(r"\s+")
+
+def normalize_sql(statement: str) -> str:
+  """Statement shape without literals or bind values, safe to log for medical data."""
+  sql = _STRING.sub("?", statement)
+  sql = _PLACEHOLDER.sub("?", sql)
+  sql = _NUMBER.sub("?", sql)
+  sql = _PLACEHOLDER_LIST.sub("(?, ...)", sql)
+  return _WHITESPACE.sub(" ", sql).strip()
+
+def _parameter_count(parameters, executemany: bool) -> int:
+  if executemany and parameters:
+    return len(parameters) * len(parameters[0])
+  return len(parameters) if parameters else 0
+
+def _route_template(scope: dict | None) -> str | None:
+  # the template (/patients/{patient_id}) rather than the concrete path
+  if scope is None:
+    return None
+  return getattr(scope.get("route"), "path", scope["path"])
+
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+  if context is not None:
+    context._query_started = time.perf_counter()
+
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+  started = getattr(context, "_query_started", None)
+  if started is None:
+    return
+  seconds = time.perf_counter() - started
+  branch = _engines.get(conn.engine, "?")
+  counter = _current.get()
+  if counter is not None:
+    counter.record(branch, statement, seconds, max(cursor.rowcount, 0))
+  if seconds * 1000 >= settings.slow_query_ms:
+    entry = {
+      "branch": branch,
+      "route": _route_template(_current_scope.get()),
+      "duration_ms": round(seconds * 1000, 2),
+      "sql": normalize_sql(statement),
+      "params": f"<{_parameter_count(parameters, executemany)} redacted>",
+    }
+    slow_queries.append(entry)
+    slow_logger.warning(json.dumps(entry))
+
+def _attach(engine):
+  if not event.contains(engine, "before_cursor_execute", _before_cursor_execute):
+    event.listen(engine, "before_cursor_execute", _before_cursor_execute)
+    event.listen(engine, "after_cursor_execute", _after_cursor_execute)
+
+def _detach(engine):
+  if event.contains(engine, "before_cursor_execute", _before_cursor_execute):
+    event.remove(engine, "before_cursor_execute", _before_cursor_execute)
+    event.remove(engine, "after_cursor_execute", _after_cursor_execute)
+
+def instrument(engine, branch: str):
+  """Register a sync Engine (async_engine.sync_engine for async ones) under its branch name."""
+  _engines[engine] = branch
+  if settings.enabled:
+    _attach(engine)
+
+def configure(enabled: bool | None = None, slow_query_ms: float | None = None, log_requests: bool | None = None) -> dict:
+  """Change instrumentation at runtime; returns the new settings."""
+  if slow_query_ms is not None:
+    settings.slow_query_ms = slow_query_ms
+  if log_requests is not None:
+    settings.log_requests = log_requests
+  if enabled is not None and enabled != settings.enabled:
+    settings.enabled = enabled
+    for engine in _engines:
+      if enabled:
+        _attach(engine)
+      else:
+        _detach(engine)
+  return settings.snapshot()
+
+@contextmanager
+def count_queries():
+  """Count the statements executed in this context (and tasks/threads started from it)."""
+  counter = QueryCounter()
+  token = _current.set(counter)
+  try:
+    yield counter
+  finally:
+    _current.reset(token)
+
+def query_budget(max_queries: int):
+  """Mark an endpoint with the most SQL statements one request may run (auth lookup included)."""
+  def mark(endpoint):
+    endpoint.query_budget = max_queries
+    return endpoint
+  return mark
+
+class QueryCountMiddleware:
+  def __init__(self, app):
+    self.app = app
+
+  async def __call__(self, scope, receive, send):
+    if scope["type"] != "http" or not settings.enabled:
+      return await self.app(scope, receive, send)
+    started = time.perf_counter()
+    status_code = None
+    scope_token = _current_scope.set(scope)
+    with count_queries() as counter:
+      async def send_with_timing(message):
+        nonlocal status_code
+        if message["type"] == "http.response.start":
+          status_code = message["status"]
+          headers = [*message.get("headers", []), (b"server-timing", counter.server_timing().encode())]
+          if config.QUERY_COUNT_HEADER:
+            headers.append((QUERY_COUNT_HEADER.lower().encode(), str(counter.count).encode()))
+          message["headers"] = headers
+        await send(message)
+
+      try:
+        await self.app(scope, receive, send_with_timing)
+      finally:
+        _current_scope.reset(scope_token)
+    route = _route_template(scope)
+    if settings.log_requests:
+      logger.info(json.dumps({
+        "method": scope["method"],
+        "route": route,
+        "status": status_code,
+        "duration_ms": round((time.perf_counter() - started) * 1000, 2),
+        "queries": counter.count,
+        "db_ms": round(counter.seconds * 1000, 2),
+        "rows": counter.rows,
+        "branches": {
+          branch: {"queries": totals.count, "db_ms": round(totals.seconds * 1000, 2), "rows": totals.rows}
+          for branch, totals in counter.branches.items()
+        },
+      }))
+    budget = getattr(scope.get("endpoint"), "query_budget", None)
+    if budget is not None and counter.count > budget:
+      logger.error(
+        "%s %s ran %d SQL statements (budget %d):\n%s",
+        scope["method"], route, counter.count, budget, "\n".join(counter.statements),
+      )
@@ -0,0 +1,241 @@
+"""Reconcile pending payments with Midtrans.
+
+Webhooks get lost, so payments can stay 'pending' after Midtrans settled or
+expired them. reconcile_branch() walks the pending payments of a branch in id
+order (keyset batches on ix_payments_pending), asks the gateway for each
+order's status with bounded concurrency and rate, and applies the results with
+the bulk, forward-only UPDATEs the webhook consumer uses. The last scanned id
+is stored in job_checkpoints after every batch, so an interrupted run resumes
+where it stopped; a completed pass resets it to 0.
+
+    python reconciliation.py                  # one pass over every branch
+    python reconciliation.py --branch central --rate 5
+    python reconciliation.py --loop           # keep running every RECONCILE_INTERVAL_SECONDS (default 300)
+"""
+import argparse
+import asyncio
+import collections
+import json
+import logging
+import time
+from datetime import datetime
+
+from sqlalchemy import select
+
+import config, crud, midtrans, models
+from database import AsyncSessions, async_engines
+
+logger = logging.getLogger(__name__)
+
+CHECKPOINT = "payment_reconciliation"
+
+class RateLimiter:
+  """Spaces acquire() calls at least 1/rate seconds apart."""
+  def __init__(self, rate: float):
+    self.interval = 1 / rate if rate > 0 else 0.0
+    self._next = 0.0
+    self._lock = asyncio.Lock()
+
+  async def acquire(self):
+    async with self._lock:
+      now = time.monotonic()
+      wait = self._next - now
+      self._next = max(now, self._next) + self.interval
+    if wait > 0:
+      await asyncio.sleep(wait)
+
+class ReconcileStats:
+  def __init__(self):
+    self.runs = 0
+    self.scanned = 0
+    self.updated = 0
+    self.gateway_calls = 0
+    self.gateway_errors = 0
+    self.last_run = None
+    # recent gateway latencies for the percentiles
+    self._latencies = collections.deque(maxlen=1000)
+
+  def record_latency(self, seconds: float):
+    self.gateway_calls += 1
+    self._latencies.append(seconds)
+
+  def snapshot(self) -> dict:
+    latencies = sorted(self._latencies)
+
+    def percentile(p):
+      return round(latencies[min(len(latencies) - 1, int(p * len(latencies)))], 4) if latencies else None
+
+    return {
+      "runs": self.runs,
+      "scanned": self.scanned,
+      "updated": self.updated,
+      "gateway_calls": self.gateway_calls,
+      "gateway_errors": self.gateway_errors,
+      "gateway_latency_p50": percentile(0.5),
+      "gateway_latency_p95": percentile(0.95),
+      "gateway_latency_max": round(latencies[-1], 4) if latencies else None,
+      "last_run": self.last_run,
+    }
+
+stats = ReconcileStats()
+_task = None
+
+async def _load_checkpoint(db) -> int:
+  checkpoint = await db.get(models.JobCheckpoint, CHECKPOINT)
+  return checkpoint.position if checkpoint else 0
+
+async def _save_checkpoint(db, position: int):
+  checkpoint = await db.get(models.JobCheckpoint, CHECKPOINT)
+  if checkpoint is None:
+    db.add(models.JobCheckpoint(name=CHECKPOINT, position=position))
+  else:
+    checkpoint.position = position
+    checkpoint.updated_at = datetime.utcnow()
+  await db.commit()
+
+async def _pending_batch(db, after: int, limit: int):
+  rows = await db.execute(
+    select(models.Payment.id, models.Payment.transaction_id)
+    .where(models.Payment.status == 'pending', models.Payment.transaction_id.is_not(None), models.Payment.id > after)
+    .order_by(models.Payment.id)
+    .limit(limit)
+  )
+  return rows.all()
+
+async def _gateway_status(payment_id: int, limiter: RateLimiter, semaphore: asyncio.Semaphore) -> dict | None:
+  async with semaphore:
+    await limiter.acquire()
+    start = time.perf_counter()
+    try:
+      return await midtrans.gateway.transaction_status(f"PAY-{payment_id}")
+    except midtrans.MidtransError:
+      # unknown order (e.g. created without the gateway) or rejected lookup
+      stats.gateway_errors += 1
+      return None
+    except midtrans.GatewayUnavailable:
+      stats.gateway_errors += 1
+      raise
+    finally:
+      stats.record_latency(time.perf_counter() - start)
+
+async def reconcile_branch(
+  branch: str,
+  batch_size: int | None = None,
+  concurrency: int | None = None,
+  rate: float | None = None,
+) -> dict:
+  """One pass over the pending payments of a branch, resuming from its checkpoint."""
+  batch_size = batch_size or config.RECONCILE_BATCH_SIZE
+  limiter = RateLimiter(rate or config.RECONCILE_RATE_PER_SECOND)
+  semaphore = asyncio.Semaphore(concurrency or config.RECONCILE_CONCURRENCY)
+  started = time.perf_counter()
+  scanned = updated = 0
+  async with AsyncSessions[branch]() as db:
+    after = await _load_checkpoint(db)
+    while True:
+      batch = await _pending_batch(db, after, batch_size)
+      # no transaction is held open while waiting on the gateway
+      await db.commit()
+      if not batch:
+        break
+      responses = await asyncio.gather(
+        *(_gateway_status(row.id, limiter, semaphore) for row in batch), return_exceptions=True,
+      )
+      updates = {}
+      failure = None
+      for row, response in zip(batch, responses):
+        if isinstance(response, BaseException):
+          failure = failure or response
+          continue
+        if response is None:
+          continue
+        status = midtrans.internal_status(response.get('transaction_status'), response.get('fraud_status'))
+        if status != 'pending':
+          updates[row.transaction_id] = status
+      for stmt in crud.payment_status_statements(updates):
+        updated += len((await db.scalars(stmt)).all())
+      if failure is not None:
+        # keep what was learned but leave the checkpoint before this batch
+        await db.commit()
+        stats.updated += updated
+        raise failure
+      after = batch[-1].id
+      await _save_checkpoint(db, after)
+      scanned += len(batch)
+      if len(batch) < batch_size:
+        break
+    await _save_checkpoint(db, 0)
+  elapsed = time.perf_counter() - started
+  stats.scanned += scanned
+  stats.updated += updated
+  return {
+    "branch": branch,
+    "scanned": scanned,
+    "updated": updated,
+    "seconds": round(elapsed, 3),
+    "rows_per_second": round(scanned / elapsed, 1) if elapsed else 0.0,
+  }
+
+async def reconcile_all(**options) -> list[dict]:
+  """Reconcile every branch; a branch whose gateway calls fail keeps its checkpoint for the next run."""
+  results = []
+  for branch in AsyncSessions:
+    try:
+      results.append(await reconcile_branch(branch, **options))
+    except midtrans.GatewayUnavailable as e:
+      logger.warning("reconciliation of %s stopped: %s", branch, e)
+      results.append({"branch": branch, "error": str(e)})
+  stats.runs += 1
+  stats.last_run = {"finished_at": datetime.utcnow().isoformat(), "branches": results}
+  return results
+
+async def _run(interval: float):
+  while True:
+    try:
+      await reconcile_all()
+    except Exception:
+      logger.exception("payment reconciliation failed")
+    await asyncio.sleep(interval)
+
+def start_worker():
+  """Run reconcile_all every RECONCILE_INTERVAL_SECONDS on the app's event loop (0 disables it)."""
+  global _task
+  if _task is None and config.RECONCILE_INTERVAL_SECONDS > 0:
+    _task = asyncio.get_running_loop().create_task(_run(config.RECONCILE_INTERVAL_SECONDS))
+
+async def stop_worker():
+  global _task
+  if _task is not None:
+    _task.cancel()
+    try:
+      await _task
+    except asyncio.CancelledError:
+      pass
+    _task = None
+
+async def _main(args):
+  options = {"batch_size": args.batch_size, "concurrency": args.concurrency, "rate": args.rate}
+  try:
+    while True:
+      if args.branch:
+        results = [await reconcile_branch(args.branch, **options)]
+      else:
+        results = await reconcile_all(**options)
+      print(json.dumps({"results": results, "stats": stats.snapshot()}, indent=2))
+      if not args.loop:
+        break
+      await asyncio.sleep(config.RECONCILE_INTERVAL_SECONDS or 300)
+  finally:
+    await midtrans.gateway.aclose()
+    for engine in async_engines.values():
+      await engine.dispose()
+
+if __name__ == "__main__":
+  parser = argparse.ArgumentParser(description="Reconcile pending payments with Midtrans")
+  parser.add_argument("--branch", help="only this branch (default: all)")
+  parser.add_argument("--batch-size", type=int)
+  parser.add_argument("--concurrency", type=int)
+  parser.add_argument("--rate", type=float, help="gateway calls per second")
+  parser.add_argument("--loop", action="store_true")
+  logging.basicConfig(level=logging.INFO)
+  asyncio.run(_main(parser.parse_args()))
@@ -0,0 +1,104 @@
+"""Refresh tokens: renew an access token without another (argon2) password login.
+
+A refresh token is "<branch>.<secret>". The branch names the database that
+holds the account and the token's SHA-256 hash, so POST /token/refresh goes
+straight there. Each login starts a token family. Every refresh revokes the
+token it was given and returns a new one from the same family. If a token
+that was already used comes back, it must have been copied, so the whole
+family is revoked. Changing a user's password or deleting the user revokes
+all of that user's tokens (crud.py).
+"""
+import hashlib
+import secrets
+from datetime import datetime, timedelta
+
+from sqlalchemy import delete, select, update
+
+import config, models
+from database import AsyncSessions
+
+class InvalidRefreshToken(Exception):
+  """Unknown, expired, revoked or reused refresh token."""
+
+  def __init__(self, reason: str):
+    super().__init__(reason)
+    self.reason = reason
+
+def _hash(secret: str) -> str:
+  return hashlib.sha256(secret.encode()).hexdigest()
+
+def _parse(token: str) -> tuple[str, str]:
+  branch, _, secret = token.partition(".")
+  if not secret or branch not in AsyncSessions:
+    raise InvalidRefreshToken("invalid")
+  return branch, secret
+
+async def issue(db, branch: str, user_id: int, family: str | None = None) -> str:
+  """Add a refresh token to db's transaction; the caller commits."""
+  now = datetime.utcnow()
+  if family is None:
+    family = secrets.token_hex(16)
+    # a new login is a good moment to drop this user's dead tokens
+    await db.execute(delete(models.RefreshToken).where(
+      models.RefreshToken.user_id == user_id, models.RefreshToken.expires_at <= now,
+    ))
+  secret = secrets.token_urlsafe(32)
+  db.add(models.RefreshToken(
+    token_hash=_hash(secret),
+    family=family,
+    user_id=user_id,
+    created_at=now,
+    expires_at=now + timedelta(days=config.REFRESH_TOKEN_EXPIRE_DAYS),
+  ))
+  return f"{branch}.{secret}"
+
+async def _revoke_family(db, family: str, now: datetime):
+  await db.execute(
+    update(models.RefreshToken)
+    .where(models.RefreshToken.family == family, models.RefreshToken.revoked_at.is_(None))
+    .values(revoked_at=now)
+  )
+
+async def rotate(token: str):
+  """Exchange a refresh token for a new one; returns (user, branch, new token)."""
+  branch, secret = _parse(token)
+  now = datetime.utcnow()
+  async with AsyncSessions[branch]() as db:
+    row = await db.scalar(select(models.RefreshToken).where(models.RefreshToken.token_hash == _hash(secret)))
+    if row is None:
+      raise InvalidRefreshToken("invalid")
+    # conditional update, so two concurrent refreshes cannot both succeed
+    claimed = await db.execute(
+      update(models.RefreshToken)
+      .where(models.RefreshToken.id == row.id, models.RefreshToken.revoked_at.is_(None))
+      .values(revoked_at=now)
+    )
+    if claimed.rowcount != 1:
+      await _revoke_family(db, row.family, now)
+      await db.commit()
+      raise InvalidRefreshToken("revoked")
+    if row.expires_at <= now:
+      await db.commit()
+      raise InvalidRefreshToken("expired")
+    user = await db.get(models.User, row.user_id)
+    if user is None:
+      await db.commit()
+      raise InvalidRefreshToken("invalid")
+    new_token = await issue(db, branch, user.id, family=row.family)
+    await db.commit()
+  return user, branch, new_token
+
+async def revoke(token: str):
+  """Log out: revoke the token's whole family. Unknown tokens are ignored."""
+  branch, secret = _parse(token)
+  async with AsyncSessions[branch]() as db:
+    row = await db.scalar(select(models.RefreshToken).where(models.RefreshToken.token_hash == _hash(secret)))
+    if row is not None:
+      await _revoke_family(db, row.family, datetime.utcnow())
+      await db.commit()
+
+def revoke_user(db, user_id: int):
+  """Revoke all of a user's refresh tokens in db's (sync) transaction; the caller commits."""
+  db.query(models.RefreshToken).filter(
+    models.RefreshToken.user_id == user_id, models.RefreshToken.revoked_at.is_(None),
+  ).update({models.RefreshToken.revoked_at: datetime.utcnow()}, synchronize_session=False)
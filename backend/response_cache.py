@@ -0,0 +1,251 @@
+import collections
+import hashlib
+import json
+import logging
+import threading
+import time
+
+from fastapi import Request, Response, status
+from fastapi.concurrency import run_in_threadpool
+from pydantic import TypeAdapter
+
+import config, metrics
+from pagination import NEXT_CURSOR_HEADER
+
+# Read-through cache for list endpoints whose data rarely changes (doctor and
+# staff lists, patient and appointment pages). Entries are keyed by route
+# template, routed branch, query parameters and caller role, plus the current
+# generation of every namespace the response depends on ("users",
+# "patients", "appointments"). The crud writers call invalidate(namespace),
+# which bumps that generation: older keys are never read again and age out of
+# the LRU/TTL. With a shared backend (RESPONSE_CACHE_URL=redis://...) the
+# generations live there too, so a write on one worker invalidates all of
+# them. Every cached response carries an ETag; a matching If-None-Match gets
+# 304 without a body.
+
+logger = logging.getLogger(__name__)
+
+CACHE_REQUESTS = metrics.Counter(
+  "response_cache_requests_total", "Cached endpoint lookups by result (hit, miss, not_modified).", ("namespace", "result"),
+)
+
+class CachedResponse:
+  __slots__ = ("etag", "body", "headers")
+
+  def __init__(self, etag: str, body: bytes, headers: dict[str, str]):
+    self.etag = etag
+    self.body = body
+    self.headers = headers
+
+  def to_bytes(self) -> bytes:
+    return json.dumps({"etag": self.etag, "headers": self.headers}).encode() + b"\n" + self.body
+
+  @classmethod
+  def from_bytes(cls, data: bytes) -> "CachedResponse":
+    meta, body = data.split(b"\n", 1)
+    meta = json.loads(meta)
+    return cls(meta["etag"], body, meta["headers"])
+
+class MemoryBackend:
+  """Per-process LRU with a TTL per entry."""
+  blocking = False
+
+  def __init__(self, max_entries: int):
+    self.max_entries = max_entries
+    self._entries: collections.OrderedDict[str, tuple[CachedResponse, float]] = collections.OrderedDict()
+    self._generations: dict[str, int] = {}
+    self._lock = threading.Lock()
+
+  def get(self, key: str) -> CachedResponse | None:
+    now = time.monotonic()
+    with self._lock:
+      entry = self._entries.get(key)
+      if entry is None:
+        return None
+      if entry[1] <= now:
+        del self._entries[key]
+        return None
+      self._entries.move_to_end(key)
+      return entry[0]
+
+  def set(self, key: str, value: CachedResponse, ttl: float):
+    with self._lock:
+      self._entries[key] = (value, time.monotonic() + ttl)
+      self._entries.move_to_end(key)
+      while len(self._entries) > self.max_entries:
+        self._entries.popitem(last=False)
+
+  def generations(self, namespaces: tuple[str, ...]) -> list[int]:
+    return [self._generations.get(namespace, 0) for namespace in namespaces]
+
+  def bump(self, namespace: str):
+    with self._lock:
+      self._generations[namespace] = self._generations.get(namespace, 0) + 1
+
+  def clear(self):
+    with self._lock:
+      self._entries.clear()
+
+  def size(self) -> int:
+    return len(self._entries)
+
+class RedisBackend:
+  """Shared backend for several workers/hosts; needs the optional `redis` package."""
+  blocking = True
+  PREFIX = "response-cache:"
+
+  def __init__(self, url: str):
+    import redis
+    self._redis = redis.Redis.from_url(url, socket_timeout=1)
+
+  def get(self, key: str) -> CachedResponse | None:
+    data = self._redis.get(self.PREFIX + key)
+    return CachedResponse.from_bytes(data) if data is not None else None
+
+  def set(self, key: str, value: CachedResponse, ttl: float):
+    self._redis.set(self.PREFIX + key, value.to_bytes(), px=int(ttl * 1000))
+
+  def generations(self, namespaces: tuple[str, ...]) -> list[int]:
+    return [int(value or 0) for value in self._redis.mget([f"{self.PREFIX}gen:{ns}" for ns in namespaces])]
+
+  def bump(self, namespace: str):
+    self._redis.incr(f"{self.PREFIX}gen:{namespace}")
+
+  def clear(self):
+    for key in self._redis.scan_iter(self.PREFIX + "*"):
+      if b":gen:" not in key:
+        self._redis.delete(key)
+
+  def size(self) -> int | None:
+    return None
+
+def create_backend(url: str):
+  if not url or url == "memory":
+    return MemoryBackend(config.RESPONSE_CACHE_MAX_ENTRIES)
+  if url.startswith(("redis://", "rediss://", "unix://")):
+    return RedisBackend(url)
+  raise ValueError(f"Unsupported RESPONSE_CACHE_URL: {url}")
+
+class CacheKey:
+  __slots__ = ("namespaces", "value")
+
+  def __init__(self, namespaces: tuple[str, ...], value: str):
+    self.namespaces = namespaces
+    self.value = value
+
+_adapters: dict = {}
+
+def encode_list(schema, rows) -> bytes:
+  """JSON for a list response, as FastAPI would render response_model=list[schema]."""
+  adapter = _adapters.get(schema)
+  if adapter is None:
+    adapter = _adapters[schema] = TypeAdapter(list[schema])
+  return adapter.dump_json(adapter.validate_python(rows, from_attributes=True))
+
+def _etag(body: bytes) -> str:
+  return '"' + hashlib.sha256(body).hexdigest()[:32] + '"'
+
+def _not_modified(request: Request, etag: str) -> bool:
+  header = request.headers.get("if-none-match")
+  if not header:
+    return False
+  return header.strip() == "*" or etag in (tag.strip().removeprefix("W/") for tag in header.split(","))
+
+class ResponseCache:
+  def __init__(self, backend, ttl_seconds: float, enabled: bool = True):
+    self.backend = backend
+    self.ttl_seconds = ttl_seconds
+    self.enabled = enabled
+
+  def key(self, request: Request, namespaces: tuple[str, ...], principal) -> CacheKey | None:
+    """Cache key for this request; read it before loading the data so a concurrent write is never cached as current."""
+    if not self.enabled:
+      return None
+    route = getattr(request.scope.get("route"), "path", request.url.path)
+    params = sorted((k, v) for k, v in request.query_params.multi_items() if k != "branch")
+    try:
+      generations = self.backend.generations(namespaces)
+    except Exception:
+      # a shared backend that is down only costs the cache, not the request
+      logger.exception("response cache unavailable")
+      return None
+    parts = {
+      "route": route,
+      # the database actually read, which defaults to the caller's branch (database.get_branch)
+      "branch": getattr(request.state, "branch", None) or request.query_params.get("branch", "central").lower(),
+      "params": params,
+      "role": getattr(principal, "role", None),
+      "generations": generations,
+    }
+    digest = hashlib.sha256(json.dumps(parts, sort_keys=True).encode()).hexdigest()
+    return CacheKey(namespaces, digest)
+
+  def _response(self, request: Request, entry: CachedResponse, namespace: str, hit: bool) -> Response:
+    headers = {"ETag": entry.etag, "Cache-Control": "private, no-cache", "Vary": "Authorization"}
+    if _not_modified(request, entry.etag):
+      CACHE_REQUESTS.labels(namespace, "not_modified").inc()
+      return Response(status_code=status.HTTP_304_NOT_MODIFIED, headers=headers)
+    CACHE_REQUESTS.labels(namespace, "hit" if hit else "miss").inc()
+    return Response(content=entry.body, media_type="application/json", headers={**headers, **entry.headers})
+
+  def lookup(self, request: Request, key: CacheKey | None) -> Response | None:
+    if key is None:
+      return None
+    try:
+      entry = self.backend.get(key.value)
+    except Exception:
+      logger.exception("response cache unavailable")
+      return None
+    return self._response(request, entry, key.namespaces[0], hit=True) if entry is not None else None
+
+  def store(self, request: Request, key: CacheKey | None, body: bytes, next_cursor=None) -> Response:
+    """Cache a freshly built JSON body and answer with it (or 304 when the client already has it)."""
+    headers = {NEXT_CURSOR_HEADER: str(next_cursor)} if next_cursor is not None else {}
+    entry = CachedResponse(_etag(body), body, headers)
+    if key is not None:
+      try:
+        self.backend.set(key.value, entry, self.ttl_seconds)
+      except Exception:
+        logger.exception("response cache unavailable")
+    return self._response(request, entry, key.namespaces[0] if key else "-", hit=False)
+
+  # async routes must not block the event loop on a network backend
+  async def key_async(self, request: Request, namespaces: tuple[str, ...], principal) -> CacheKey | None:
+    if self.backend.blocking:
+      return await run_in_threadpool(self.key, request, namespaces, principal)
+    return self.key(request, namespaces, principal)
+
+  async def lookup_async(self, request: Request, key: CacheKey | None) -> Response | None:
+    if key is not None and self.backend.blocking:
+      return await run_in_threadpool(self.lookup, request, key)
+    return self.lookup(request, key)
+
+  async def store_async(self, request: Request, key: CacheKey | None, body: bytes, next_cursor=None) -> Response:
+    if key is not None and self.backend.blocking:
+      return await run_in_threadpool(self.store, request, key, body, next_cursor)
+    return self.store(request, key, body, next_cursor)
+
+  def invalidate(self, *namespaces: str):
+    for namespace in namespaces:
+      try:
+        self.backend.bump(namespace)
+      except Exception:
+        # the write already committed; stale entries expire after ttl_seconds
+        logger.exception("could not invalidate %s in the response cache", namespace)
+
+  def stats(self) -> dict:
+    return {
+      "enabled": self.enabled,
+      "backend": type(self.backend).__name__,
+      "size": self.backend.size(),
+      "ttl_seconds": self.ttl_seconds,
+    }
+
+response_cache = ResponseCache(
+  create_backend(config.RESPONSE_CACHE_URL),
+  config.RESPONSE_CACHE_TTL_SECONDS,
+  enabled=config.RESPONSE_CACHE_TTL_SECONDS > 0,
+)
+
+def invalidate(*namespaces: str):
+  response_cache.invalidate(*namespaces)
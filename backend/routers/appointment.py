@@ -1,8 +1,13 @@
-from fastapi import APIRouter, Depends, HTTPException, status
-from sqlalchemy.orm import Session
-import models, crud, schemas
-from auth import require_role
-from database import get_db
+from datetime import datetime
+from fastapi import APIRouter, Depends, HTTPException, Query, Request, status
+from fastapi.concurrency import run_in_threadpool
+from sqlalchemy.ext.asyncio import AsyncSession
+import models, async_crud, schemas, federation, scheduling, config
+from auth import require_role_async
+from database import federated_reads, get_async_db, parse_branches
+from pagination import PageParams, ndjson_response
+from querycount import query_budget
+from response_cache import encode_list, response_cache
 
 router = APIRouter(
   prefix="/appointments",
@@ -10,46 +15,101 @@ router = APIRouter(
 )
 
 @router.post("/",response_model=schemas.AppointmentOut)
-def create_appointment(
+async def create_appointment(
   appointment_data : schemas.AppointmentCreate,
-  db: Session=Depends(get_db),
-  current_user = Depends(require_role(['staff','admin']))
+  db: AsyncSession = Depends(get_async_db),
+  current_user = Depends(require_role_async(['staff','admin']))
 ):
-  return crud.create_appointment(db, appointment_data)
+  try:
+    return await async_crud.create_appointment(db, appointment_data)
+  except scheduling.ScheduleConflict as e:
+    raise HTTPException(status_code=status.HTTP_409_CONFLICT, detail=str(e))
+
+@router.get("/availability",response_model=schemas.DoctorAvailability)
+async def doctor_availability(
+  doctor_id: int,
+  start: datetime = Query(..., alias="from"),
+  end: datetime = Query(..., alias="to"),
+  duration: int = Query(30, ge=5, le=config.APPOINTMENT_MAX_MINUTES, description="Panjang slot minimum (menit)"),
+  db: AsyncSession = Depends(get_async_db),
+  current_user = Depends(require_role_async(['staff','admin','doctor']))
+):
+  # naive UTC like scheduled_at, so mixed naive/aware bounds compare
+  start, end = scheduling.normalize(start), scheduling.normalize(end)
+  if end <= start or end - start > scheduling.MAX_WINDOW:
+    raise HTTPException(
+      status_code=400,
+      detail=f"'to' must be after 'from' and at most {scheduling.MAX_WINDOW.days} days later"
+    )
+  free = await async_crud.get_doctor_availability(db, doctor_id, start, end, duration)
+  return {"doctor_id": doctor_id, "start": start, "end": end, "free": [{"start": s, "end": e} for s, e in free]}
 
 @router.get("/",response_model=list[schemas.AppointmentOut])
-def list_appointments(
-  db: Session=Depends(get_db),
-  current_user = Depends(require_role(['doctor','admin']))
+@federated_reads
+async def list_appointments(
+  request: Request,
+  page: PageParams = Depends(),
+  branch: str | None = Query(None, description="Nama branch (khusus admin), '*' atau daftar dipisah koma untuk semua/beberapa branch; default branch dari token"),
+  db: AsyncSession = Depends(get_async_db),
+  current_user = Depends(require_role_async(['doctor','admin'], claims_only=True))
+):
+  branches = parse_branches(branch) if branch else None
+  if branches is not None:
+    return await run_in_threadpool(federation.list_keyset, branches, models.Appointment, schemas.AppointmentOut, limit=page.limit, after=page.after)
+  if page.stream:
+    return ndjson_response(async_crud.iter_appointments(db, after=page.after, limit=page.limit), schemas.AppointmentOut)
+  key = await response_cache.key_async(request, ("appointments",), current_user)
+  cached = await response_cache.lookup_async(request, key)
+  if cached is not None:
+    return cached
+  appointments, next_cursor = await async_crud.get_appointments(db, limit=page.limit, after=page.after)
+  return await response_cache.store_async(request, key, encode_list(schemas.AppointmentOut, appointments), next_cursor)
+
+@router.get("/{appointment_id}",response_model=schemas.AppointmentDetail)
+@query_budget(4)
+async def get_appointment(
+  appointment_id: int,
+  db: AsyncSession = Depends(get_async_db),
+  current_user = Depends(require_role_async(['doctor','admin','staff']))
 ):
-  return crud.get_appointments(db)
+  """Appointment with its patient, doctor, medical record and payment (with items)."""
+  db_appointment = await async_crud.get_appointment_detail(db, appointment_id)
+  if not db_appointment:
+    raise HTTPException(
+      status_code=404,
+      detail='Appointment not found'
+    )
+  return db_appointment
 
 @router.put("/{appointment_id}",response_model=schemas.AppointmentOut)
-def update_appointment(
+async def update_appointment(
   appointment_id : int,
   appointment_data: schemas.AppointmentCreate,
-  db:Session = Depends(get_db),
-  current_user = Depends(require_role(['admin','staff']))
+  db:AsyncSession = Depends(get_async_db),
+  current_user = Depends(require_role_async(['admin','staff']))
 ):
-  db_appointment = crud.get_appointment_by_id(db,appointment_id)
+  db_appointment = await async_crud.get_appointment_by_id(db,appointment_id)
   if not db_appointment:
     raise HTTPException(
       status_code=404,
       detail='Appointment not found'
     )
-  return crud.update_appointment(db,db_appointment,appointment_data)
+  try:
+    return await async_crud.update_appointment(db,db_appointment,appointment_data)
+  except scheduling.ScheduleConflict as e:
+    raise HTTPException(status_code=status.HTTP_409_CONFLICT, detail=str(e))
 
 @router.delete("/{appointment_id}",status_code=status.HTTP_204_NO_CONTENT)
-def delete_appointment(
+async def delete_appointment(
   appointment_id: int,
-  db: Session = Depends(get_db),
-  current_user = Depends(require_role(['admin']))
+  db: AsyncSession = Depends(get_async_db),
+  current_user = Depends(require_role_async(['admin']))
 ):
-  db_appointment = crud.get_appointment_by_id(db, appointment_id)
+  db_appointment = await async_crud.get_appointment_by_id(db, appointment_id)
   if not db_appointment:
     raise HTTPException(
       status_code=404,
       detail='Appointment not found'
     )
-  crud.delete_appointment(db, db_appointment)
+  await async_crud.delete_appointment(db, db_appointment)
   return {'message':'Appointment deleted successfully'}
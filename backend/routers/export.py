@@ -0,0 +1,46 @@
+from datetime import datetime
+from typing import Literal
+from fastapi import APIRouter, Depends, HTTPException, Query
+from fastapi.responses import StreamingResponse
+import exports
+import scheduling
+from auth import require_role_async
+from database import Sessions, federated_reads, get_branch, parse_branches
+
+router = APIRouter(
+  prefix="/exports",
+  tags=["Exports"]
+)
+
+@router.get("/{dataset}")
+@federated_reads
+async def export_dataset(
+  dataset: Literal["patients", "appointments", "medical_records", "payments", "payment_items"],
+  format: Literal["csv", "ndjson", "parquet"] = "csv",
+  branch: str | None = Query(None, description="Nama branch (khusus admin), '*' atau daftar dipisah koma untuk semua/beberapa branch; default branch dari token"),
+  start: datetime | None = Query(None, alias="from", description="Mulai (inklusif)"),
+  end: datetime | None = Query(None, alias="to", description="Sampai (eksklusif)"),
+  routed: str = Depends(get_branch),
+  current_user = Depends(require_role_async(['admin']))
+):
+  """Stream a full extract of one table; memory stays bounded whatever the size."""
+  if (start is not None or end is not None) and exports.DATASETS[dataset].date_column is None:
+    raise HTTPException(status_code=400, detail=f"'{dataset}' has no date column to filter on")
+  # date columns are naive UTC; comparing them with an aware bound, or an aware
+  # bound with a naive one, fails in the query instead of with a 400 here
+  start = scheduling.normalize(start) if start is not None else None
+  end = scheduling.normalize(end) if end is not None else None
+  if start is not None and end is not None and end <= start:
+    raise HTTPException(status_code=400, detail="'to' must be after 'from'")
+  branches = (parse_branches(branch) if branch else None) or [routed]
+  try:
+    chunks = exports.export(dataset, format, branches, start, end)
+  except exports.ExportUnavailable as e:
+    raise HTTPException(status_code=400, detail=str(e))
+  media_type, extension = exports.FORMATS[format]
+  label = "all" if len(branches) == len(Sessions) and len(branches) > 1 else "-".join(branches)
+  return StreamingResponse(
+    chunks,
+    media_type=media_type,
+    headers={"Content-Disposition": f'attachment; filename="{dataset}-{label}.{extension}"'},
+  )
@@ -1,8 +1,11 @@
-from fastapi import APIRouter, Depends, HTTPException
+from datetime import datetime
+from fastapi import APIRouter, Depends, HTTPException, Query, Response
 from sqlalchemy.orm import Session
 from database import get_db
 import models, schemas, crud
 from auth import require_role
+from pagination import MAX_PAGE_SIZE, parse_timeline_cursor, set_next_cursor
+from querycount import query_budget
 
 router = APIRouter(
   prefix="/medical_records",
@@ -19,6 +22,7 @@ def create_medical_record(record: schemas.MedicalRecordCreate,db: Session = Depe
   return crud.create_medical_record(db, record)
 
 @router.get("/patient/{patient_id}", response_model=list[schemas.MedicalRecord])
+@query_budget(2)
 def get_medical_records(patient_id: int, db: Session= Depends(get_db), current_user: models.User=Depends(require_role(['doctor']))):
   records = crud.get_medical_records_by_patient(db,patient_id)
   if not records:
@@ -27,3 +31,22 @@ def get_medical_records(patient_id: int, db: Session= Depends(get_db), current_u
       detail='No medical records found for this patient'
     )
   return records
+
+@router.get("/patient/{patient_id}/timeline", response_model=list[schemas.MedicalRecordEntry], response_model_exclude_unset=True)
+@query_budget(2)
+def get_medical_record_timeline(
+  patient_id: int,
+  response: Response,
+  limit: int | None = Query(None, ge=1, le=MAX_PAGE_SIZE, description="Jumlah maksimum baris per halaman"),
+  cursor: str | None = Query(None, description="Nilai X-Next-Cursor dari halaman sebelumnya"),
+  start: datetime | None = Query(None, alias="from", description="Mulai (inklusif)"),
+  end: datetime | None = Query(None, alias="to", description="Sampai (eksklusif)"),
+  full: bool = Query(False, description="Sertakan diagnosis, treatment dan notes"),
+  db: Session = Depends(get_db),
+  current_user: models.User = Depends(require_role(['doctor'], claims_only=True))
+):
+  """A patient's records newest first, one keyset page at a time."""
+  before = parse_timeline_cursor(cursor) if cursor is not None else None
+  records, next_cursor = crud.get_medical_record_timeline(db, patient_id, limit=limit, before=before, start=start, end=end, full=full)
+  set_next_cursor(response, next_cursor)
+  return records
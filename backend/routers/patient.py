@@ -1,8 +1,12 @@
-from fastapi import APIRouter, Depends, HTTPException, Query
-from sqlalchemy.orm import Session
-import schemas, crud
-from auth import require_role
-from database import Sessions, get_db
+from fastapi import APIRouter, Depends, HTTPException, Query, Request
+from fastapi.concurrency import run_in_threadpool
+from sqlalchemy.ext.asyncio import AsyncSession
+import schemas, async_crud, models, federation, patient_import, patient_index, patient_search
+from auth import require_role_async
+from database import federated_reads, get_async_db, parse_branches
+from pagination import PageParams, ndjson_response
+from querycount import query_budget
+from response_cache import encode_list, response_cache
 
 router = APIRouter(
   prefix="/patients",
@@ -10,46 +14,153 @@ router = APIRouter(
 )
 
 @router.post("/",response_model=schemas.PatientOut)
-def create_patient(
+async def create_patient(
     patient: schemas.PatientCreate,
-    db: Session=Depends(get_db),
-    current_user = Depends(require_role(['admin','staff']))
+    db: AsyncSession = Depends(get_async_db),
+    current_user = Depends(require_role_async(['admin','staff']))
 ):
-   return crud.create_patient(db, patient)
+   return await async_crud.create_patient(db, patient)
+
+@router.post("/import",response_model=schemas.PatientImportReport)
+async def import_patients(
+   request: Request,
+   format: str | None = Query(None, pattern="^(csv|ndjson)$", description="Format file; default dari Content-Type (CSV bila tidak dikenal)"),
+   db: AsyncSession = Depends(get_async_db),
+   current_user = Depends(require_role_async(['admin','staff']))
+):
+   """Bulk-load patients from a CSV (header: name,national_id,phone,address) or NDJSON request body."""
+   if format is None:
+      content_type = request.headers.get("content-type", "")
+      format = "ndjson" if "ndjson" in content_type or "jsonl" in content_type else "csv"
+   try:
+      return await patient_import.import_patients(db, request.stream(), format)
+   except patient_import.ImportFormatError as e:
+      raise HTTPException(status_code=400, detail=str(e))
 
 @router.get("/",response_model=list[schemas.PatientOut])
-def list_patients(
-   db: Session=Depends(get_db),
-   current_user=Depends(require_role(['admin','doctor']))
+@federated_reads
+async def list_patients(
+   request: Request,
+   page: PageParams = Depends(),
+   branch: str | None = Query(None, description="Nama branch (khusus admin), '*' atau daftar dipisah koma untuk semua/beberapa branch; default branch dari token"),
+   db: AsyncSession = Depends(get_async_db),
+   current_user=Depends(require_role_async(['admin','doctor'], claims_only=True))
+):
+   branches = parse_branches(branch) if branch else None
+   if branches is not None:
+      return await run_in_threadpool(federation.list_keyset, branches, models.Patient, schemas.PatientOut, limit=page.limit, after=page.after)
+   if page.stream:
+      return ndjson_response(async_crud.iter_patients(db, after=page.after, limit=page.limit), schemas.PatientOut)
+   key = await response_cache.key_async(request, ("patients",), current_user)
+   cached = await response_cache.lookup_async(request, key)
+   if cached is not None:
+      return cached
+   patients, next_cursor = await async_crud.get_patients(db, limit=page.limit, after=page.after)
+   return await response_cache.store_async(request, key, encode_list(schemas.PatientOut, patients), next_cursor)
+
+@router.get("/search",response_model=list[schemas.PatientOut])
+async def search_patients(
+   q: str = Query(..., min_length=2, max_length=100, description="Nama, NIK atau nomor telepon (awalan atau mirip)"),
+   limit: int = Query(20, ge=1, le=patient_search.MAX_RESULTS),
+   db: AsyncSession = Depends(get_async_db),
+   current_user=Depends(require_role_async(['admin','staff','doctor'], claims_only=True))
+):
+   return await async_crud.search_patients(db, q, limit)
+
+@router.get("/branches",response_model=schemas.MasterPatient)
+async def find_patient_records(
+   national_id: str = Query(..., min_length=1, max_length=32, description="NIK pasien"),
+   current_user=Depends(require_role_async(['admin','staff','doctor'], claims_only=True))
+):
+   """Every branch record of the person with this national_id, from the master patient index."""
+   master = await patient_index.find(national_id)
+   if master is None:
+      raise HTTPException(
+         status_code=404,
+         detail='Patient not found in the master patient index'
+      )
+   return master
+
+async def _master_patient(request: Request, db: AsyncSession, patient_id: int):
+   branch = request.state.branch
+   master = await patient_index.locate(branch, patient_id)
+   if master is None:
+      # not linked yet, e.g. saved while the index database was down
+      db_patient = await async_crud.get_patient_by_id(db, patient_id)
+      if not db_patient:
+         raise HTTPException(
+            status_code=404,
+            detail='Patient not found'
+         )
+      await patient_index.link_async(branch, [db_patient])
+      master = await patient_index.locate(branch, patient_id)
+   return master
+
+@router.get("/{patient_id}/branches",response_model=schemas.MasterPatient)
+async def patient_records(
+   patient_id: int,
+   request: Request,
+   db: AsyncSession = Depends(get_async_db),
+   current_user=Depends(require_role_async(['admin','staff','doctor'], claims_only=True))
+):
+   """Where this patient has records: the master patient index entry and its linked branch records."""
+   return await _master_patient(request, db, patient_id)
+
+@router.get("/{patient_id}/history/merged",response_model=schemas.MergedPatientHistory)
+async def merged_patient_history(
+   patient_id: int,
+   request: Request,
+   db: AsyncSession = Depends(get_async_db),
+   current_user = Depends(require_role_async(['admin','doctor']))
+):
+   """Appointments of every branch record linked to this patient, newest first; unreachable branches go in X-Federation-Errors."""
+   master = await _master_patient(request, db, patient_id)
+   return await run_in_threadpool(patient_index.merged_history, master)
+
+@router.get("/{patient_id}/history",response_model=schemas.PatientHistory)
+@query_budget(5)
+async def patient_history(
+   patient_id: int,
+   db: AsyncSession = Depends(get_async_db),
+   current_user = Depends(require_role_async(['admin','doctor']))
 ):
-   return crud.get_patients(db)
+   """Patient with every appointment, newest first, and each visit's doctor, record and payment."""
+   db_patient = await async_crud.get_patient_history(db, patient_id)
+   if not db_patient:
+      raise HTTPException(
+         status_code=404,
+         detail='Patient not found'
+      )
+   history = schemas.PatientHistory.model_validate(db_patient)
+   history.appointments.sort(key=lambda appointment: appointment.scheduled_at, reverse=True)
+   return history
 
 @router.put("/{patient_id}",response_model=schemas.PatientOut)
-def update_patient(
+async def update_patient(
    patient_id: int,
    updated_data: schemas.PatientCreate,
-   db: Session = Depends(get_db),
-   current_user = Depends(require_role(['admin','staff']))
+   db: AsyncSession = Depends(get_async_db),
+   current_user = Depends(require_role_async(['admin','staff']))
 ):
-   db_patient= crud.get_patient_by_id(db, patient_id)
+   db_patient= await async_crud.get_patient_by_id(db, patient_id)
    if not db_patient:
       raise HTTPException(
          status_code=404,
          detail='Patient not found'
       )
-   return crud.update_patient(db, db_patient,updated_data)
+   return await async_crud.update_patient(db, db_patient,updated_data)
 
 @router.delete("/{patient_id}")
-def delete_patient(
+async def delete_patient(
    patient_id: int,
-   db: Session = Depends(get_db),
-   current_user = Depends(require_role(['admin']))
+   db: AsyncSession = Depends(get_async_db),
+   current_user = Depends(require_role_async(['admin']))
 ):
-   db_patient = crud.get_patient_by_id(db,patient_id)
+   db_patient = await async_crud.get_patient_by_id(db,patient_id)
    if not db_patient:
       raise HTTPException(
          status_code=404,
          detail='Patient not found'
       )
-   crud.delete_patient(db,db_patient)
+   await async_crud.delete_patient(db,db_patient)
    return {"message":f"Patient with id {patient_id} has been deleted successfully"}
\ No newline at end of file
@@ -1,30 +1,21 @@
 from fastapi import APIRouter, Depends, HTTPException, Request
+from sqlalchemy.ext.asyncio import AsyncSession
 from sqlalchemy.orm import Session
-import schemas, models, crud, config
-from schemas import PaymentItemCreate, PaymentOutWithItems, PaymentItemOut
-from auth import require_role
-from database import get_db
-import midtransclient
-import hashlib
+import schemas, models, crud, async_crud, midtrans, payment_queue, reconciliation
+from schemas import PaymentItemCreate, PaymentItemsCreate, PaymentOutWithItems, PaymentItemOut
+from auth import require_role, require_role_async
+from database import get_async_db, get_db
+from querycount import query_budget
 
 router = APIRouter(
     prefix="/payments",
     tags=['payments']
 )
 
-# Initialize Midtrans Snap client
-snap = midtransclient.Snap(
-    is_production=False,
-    server_key=config.MIDTRANS_SERVER_KEY,
-    client_key=config.MIDTRANS_CLIENT_KEY
-)
-
-# Initialize Core API for transaction status
-core_api = midtransclient.CoreApi(
-    is_production=False,
-    server_key=config.MIDTRANS_SERVER_KEY,
-    client_key=config.MIDTRANS_CLIENT_KEY
-)
+# Midtrans calls go through midtrans.gateway (async, pooled connections,
+# circuit breaker). Handlers close their DB session before calling out so a
+# slow gateway does not hold a pooled connection; GatewayUnavailable is
+# turned into a 503 by the handler in main.py.
 
 
 @router.post("/", response_model=schemas.PaymentOut)
@@ -37,23 +28,24 @@ def create_payment(
 
 
 @router.post("/create-snap-token")
-def create_snap_payment(
+async def create_snap_payment(
     payment: schemas.PaymentCreate,
-    db: Session = Depends(get_db),
-    current_user=Depends(require_role(['staff', 'admin']))
+    db: AsyncSession = Depends(get_async_db),
+    current_user=Depends(require_role_async(['staff', 'admin']))
 ):
     """
     Create payment using Midtrans Snap (for various payment methods)
     Returns snap_token for frontend integration
     """
     # Create payment record in database
-    db_payment = crud.create_payment(db, payment)
+    db_payment = await async_crud.create_payment(db, payment)
+    await db.close()
     
     # Build transaction parameter
     transaction_params = {
         "transaction_details": {
-            "order_id": "test-transaction-123",
-            "gross_amount": 200000
+            "order_id": f"PAY-{db_payment.id}",
+            "gross_amount": int(db_payment.amount)
         }, "credit_card":{
             "secure" : True
         }, "customer_details":{
@@ -78,47 +70,44 @@ def create_snap_payment(
     
     try:
         # Create Snap transaction
-        transaction = snap.create_transaction(transaction_params)
-        
-        # Store transaction token in database
-        db_payment.transaction_id = transaction['token']
-        db_payment.snap_token = transaction['token']
-        db.commit()
-        db.refresh(db_payment)
-        
-        return {
-            "message": "Snap token created successfully",
-            "payment_id": db_payment.id,
-            "snap_token": transaction['token'],
-            "redirect_url": transaction['redirect_url']
-        }
-    
-    except Exception as e:
-        db.rollback()
+        transaction = await midtrans.gateway.create_snap_transaction(transaction_params)
+    except midtrans.MidtransError as e:
         raise HTTPException(
             status_code=400,
             detail=f"Failed to create Midtrans transaction: {str(e)}"
         )
 
+    # Store transaction token in database
+    db_payment = await async_crud.set_payment_transaction(db, db_payment.id, transaction['token'])
+    
+    return {
+        "message": "Snap token created successfully",
+        "payment_id": db_payment.id,
+        "snap_token": transaction['token'],
+        "redirect_url": transaction['redirect_url']
+    }
+
 
 @router.post("/create-bank-transfer")
-def create_bank_transfer_payment(
+async def create_bank_transfer_payment(
     payment: schemas.PaymentCreate,
     bank_type: str = "bca",  # bca, bni, bri, permata
-    db: Session = Depends(get_db),
-    current_user=Depends(require_role(['staff', 'admin']))
+    db: AsyncSession = Depends(get_async_db),
+    current_user=Depends(require_role_async(['staff', 'admin']))
 ):
     """
     Create payment specifically for bank transfer using Core API
     """
     # Create payment record in database
-    db_payment = crud.create_payment(db, payment)
+    db_payment = await async_crud.create_payment(db, payment)
+    await db.close()
     
     # Build transaction parameter
+    order_id = f"PAY-{db_payment.id}"
     transaction_params = {
         "payment_type": "bank_transfer",
         "transaction_details": {
-            "order_id": f"PAY-{db_payment.id}",
+            "order_id": order_id,
             "gross_amount": int(db_payment.amount)
         },
         "bank_transfer": {
@@ -127,142 +116,129 @@ def create_bank_transfer_payment(
     }
     
     try:
-        # Charge using Core API
-        charge_response = core_api.charge(transaction_params)
-        
-        # Store transaction details
-        db_payment.transaction_id = charge_response['transaction_id']
-        db_payment.status = charge_response['transaction_status']
-        db.commit()
-        db.refresh(db_payment)
-        
-        # Extract VA number based on bank type
-        va_numbers = charge_response.get('va_numbers', [])
-        va_number = va_numbers[0]['va_number'] if va_numbers else None
-        
-        return {
-            "message": "Bank transfer payment created",
-            "payment_id": db_payment.id,
-            "transaction_id": charge_response['transaction_id'],
-            "va_number": va_number,
-            "bank": bank_type,
-            "gross_amount": charge_response['gross_amount'],
-            "transaction_status": charge_response['transaction_status']
-        }
-    
-    except Exception as e:
-        db.rollback()
+        # Charge using Core API; the order id doubles as idempotency key so the charge can be retried
+        charge_response = await midtrans.gateway.charge(transaction_params, idempotency_key=order_id)
+    except midtrans.MidtransError as e:
         raise HTTPException(
             status_code=400,
             detail=f"Failed to create bank transfer: {str(e)}"
         )
 
+    # Store transaction details
+    db_payment = await async_crud.set_payment_transaction(
+        db, db_payment.id, charge_response['transaction_id'],
+        midtrans.internal_status(charge_response['transaction_status'], charge_response.get('fraud_status')),
+    )
+    
+    # Extract VA number based on bank type
+    va_numbers = charge_response.get('va_numbers', [])
+    va_number = va_numbers[0]['va_number'] if va_numbers else None
+    
+    return {
+        "message": "Bank transfer payment created",
+        "payment_id": db_payment.id,
+        "transaction_id": charge_response['transaction_id'],
+        "va_number": va_number,
+        "bank": bank_type,
+        "gross_amount": charge_response['gross_amount'],
+        "transaction_status": charge_response['transaction_status']
+    }
+
 
 @router.post("/notification")
-async def midtrans_notification(request: Request, db: Session = Depends(get_db)):
+async def midtrans_notification(request: Request, db: AsyncSession = Depends(get_async_db)):
     """
     Handle Midtrans payment notification (webhook)
+
+    The notification is verified and queued; payment_queue applies it in the
+    background so Midtrans gets its 200 immediately and does not retry.
     """
     try:
-        # Get notification body
         notification_body = await request.json()
-        
-        # Verify notification authenticity
-        order_id = notification_body.get('order_id')
-        status_code = notification_body.get('status_code')
-        gross_amount = notification_body.get('gross_amount')
-        signature_key = notification_body.get('signature_key')
-        
-        # Create hash for verification
-        hash_string = f"{order_id}{status_code}{gross_amount}{config.MIDTRANS_SERVER_KEY}"
-        calculated_signature = hashlib.sha512(hash_string.encode('utf-8')).hexdigest()
-        
-        # Verify signature
-        if calculated_signature != signature_key:
-            raise HTTPException(status_code=403, detail="Invalid signature")
-        
-        # Get transaction status from Midtrans
-        transaction_status = notification_body.get('transaction_status')
-        fraud_status = notification_body.get('fraud_status')
-        transaction_id = notification_body.get('transaction_id')
-        
-        # Map Midtrans status to internal status
-        if transaction_status == 'capture':
-            if fraud_status == 'accept':
-                new_status = 'paid'
-            else:
-                new_status = 'pending'
-        elif transaction_status == 'settlement':
-            new_status = 'paid'
-        elif transaction_status in ['cancel', 'deny', 'expire']:
-            new_status = 'failed'
-        elif transaction_status == 'pending':
-            new_status = 'pending'
-        else:
-            new_status = 'pending'
-        
-        # Update payment status in database
-        crud.update_payment_status(db, transaction_id, new_status)
-                
-        return {
-            "message": "Notification processed successfully",
-            "status": new_status
-        }
-    
-    except Exception as e:
-        raise HTTPException(status_code=400, detail=str(e))
+    except ValueError:
+        raise HTTPException(status_code=400, detail="Invalid JSON body")
+    if not isinstance(notification_body, dict):
+        raise HTTPException(status_code=400, detail="Invalid notification body")
+
+    if not midtrans.verify_signature(notification_body):
+        raise HTTPException(status_code=403, detail="Invalid signature")
+
+    if not notification_body.get('transaction_id') or not notification_body.get('transaction_status'):
+        raise HTTPException(status_code=400, detail="Missing transaction_id or transaction_status")
+
+    queued = await payment_queue.enqueue(db, notification_body)
+    return {
+        "message": "Notification queued" if queued else "Duplicate notification ignored",
+        "status": midtrans.internal_status(
+            notification_body.get('transaction_status'),
+            notification_body.get('fraud_status'),
+        )
+    }
+
+
+@router.get("/notifications/stats")
+def notification_queue_stats(
+    current_user=Depends(require_role(['admin']))
+):
+    return {**payment_queue.stats.snapshot(), "depth": payment_queue.depth()}
+
+
+@router.get("/gateway/stats")
+def gateway_stats(
+    current_user=Depends(require_role(['admin']))
+):
+    return midtrans.gateway.stats()
+
+
+@router.get("/reconciliation/stats")
+def reconciliation_stats(
+    current_user=Depends(require_role(['admin']))
+):
+    return reconciliation.stats.snapshot()
 
 
 @router.get("/{payment_id}/status")
-def check_payment_status(
+async def check_payment_status(
     payment_id: int,
-    db: Session = Depends(get_db),
-    current_user=Depends(require_role(['admin', 'staff']))
+    db: AsyncSession = Depends(get_async_db),
+    current_user=Depends(require_role_async(['admin', 'staff']))
 ):
     """
     Check payment status from Midtrans
     """
-    payment = crud.get_payment_with_items(db, payment_id)
+    payment = await async_crud.get_payment_by_id(db, payment_id)
     if not payment:
         raise HTTPException(status_code=404, detail="Payment not found")
     
     if not payment.transaction_id:
         raise HTTPException(status_code=400, detail="No transaction ID found")
+    await db.close()
     
     try:
         # Get transaction status from Midtrans
         order_id = f"PAY-{payment_id}"
-        status_response = core_api.transactions.status(order_id)
-        
-        # Update local status
-        transaction_status = status_response['transaction_status']
-        fraud_status = status_response.get('fraud_status', '')
-        
-        if transaction_status == 'capture':
-            new_status = 'paid' if fraud_status == 'accept' else 'pending'
-        elif transaction_status == 'settlement':
-            new_status = 'paid'
-        elif transaction_status in ['cancel', 'deny', 'expire']:
-            new_status = 'failed'
-        else:
-            new_status = 'pending'
-        
-        crud.update_payment_status(db, payment.transaction_id, new_status)
-        
-        return {
-            "payment_id": payment_id,
-            "transaction_id": payment.transaction_id,
-            "status": new_status,
-            "midtrans_status": transaction_status,
-            "fraud_status": fraud_status
-        }
-    
-    except Exception as e:
+        status_response = await midtrans.gateway.transaction_status(order_id)
+    except midtrans.MidtransError as e:
         raise HTTPException(
             status_code=400,
             detail=f"Failed to check payment status: {str(e)}"
         )
 
+    # Update local status
+    transaction_status = status_response['transaction_status']
+    fraud_status = status_response.get('fraud_status', '')
+    new_status = midtrans.internal_status(transaction_status, fraud_status)
+    
+    await async_crud.update_payment_status(db, payment.transaction_id, new_status)
+    
+    return {
+        "payment_id": payment_id,
+        "transaction_id": payment.transaction_id,
+        "status": new_status,
+        "midtrans_status": transaction_status,
+        "fraud_status": fraud_status
+    }
+
 
 @router.post("/{payment_id}/items", response_model=PaymentItemOut)
 def add_payment_item(
@@ -271,10 +247,30 @@ def add_payment_item(
     db: Session = Depends(get_db),
     current_user=Depends(require_role(['admin', 'staff']))
 ):
-    return crud.create_payment_item(db, payment_id, item)
+    db_item = crud.create_payment_item(db, payment_id, item)
+    if db_item is None:
+        raise HTTPException(status_code=404, detail="Payment not found")
+    return db_item
+
+
+@router.post("/{payment_id}/items/bulk", response_model=PaymentOutWithItems)
+@query_budget(6)
+def add_payment_items(
+    payment_id: int,
+    payload: PaymentItemsCreate,
+    db: Session = Depends(get_db),
+    current_user=Depends(require_role(['admin', 'staff']))
+):
+    """
+    Add all invoice lines at once; the payment amount is recomputed from its items
+    """
+    if crud.add_payment_items(db, payment_id, payload.items) is None:
+        raise HTTPException(status_code=404, detail="Payment not found")
+    return crud.get_payment_with_items(db, payment_id)
 
 
 @router.get("/{payment_id}", response_model=PaymentOutWithItems)
+@query_budget(3)
 def get_payment_detail(
     payment_id: int,
     db: Session = Depends(get_db),
@@ -1,8 +1,10 @@
-from fastapi import APIRouter, Depends, HTTPException, status, Query
+from fastapi import APIRouter, Depends, HTTPException, status, Query, Request
 from sqlalchemy.orm import Session
 import models, schemas, crud
 from auth import get_current_user,require_role
 from database import get_db
+from pagination import PageParams, ndjson_response
+from response_cache import encode_list, response_cache
 from crud import hash_password, get_all_users
 
 router = APIRouter(
@@ -33,12 +35,21 @@ def create_user(
 
 @router.get("/", response_model=list[schemas.UserOut])
 def list_users(
+    request: Request,
     role: str | None = Query(None, description="Filter berdasarkan role user"),
+    page: PageParams = Depends(),
     db: Session = Depends(get_db),
     current_user = Depends(require_role(['admin']))
 ):
-    users = crud.get_all_users(db, role=role)
-    return users
+    if page.stream:
+        return ndjson_response(crud.iter_users(db, role=role, after=page.after, limit=page.limit), schemas.UserOut)
+    # doctor/staff lists are read on every page load and change rarely
+    key = response_cache.key(request, ("users",), current_user)
+    cached = response_cache.lookup(request, key)
+    if cached is not None:
+        return cached
+    users, next_cursor = crud.get_all_users(db, role=role, limit=page.limit, after=page.after)
+    return response_cache.store(request, key, encode_list(schemas.UserOut, users), next_cursor)
 
 @router.put("/{user_id}", response_model=schemas.UserOut)
 def update_user(
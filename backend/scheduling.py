@@ -0,0 +1,100 @@
+import bisect
+from datetime import datetime, timedelta, timezone
+
+from sqlalchemy import select
+
+import config, models
+
+# Doctor schedules are read as a range scan on ix_appointments_doctor_id_scheduled_at.
+# Because an appointment never lasts longer than MAX_DURATION, every booking that
+# overlaps [start, end) begins in [start - MAX_DURATION, end), so one index range
+# gives all candidates in O(log n + k) and DoctorSchedule works on just those.
+
+MAX_DURATION = timedelta(minutes=config.APPOINTMENT_MAX_MINUTES)
+MAX_WINDOW = timedelta(days=31)
+# statuses that do not occupy the doctor's time
+INACTIVE_STATUSES = ("cancelled",)
+
+class ScheduleConflict(Exception):
+  def __init__(self, appointment_id: int, start: datetime, end: datetime):
+    super().__init__(f"Doctor already has appointment {appointment_id} from {start} to {end}")
+    self.appointment_id = appointment_id
+    self.start = start
+    self.end = end
+
+def normalize(dt: datetime) -> datetime:
+  """scheduled_at is a naive TIMESTAMP; aware datetimes are stored as naive UTC."""
+  if dt.tzinfo is not None:
+    return dt.astimezone(timezone.utc).replace(tzinfo=None)
+  return dt
+
+class DoctorSchedule:
+  """Booked intervals of one doctor inside a window, sorted by start."""
+  def __init__(self, bookings):
+    # bookings: iterable of (start, end, appointment_id)
+    self.intervals = sorted(bookings)
+    self.starts = [interval[0] for interval in self.intervals]
+
+  def overlapping(self, start: datetime, end: datetime) -> list[tuple]:
+    lo = bisect.bisect_left(self.starts, start - MAX_DURATION)
+    hi = bisect.bisect_left(self.starts, end)
+    return [interval for interval in self.intervals[lo:hi] if interval[1] > start]
+
+  def free_windows(self, start: datetime, end: datetime, min_length: timedelta) -> list[tuple[datetime, datetime]]:
+    free = []
+    cursor = start
+    for busy_start, busy_end, _ in self.overlapping(start, end):
+      if busy_start - cursor >= min_length:
+        free.append((cursor, busy_start))
+      cursor = max(cursor, busy_end)
+    if end - cursor >= min_length:
+      free.append((cursor, end))
+    return free
+
+def _bookings_stmt(doctor_id: int, start: datetime, end: datetime, exclude_id: int | None = None):
+  stmt = (
+    select(models.Appointment.id, models.Appointment.scheduled_at, models.Appointment.duration_minutes)
+    .where(
+      models.Appointment.doctor_id == doctor_id,
+      models.Appointment.scheduled_at >= start - MAX_DURATION,
+      models.Appointment.scheduled_at < end,
+      models.Appointment.status.notin_(INACTIVE_STATUSES),
+    )
+    .order_by(models.Appointment.scheduled_at)
+  )
+  if exclude_id is not None:
+    stmt = stmt.where(models.Appointment.id != exclude_id)
+  return stmt
+
+def _schedule(rows) -> DoctorSchedule:
+  return DoctorSchedule(
+    (row.scheduled_at, row.scheduled_at + timedelta(minutes=row.duration_minutes), row.id)
+    for row in rows
+  )
+
+def _lock_doctor_stmt(doctor_id: int):
+  # serializes bookings per doctor; no-op on SQLite, which serializes writers anyway
+  return select(models.User.id).where(models.User.id == doctor_id).with_for_update()
+
+def _raise_on_conflict(schedule: DoctorSchedule, start: datetime, end: datetime):
+  conflicts = schedule.overlapping(start, end)
+  if conflicts:
+    busy_start, busy_end, appointment_id = conflicts[0]
+    raise ScheduleConflict(appointment_id, busy_start, busy_end)
+
+def ensure_free(db, doctor_id: int, start: datetime, duration_minutes: int, exclude_id: int | None = None):
+  """Lock the doctor row and raise ScheduleConflict if [start, start + duration) is booked.
+
+  The lock is held until the caller commits, so the check and the insert are atomic.
+  """
+  end = start + timedelta(minutes=duration_minutes)
+  db.execute(_lock_doctor_stmt(doctor_id))
+  _raise_on_conflict(_schedule(db.execute(_bookings_stmt(doctor_id, start, end, exclude_id))), start, end)
+
+async def ensure_free_async(db, doctor_id: int, start: datetime, duration_minutes: int, exclude_id: int | None = None):
+  end = start + timedelta(minutes=duration_minutes)
+  await db.execute(_lock_doctor_stmt(doctor_id))
+  _raise_on_conflict(_schedule(await db.execute(_bookings_stmt(doctor_id, start, end, exclude_id))), start, end)
+
+async def load_schedule(db, doctor_id: int, start: datetime, end: datetime) -> DoctorSchedule:
+  return _schedule(await db.execute(_bookings_stmt(doctor_id, start, end)))
@@ -1,11 +1,19 @@
-from pydantic import BaseModel
+from pydantic import BaseModel, Field, PlainSerializer
 from datetime import datetime
-from typing import Optional
+from decimal import Decimal
+from typing import Annotated, Optional
+import config
+
+# Money is exact (Decimal, NUMERIC(12, 2) in the database) but stays a JSON number for the frontend
+Money = Annotated[Decimal, Field(max_digits=12, decimal_places=2), PlainSerializer(float, return_type=float, when_used="json")]
 
 class UserLogin(BaseModel):
   username: str
   password: str
 
+class TokenRefresh(BaseModel):
+  refresh_token: str
+
 class UserCreate(BaseModel):
   username: str
   password: str
@@ -41,29 +49,46 @@ class PatientOut(BaseModel):
   class Config:
       from_attributes = True
 
+class PatientImportError(BaseModel):
+  row: int
+  national_id: str | None = None
+  errors: list[str]
+
+class PatientImportReport(BaseModel):
+  received: int
+  imported: int
+  duplicates: int
+  invalid: int
+  errors: list[PatientImportError]
+  errors_truncated: bool
+  seconds: float
+  rows_per_second: float
+
 class AppointmentCreate(BaseModel):
   patient_id: int
   doctor_id: int
   scheduled_at: datetime
+  duration_minutes: int = Field(config.APPOINTMENT_DEFAULT_MINUTES, ge=5, le=config.APPOINTMENT_MAX_MINUTES)
 
 class AppointmentOut(BaseModel):
   id: int
   patient_id: int
   doctor_id: int
   scheduled_at: datetime
+  duration_minutes: int = config.APPOINTMENT_DEFAULT_MINUTES
   status: str
   class Config:
       from_attributes = True
 
-class AppointmentDetail(BaseModel):
-  id: int
-  patient_id: int
-  doctor_id: int
-  scheduled_at: datetime
-  status: str
+class TimeWindow(BaseModel):
+  start: datetime
+  end: datetime
 
-  class Config:
-     from_attributes = True
+class DoctorAvailability(BaseModel):
+  doctor_id: int
+  start: datetime
+  end: datetime
+  free: list[TimeWindow]
 
 class MedicalRecordBase(BaseModel):
   appointment_id: int
@@ -83,9 +108,23 @@ class MedicalRecord(MedicalRecordBase):
   class Config:
     from_attributes = True
 
+class MedicalRecordEntry(BaseModel):
+  """Timeline row; the text fields are only present when requested."""
+  id: int
+  appointment_id: int
+  patient_id: int
+  doctor_id: int
+  created_at: datetime
+  diagnosis: str | None = None
+  treatment: str | None = None
+  notes: str | None = None
+
+  class Config:
+    from_attributes = True
+
 class PaymentBase(BaseModel):
   appointment_id: int
-  amount: float
+  amount: Money
   payment_method: str
 
 class PaymentCreate(PaymentBase):
@@ -102,18 +141,63 @@ class PaymentOut(PaymentBase):
 
 class PaymentItemBase(BaseModel):
   description: str
-  quantity: int = 1
-  price: float
+  quantity: int = Field(1, ge=1)
+  price: Money
 
 class PaymentItemCreate(PaymentItemBase):
   pass
 
+class PaymentItemsCreate(BaseModel):
+  items: list[PaymentItemCreate] = Field(min_length=1, max_length=500)
+
 class PaymentItemOut(PaymentItemBase):
   id: int
-  total: float
+  total: Money
 
   class Config:
     from_attributes = True
   
 class PaymentOutWithItems(PaymentOut):
-  items: list[PaymentItemOut]=[]
\ No newline at end of file
+  items: list[PaymentItemOut]=[]
+
+# Composite reads; the crud loaders eager-load exactly these relationships
+class AppointmentHistoryEntry(BaseModel):
+  id: int
+  patient_id: int
+  doctor_id: int
+  scheduled_at: datetime
+  duration_minutes: int = config.APPOINTMENT_DEFAULT_MINUTES
+  status: str
+  doctor: UserOut | None = None
+  medical_record: MedicalRecord | None = None
+  payment: PaymentOutWithItems | None = None
+
+  class Config:
+     from_attributes = True
+
+class AppointmentDetail(AppointmentHistoryEntry):
+  patient: PatientOut
+
+class PatientHistory(PatientOut):
+  appointments: list[AppointmentHistoryEntry] = []
+
+# Master patient index (patient_index.py)
+class PatientLocation(BaseModel):
+  branch: str
+  patient_id: int
+  match: str
+  score: float | None = None
+
+class MasterPatient(BaseModel):
+  id: int
+  national_id: str | None = None
+  name: str | None = None
+  phone: str | None = None
+  records: list[PatientLocation]
+
+class MergedHistoryEntry(AppointmentHistoryEntry):
+  branch: str
+
+class MergedPatientHistory(BaseModel):
+  master: MasterPatient
+  appointments: list[MergedHistoryEntry] = []
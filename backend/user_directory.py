@@ -0,0 +1,113 @@
+"""Global username -> branch directory, so /login/ finds an account in one lookup.
+
+Every branch database holds a full replica of user_directory. The user write
+paths in crud.py update all replicas after the user row commits. /login/
+reads a single replica with a primary-key lookup: the ?branch= database, or
+USER_DIRECTORY_BRANCH when the client gives no branch. It then authenticates
+against the branch that holds the account, instead of trying each branch.
+
+A username that exists in two branches keeps pointing at the branch that
+registered it first; ?branch= still logs into the other one. A replica can
+miss a write while its database is down. The next successful login with
+?branch= repairs it, or run:
+
+    python user_directory.py --rebuild
+"""
+import argparse
+import json
+import logging
+from datetime import datetime
+
+from sqlalchemy import delete, insert, select
+from sqlalchemy.dialects import postgresql, sqlite
+
+import config, metrics, models
+from database import async_engines, engines, session_branch
+
+logger = logging.getLogger(__name__)
+
+LOOKUPS = metrics.Counter("user_directory_lookups_total", "Login directory lookups by result (hit, miss).", ("result",))
+
+_table = models.UserDirectoryEntry.__table__
+
+class Entry:
+  __slots__ = ("branch", "role")
+
+  def __init__(self, branch: str, role: str | None):
+    self.branch = branch
+    self.role = role
+
+def _upsert(dialect: str):
+  stmt = (postgresql.insert if dialect == "postgresql" else sqlite.insert)(_table)
+  # only the branch that owns the entry may change it: the first registration wins
+  return stmt.on_conflict_do_update(
+    index_elements=[_table.c.username],
+    set_={"user_id": stmt.excluded.user_id, "role": stmt.excluded.role, "updated_at": stmt.excluded.updated_at},
+    where=_table.c.branch == stmt.excluded.branch,
+  )
+
+def _row(username: str, branch: str, user_id: int, role: str | None) -> dict:
+  return {"username": username, "branch": branch, "user_id": user_id, "role": role, "updated_at": datetime.utcnow()}
+
+def _replicate(apply):
+  """Run apply(conn) on every replica; a branch that is down is logged and skipped."""
+  for branch, engine in engines.items():
+    try:
+      with engine.begin() as conn:
+        apply(conn)
+    except Exception:
+      logger.exception("user directory replica on %s was not updated", branch)
+
+def on_user_saved(db, user, old_username: str | None = None):
+  """Register a created/updated user of db's branch in every replica."""
+  branch = session_branch(db)
+  row = _row(user.username, branch, user.id, user.role)
+  def apply(conn):
+    if old_username is not None and old_username != user.username:
+      conn.execute(delete(_table).where(_table.c.username == old_username, _table.c.branch == branch))
+    conn.execute(_upsert(conn.dialect.name), [row])
+  _replicate(apply)
+
+def on_user_deleted(db, username: str):
+  branch = session_branch(db)
+  _replicate(lambda conn: conn.execute(delete(_table).where(_table.c.username == username, _table.c.branch == branch)))
+
+async def lookup(username: str, replica: str = config.USER_DIRECTORY_BRANCH) -> Entry | None:
+  async with async_engines[replica].connect() as conn:
+    row = (await conn.execute(select(_table.c.branch, _table.c.role).where(_table.c.username == username))).first()
+  LOOKUPS.labels("hit" if row is not None else "miss").inc()
+  return Entry(row.branch, row.role) if row is not None else None
+
+async def register(user, branch: str):
+  """Add an account found by a ?branch= login to every replica."""
+  row = _row(user.username, branch, user.id, user.role)
+  for name, engine in async_engines.items():
+    try:
+      async with engine.begin() as conn:
+        await conn.execute(_upsert(conn.dialect.name), [row])
+    except Exception:
+      logger.exception("user directory replica on %s was not updated", name)
+
+def rebuild() -> dict:
+  """Replace every replica with the users of all branches."""
+  rows = {}
+  for branch, engine in engines.items():
+    with engine.connect() as conn:
+      for user in conn.execute(select(models.User.username, models.User.id, models.User.role)):
+        if user.username is not None and user.username not in rows:
+          rows[user.username] = _row(user.username, branch, user.id, user.role)
+  for engine in engines.values():
+    with engine.begin() as conn:
+      conn.execute(delete(_table))
+      if rows:
+        conn.execute(insert(_table), list(rows.values()))
+  return {"entries": len(rows), "replicas": list(engines)}
+
+if __name__ == "__main__":
+  parser = argparse.ArgumentParser(description="Maintain the user directory replicas")
+  parser.add_argument("--rebuild", action="store_true", help="rebuild every replica from the users tables")
+  args = parser.parse_args()
+  if not args.rebuild:
+    parser.error("nothing to do; pass --rebuild")
+  logging.basicConfig(level=logging.INFO)
+  print(json.dumps(rebuild()))
@@ -1,6 +1,7 @@
 'use client'
 import { useState, useEffect } from 'react'
 import DoctorForm from '@/app/components/form/DoctorForm'
+import { fetchAllPages } from '@/utils/pagination'
 
 // API Base URL - sesuaikan dengan backend Anda
 const API_BASE_URL = 'http://localhost:8000'
@@ -24,7 +25,8 @@ export default function Page() {
     const fetchDoctors = async () => {
         try {
             setLoading(true);
-            const response = await fetch(`${API_BASE_URL}/users/?role=doctor`, {
+            // backend mengembalikan satu halaman per request; ikuti X-Next-Cursor sampai habis
+            const data = await fetchAllPages(`${API_BASE_URL}/users/?role=doctor`, {
                 method: 'GET', // <-- pindahkan ke sini
                 headers: {
                     'Authorization': `Bearer ${getAuthToken()}`,
@@ -33,12 +35,6 @@ export default function Page() {
                 credentials: 'include', // opsional, kalau pakai cookie-based auth
             });
 
-            if (!response.ok) {
-                throw new Error('Failed to fetch doctors');
-            }
-
-            const data = await response.json();
-
             // API-mu sudah bisa filter berdasarkan role,
             const doctorUsers = data.filter(user => user.role === 'doctor');
             setDoctors(doctorUsers);
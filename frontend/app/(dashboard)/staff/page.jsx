@@ -1,6 +1,7 @@
 'use client'
 import { useState, useEffect } from 'react'
 import StaffForm from '@/app/components/form/StaffForm'
+import { fetchAllPages } from '@/utils/pagination'
 
 // API Base URL - sesuaikan dengan backend Anda
 const API_BASE_URL = 'http://localhost:8000'
@@ -24,7 +25,8 @@ export default function Page() {
     const fetchStaff = async () => {
         try {
             setLoading(true)
-            const response = await fetch(`${API_BASE_URL}/users/?role=staff`, {
+            // backend mengembalikan satu halaman per request; ikuti X-Next-Cursor sampai habis
+            const data = await fetchAllPages(`${API_BASE_URL}/users/?role=staff`, {
                 method: 'GET',
                 headers: {
                     'Authorization': `Bearer ${getAuthToken()}`,
@@ -32,12 +34,6 @@ export default function Page() {
                 },
                 credentials: 'include',
             })
-
-            if (!response.ok) {
-                throw new Error('Failed to fetch staff')
-            }
-
-            const data = await response.json()
             const staffUsers = data.filter(user => user.role === 'staff')
             setStaff(staffUsers)
             setError(null)
@@ -0,0 +1,29 @@
+// utils/pagination.js
+// Helper untuk list endpoint backend yang dipaginasi (keyset cursor)
+
+/**
+ * Fetch every page of a paginated list endpoint.
+ * The backend returns at most one page per request and puts the cursor for
+ * the next page in the X-Next-Cursor header; this follows it with ?after=
+ * until no header is returned.
+ * @param {string} url - List endpoint URL (may already have query parameters)
+ * @param {RequestInit} options - fetch options (headers, credentials, ...)
+ * @returns {Promise<Array>} All rows of all pages
+ */
+export const fetchAllPages = async (url, options = {}) => {
+    const rows = []
+    let after = null
+    do {
+        const pageUrl = new URL(url)
+        if (after !== null) {
+            pageUrl.searchParams.set('after', after)
+        }
+        const response = await fetch(pageUrl.toString(), options)
+        if (!response.ok) {
+            throw new Error(`Request failed with status ${response.status}`)
+        }
+        rows.push(...await response.json())
+        after = response.headers.get('X-Next-Cursor')
+    } while (after !== null)
+    return rows
+}